@@ -0,0 +1,143 @@
+"""Latency of small renders while large ones are being rendered, with and without the heavy lane.
+
+Runs the same mixed load against the Flask app through its test client twice, each in a fresh
+process: once with every render on one lane (as before renders were split by cost), and once with
+the default fast and heavy lanes. Both have the same number of render processes in total. A few
+clients keep asking for a long OGG while others send short clicktracks, each at a different tempo
+so none are served by the render cache, and the small requests' latency percentiles are recorded.
+
+Uploads go to the stub storage from pipeline.py. Run from the repo root:
+
+    python benchmarks/lanes.py [--seconds 30] [--output results.json]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from payloads import PAYLOADS, with_tempo_offset  # noqa: E402
+from pipeline import git_revision, install_stub_storage, percentile  # noqa: E402
+
+SMALL_PAYLOADS = ["short", "odd_meters", "polyrhythm"]
+HEAVY_PAYLOAD = "long"
+
+
+def scenarios(workers: int) -> dict:
+    """The environment of each scenario, with the same number of render processes in all of them"""
+    return {
+        "one_lane": {"FAST_LANE_MAX_MS": "inf", "RENDER_JOB_WORKERS": str(workers)},
+        "two_lanes": {"RENDER_JOB_WORKERS": str(max(workers - 1, 1)), "HEAVY_JOB_WORKERS": "1"},
+    }
+
+
+def run_load(seconds: float, small_clients: int, heavy_clients: int, small_format: str) -> dict:
+    from midi_app import app
+
+    install_stub_storage(0)
+    small_latencies, heavy_latencies, statuses = [], [], {}
+    lock = threading.Lock()
+    deadline = time.perf_counter() + seconds
+    counter = iter(range(1, 1_000_000))
+
+    def client(heavy: bool) -> None:
+        test_client = app.test_client()
+        while time.perf_counter() < deadline:
+            with lock:
+                offset = next(counter)
+            if heavy:
+                endpoint, data = "/api/make_ogg", with_tempo_offset(PAYLOADS[HEAVY_PAYLOAD], offset)
+            else:
+                name = SMALL_PAYLOADS[offset % len(SMALL_PAYLOADS)]
+                endpoint, data = f"/api/make_{small_format}", with_tempo_offset(PAYLOADS[name], offset)
+            start = time.perf_counter()
+            response = test_client.post(endpoint, json=data)
+            elapsed = (time.perf_counter() - start) * 1000
+            with lock:
+                kind = "heavy" if heavy else "small"
+                statuses.setdefault(kind, {}).setdefault(str(response.status_code), 0)
+                statuses[kind][str(response.status_code)] += 1
+                if response.status_code == 200:
+                    (heavy_latencies if heavy else small_latencies).append(elapsed)
+            if response.status_code == 503:
+                time.sleep(1)
+
+    threads = [threading.Thread(target=client, args=(idx < heavy_clients,)) for idx in range(heavy_clients + small_clients)]
+    for thread in threads:
+        thread.start()
+        # The heavy clients get going first, so the small ones arrive to a busy server
+        time.sleep(0.2)
+    for thread in threads:
+        thread.join()
+
+    def summary(latencies):
+        if not latencies:
+            return {"count": 0}
+        return {
+            "count": len(latencies),
+            "p50": round(percentile(latencies, 50), 1),
+            "p95": round(percentile(latencies, 95), 1),
+            "p99": round(percentile(latencies, 99), 1),
+            "max": round(max(latencies), 1),
+        }
+
+    return {"small_ms": summary(small_latencies), "heavy_ms": summary(heavy_latencies), "statuses": statuses}
+
+
+def main(args) -> int:
+    results = {**git_revision(), "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"), "cpus": os.cpu_count(), "scenarios": {}}
+    print(f"{'scenario':>10} {'small':>6} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'heavy':>6} {'heavy p50':>10}")
+    for name, scenario_env in scenarios(args.workers).items():
+        with tempfile.TemporaryDirectory() as directory:
+            env = {
+                **os.environ,
+                "FLASK_ENV": os.environ.get("FLASK_ENV", "development"),
+                "STORAGE_BACKEND": "memory",
+                "RENDER_CACHE_DIR": os.path.join(directory, "render_cache"),
+                "EXPIRY_DIR": os.path.join(directory, "pending_deletions"),
+                "METRICS_DIR": os.path.join(directory, "metrics"),
+                **scenario_env,
+            }
+            command = [
+                sys.executable, __file__, "--child", "--seconds", str(args.seconds), "--small-clients",
+                str(args.small_clients), "--heavy-clients", str(args.heavy_clients), "--small-format", args.small_format,
+            ]
+            output = subprocess.run(command, capture_output=True, text=True, env=env)
+        if output.returncode:
+            raise RuntimeError(f"{name} failed:\n{output.stderr}")
+        # The app logs to stdout too, and renders still running when the load stops may log after
+        # the result, which is the last JSON line
+        lines = [line for line in output.stdout.splitlines() if line.startswith("{")]
+        result = results["scenarios"][name] = json.loads(lines[-1])
+        small, heavy = result["small_ms"], result["heavy_ms"]
+        print(
+            f"{name:>10} {small['count']:>6} {small.get('p50', 0):>8.1f} {small.get('p95', 0):>8.1f} "
+            f"{small.get('p99', 0):>8.1f} {heavy['count']:>6} {heavy.get('p50', 0):>10.1f}"
+        )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--seconds", type=float, default=30, help="how long to run each scenario for")
+    parser.add_argument("--small-clients", type=int, default=2)
+    parser.add_argument("--heavy-clients", type=int, default=3)
+    parser.add_argument("--small-format", default="wav", choices=["midi", "wav", "flac", "ogg"])
+    parser.add_argument("--workers", type=int, default=3, help="render processes in each scenario")
+    parser.add_argument("--output", help="file to write the JSON results to")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        print(json.dumps(run_load(args.seconds, args.small_clients, args.heavy_clients, args.small_format)))
+    else:
+        sys.exit(main(args))
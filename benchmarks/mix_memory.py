@@ -0,0 +1,87 @@
+"""Peak memory of combining two instruments' parts, against the length of the track.
+
+Compares reading both parts whole and adding them (as make_file_with_fluidsynth used to) with
+audio_processing.mix_parts, which mixes a block at a time. Each measurement runs in a fresh
+process, reporting how far its peak RSS rose while mixing.
+
+Run from the repo root:
+
+    python benchmarks/mix_memory.py [minutes ...]
+"""
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import soundfile as sf
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+SAMPLE_RATE = 44100
+DEFAULT_MINUTES = [1, 5, 10, 20]
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def mix_whole(part_filenames, output_filename):
+    audio_data1, sample_rate = sf.read(part_filenames[0])
+    audio_data2, sample_rate = sf.read(part_filenames[1])
+    shorter_length = min(len(audio_data1), len(audio_data2))
+    audio_data = audio_data1[:shorter_length] + audio_data2[:shorter_length]
+    sf.write(output_filename, audio_data, sample_rate)
+
+
+def write_part(filename: str, seconds: float, seed: int) -> None:
+    """Writes a part of clicks of the given length, a minute at a time"""
+    rng = np.random.default_rng(seed)
+    click = rng.uniform(-0.3, 0.3, (2000, 2)).astype(np.float32)
+    minute = np.zeros((60 * SAMPLE_RATE, 2), dtype=np.float32)
+    for offset in range(0, len(minute) - len(click), SAMPLE_RATE // 2):
+        minute[offset:offset + len(click)] = click
+    with sf.SoundFile(filename, "w", SAMPLE_RATE, 2) as f:
+        remaining = int(seconds * SAMPLE_RATE)
+        while remaining > 0:
+            f.write(minute[:remaining])
+            remaining -= len(minute)
+
+
+def child(method: str, output_filename: str, part_filenames) -> None:
+    from midi_app.audio_processing import mix_parts
+
+    baseline = peak_rss_mb()
+    start = time.perf_counter()
+    (mix_whole if method == "whole" else mix_parts)(part_filenames, output_filename)
+    print(f"{peak_rss_mb() - baseline:.1f} {time.perf_counter() - start:.3f}")
+
+
+def main(minutes):
+    print(f"{'minutes':>8} {'whole MB':>10} {'whole s':>8} {'blocks MB':>10} {'blocks s':>9}")
+    with tempfile.TemporaryDirectory() as directory:
+        for length in minutes:
+            parts = [os.path.join(directory, f"part{i}.wav") for i in (1, 2)]
+            for seed, part in enumerate(parts):
+                write_part(part, length * 60 + seed * 0.1, seed)
+            results = []
+            for method in ("whole", "blocks"):
+                output = subprocess.run(
+                    [sys.executable, __file__, "--child", method, os.path.join(directory, "output.wav"), *parts],
+                    capture_output=True,
+                    text=True,
+                    check=True,
+                    env={**os.environ, "FLASK_ENV": os.environ.get("FLASK_ENV", "development")},
+                ).stdout.split()
+                results += [float(output[0]), float(output[1])]
+            print(f"{length:>8} {results[0]:>10.1f} {results[1]:>8.2f} {results[2]:>10.1f} {results[3]:>9.2f}")
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--child"]:
+        child(sys.argv[2], sys.argv[3], sys.argv[4:])
+    else:
+        main([float(m) for m in sys.argv[1:]] or DEFAULT_MINUTES)
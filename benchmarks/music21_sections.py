@@ -1,9 +1,16 @@
+"""The music21 section helpers the app used to build its midi files with, kept as the reference
+implementation which midi_writer.py and timeline.py reproduce byte for byte, quirks included. The
+app itself doesn't import music21.
+"""
+import os
+import sys
 from typing import List
 from music21 import note, tempo, meter
 import numpy as np
 
-def get_tempo_dict(note_bpms: List[int]) -> dict:
-    return dict((idx, bpm) for idx, bpm in enumerate(note_bpms) if idx == 0 or bpm != note_bpms[idx -1] )
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from midi_app.timeline import get_tempo_dict  # noqa: E402
 
 def make_section(
     num_notes_before: int,
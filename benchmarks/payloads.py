@@ -0,0 +1,75 @@
+"""A corpus of realistic clicktrack payloads for the benchmarks, from a short loop to a whole set.
+
+Each payload is what the frontend sends to the make_* endpoints: sectionData, noteBpms and
+instruments.
+"""
+from typing import Dict, List
+
+
+def section(time_sig, num_measures: int, accented_beats=(0,), secondary_time_sig=None) -> dict:
+    rhythms = [{"timeSig": list(time_sig), "accentedBeats": list(accented_beats)}]
+    if secondary_time_sig:
+        rhythms.append({"timeSig": list(secondary_time_sig), "accentedBeats": [0]})
+    return {"rhythms": rhythms, "overallData": {"numMeasures": num_measures}}
+
+
+def num_beats(section_data: List[dict]) -> int:
+    return sum(s["rhythms"][0]["timeSig"][0] * s["overallData"]["numMeasures"] for s in section_data)
+
+
+def payload(section_data: List[dict], note_bpms, instruments=("woodblock_high",)) -> dict:
+    note_bpms = list(note_bpms)
+    if len(note_bpms) != num_beats(section_data):
+        raise ValueError("Need a bpm for every beat")
+    return {"sectionData": section_data, "noteBpms": note_bpms, "instruments": list(instruments)}
+
+
+def constant(section_data: List[dict], bpm: int, instruments=("woodblock_high",)) -> dict:
+    return payload(section_data, [bpm] * num_beats(section_data), instruments)
+
+
+def ramp(section_data: List[dict], start_bpm: int, end_bpm: int, instruments=("woodblock_high",)) -> dict:
+    """Changes tempo on every beat, from start_bpm to end_bpm"""
+    beats = num_beats(section_data)
+    return payload(
+        section_data, [round(start_bpm + (end_bpm - start_bpm) * i / max(beats - 1, 1)) for i in range(beats)], instruments
+    )
+
+
+def setlist() -> dict:
+    """About ten minutes of songs, each in its own meter and tempo, with two instruments"""
+    songs = [
+        ([section((4, 4), 24), section((4, 4), 32, (0, 2))], 128),
+        ([section((6, 8), 48, (0, 3))], 96),
+        ([section((7, 8), 40, (0, 2, 4)), section((4, 4), 16)], 140),
+        ([section((3, 4), 64)], 176),
+        ([section((5, 4), 30, (0, 3)), section((4, 4), 24)], 110),
+        ([section((4, 4), 16), section((4, 4), 16, (0,), (3, 4)), section((4, 4), 32)], 100),
+    ]
+    section_data, note_bpms = [], []
+    for sections, bpm in songs:
+        section_data += sections
+        note_bpms += [bpm] * num_beats(sections)
+    return payload(section_data, note_bpms, ("woodblock_high", "drum1"))
+
+
+PAYLOADS: Dict[str, dict] = {
+    "short": constant([section((4, 4), 8)], 120),
+    "long": constant([section((4, 4), 300, (0, 2))], 120),
+    "tempo_ramp": ramp([section((4, 4), 64)], 80, 180),
+    "odd_meters": constant(
+        [section((7, 8), 16, (0, 2, 4)), section((5, 4), 16, (0, 3)), section((6, 8), 16, (0, 3)), section((3, 4), 16)], 132
+    ),
+    "polyrhythm": constant([section((4, 4), 32, (0,), (3, 4))], 100),
+    "polyrhythm_two_instruments": constant(
+        [section((4, 4), 16), section((4, 4), 32, (0,), (5, 8))], 90, ("woodblock_high", "finger_snap")
+    ),
+    "two_instruments": ramp([section((4, 4), 48), section((3, 4), 48)], 100, 140, ("drum1", "percussive_clap")),
+    "setlist": setlist(),
+}
+
+
+def with_tempo_offset(data: dict, offset: int) -> dict:
+    """The payload with every bpm shifted by offset, a different clicktrack of the same shape, so
+    repeats of it aren't served by the render cache"""
+    return {**data, "noteBpms": [bpm + offset for bpm in data["noteBpms"]]}
@@ -0,0 +1,320 @@
+"""End to end benchmark of the render pipeline, writing JSON which can be compared between commits.
+
+For every payload in payloads.py, in a fresh process of its own:
+
+- times each stage of a render on its own: working out the clicks (timeline), writing the midi,
+  synthesising each instrument's notes from its soundfont (synthesis, with the sample cache
+  cleared), mixing the clicks (mix), encoding each format (encode) and uploading it to a stub
+  storage backend (upload)
+- times the whole of jobs.render_and_upload for each format, with the render cache cleared
+- records the peak RSS of the process, and how far a render raised it
+
+Then runs a load test against the Flask app through its test client, with concurrent requests
+of the corpus' payloads (each a different tempo, so none are served by the render cache), and
+records the throughput and latency percentiles.
+
+Uploads go to a stub which keeps nothing and, with --upload-mbps, takes as long as an upload at
+that bandwidth would, so nothing leaves the machine.
+
+Run from the repo root:
+
+    python benchmarks/pipeline.py [--output results.json] [--compare baseline.json]
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from payloads import PAYLOADS, with_tempo_offset  # noqa: E402
+
+DEFAULT_FORMATS = ["wav", "flac", "ogg"]
+# Slowdown reported as a regression by --compare, if it is also more than a few milliseconds, as
+# the fastest stages are too quick to time reliably
+REGRESSION_THRESHOLD = 0.1
+REGRESSION_MIN_MS = 5
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def best_of(func, repeats: int, setup=None) -> float:
+    """Fastest of repeats calls of func in milliseconds, calling setup untimed before each"""
+    times = []
+    for _ in range(repeats):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times) * 1000
+
+
+def install_stub_storage(upload_mbps: float):
+    """Swaps the storage backend for one which reads every upload and throws it away, sleeping as
+    long as the upload would take at upload_mbps, if given"""
+    from midi_app import file_management
+    from midi_app.storage import UPLOAD_CHUNK_BYTES, Storage
+
+    class StubStorage(Storage):
+        def upload(self, source, file_format):
+            if isinstance(source, str):
+                source = open(source, "rb")
+            if isinstance(source, bytes):
+                chunks = [source]
+            else:
+                chunks = iter(lambda: source.read(UPLOAD_CHUNK_BYTES), b"")
+            for chunk in chunks:
+                if upload_mbps:
+                    time.sleep(len(chunk) * 8 / (upload_mbps * 1_000_000))
+            return f"http://stub/{file_format}", "stub"
+
+        def delete(self, public_ids):
+            pass
+
+    file_management.storage = StubStorage()
+
+
+def clear_render_cache() -> None:
+    from midi_app.render_cache import render_cache
+
+    shutil.rmtree(render_cache.directory, ignore_errors=True)
+
+
+def run_case(name: str, formats, repeats: int, upload_mbps: float) -> dict:
+    """Benchmarks one payload, in its own process so that its peak RSS is its own"""
+    from midi_app.audio_processing import AUDIO_BACKEND
+    from midi_app.encoding import encoded_chunks
+    from midi_app.file_management import upload_file
+    from midi_app.instruments import all_instruments, playback_notes
+    from midi_app.jobs import render_and_upload
+    from midi_app.midi_writer import timeline_midi_bytes
+    from midi_app.sample_cache import sample_cache
+    from midi_app.sample_renderer import SAMPLE_RATE, plan_clicks, render_blocks
+    from midi_app.timeline import build_timeline
+
+    install_stub_storage(upload_mbps)
+    data = PAYLOADS[name]
+    section_data, note_bpms, instrument_vals = data["sectionData"], data["noteBpms"], data["instruments"]
+    instruments = [all_instruments[iv] for iv in instrument_vals]
+    pitches = playback_notes(instruments)
+    separate = len(instruments) > 1
+
+    # Memory first, as the stages below hold whole tracks at once, which a render never does
+    baseline_rss = peak_rss_mb()
+    end_to_end = {
+        file_format: best_of(
+            lambda: render_and_upload(file_format, section_data, note_bpms, instrument_vals), repeats, clear_render_cache
+        )
+        for file_format in formats
+    }
+    rss = {"peak_mb": round(peak_rss_mb(), 1), "render_increase_mb": round(peak_rss_mb() - baseline_rss, 1)}
+
+    stages = {}
+    stages["timeline"] = best_of(lambda: build_timeline(section_data, note_bpms, *pitches, separate), repeats)
+    timeline = build_timeline(section_data, note_bpms, *pitches, separate)
+    stages["midi"] = best_of(lambda: timeline_midi_bytes(timeline), repeats)
+    soundfonts = [sample_cache.soundfont(instrument.soundfont_file) for instrument in instruments]
+    stages["synthesis"] = best_of(lambda: plan_clicks(timeline, soundfonts, SAMPLE_RATE), repeats, sample_cache.clear)
+    _, frames = plan_clicks(timeline, soundfonts, SAMPLE_RATE)
+    stages["mix"] = best_of(lambda: list(render_blocks(timeline, soundfonts, SAMPLE_RATE)[1]), repeats)
+    blocks = list(render_blocks(timeline, soundfonts, SAMPLE_RATE)[1])
+
+    encoded = {}
+    for file_format in formats:
+        stages[f"encode_{file_format}"] = best_of(
+            lambda: encoded.__setitem__(file_format, b"".join(encoded_chunks(blocks, frames, file_format))), repeats
+        )
+        stages[f"upload_{file_format}"] = best_of(lambda: upload_file(encoded[file_format], file_format), repeats)
+
+    return {
+        "audio_backend": AUDIO_BACKEND,
+        "beats": len(note_bpms),
+        "seconds": round(frames / SAMPLE_RATE, 1),
+        "bytes": {file_format: len(data) for file_format, data in encoded.items()},
+        "stages_ms": {stage: round(ms, 2) for stage, ms in stages.items()},
+        "end_to_end_ms": {file_format: round(ms, 2) for file_format, ms in end_to_end.items()},
+        "rss": rss,
+    }
+
+
+def percentile(values, pct: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, round(pct / 100 * (len(values) - 1)))]
+
+
+def run_load(requests: int, concurrency: int, file_format: str, upload_mbps: float) -> dict:
+    """Sends requests to /api/make_<format> from concurrency threads at once"""
+    from midi_app import app
+
+    install_stub_storage(upload_mbps)
+    names = sorted(PAYLOADS)
+    latencies, statuses = [], {}
+    lock = threading.Lock()
+
+    def send(idx: int) -> None:
+        data = with_tempo_offset(PAYLOADS[names[idx % len(names)]], idx // len(names) + 1)
+        client = app.test_client()
+        start = time.perf_counter()
+        response = client.post(f"/api/make_{file_format}", json=data)
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies.append(elapsed * 1000)
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        list(pool.map(send, range(requests)))
+    wall = time.perf_counter() - start
+
+    return {
+        "format": file_format,
+        "requests": requests,
+        "concurrency": concurrency,
+        "wall_s": round(wall, 2),
+        "throughput_rps": round(requests / wall, 2),
+        "latency_ms": {
+            "mean": round(statistics.mean(latencies), 1),
+            "p50": round(percentile(latencies, 50), 1),
+            "p95": round(percentile(latencies, 95), 1),
+            "p99": round(percentile(latencies, 99), 1),
+            "max": round(max(latencies), 1),
+        },
+        "statuses": {str(status): count for status, count in sorted(statuses.items())},
+    }
+
+
+def child(args) -> None:
+    if args.child == "load":
+        result = run_load(args.load_requests, args.concurrency, args.load_format, args.upload_mbps)
+    else:
+        result = run_case(args.child, args.formats, args.repeats, args.upload_mbps)
+    print(json.dumps(result))
+
+
+def run_child(args, name: str, env: dict) -> dict:
+    command = [
+        sys.executable, __file__, "--child", name, "--formats", *args.formats, "--repeats", str(args.repeats),
+        "--upload-mbps", str(args.upload_mbps), "--load-requests", str(args.load_requests),
+        "--concurrency", str(args.concurrency), "--load-format", args.load_format,
+    ]
+    output = subprocess.run(command, capture_output=True, text=True, env=env)
+    if output.returncode:
+        raise RuntimeError(f"{name} failed:\n{output.stderr}")
+    # The app logs to stdout too, the result is the last line
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+def git_revision() -> dict:
+    def git(*command):
+        return subprocess.run(["git", *command], capture_output=True, text=True).stdout.strip()
+
+    return {"commit": git("rev-parse", "HEAD"), "dirty": bool(git("status", "--porcelain", "--untracked-files=no"))}
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> int:
+    """Prints every timing against the baseline's, returning how many got slower by more than
+    threshold"""
+    def row(name: str, timing: str, before: float, after: float) -> bool:
+        change = after / before - 1
+        slower = change > threshold and after - before > REGRESSION_MIN_MS
+        print(f"{name:>28} {timing:>16} {before:>10.1f} {after:>10.1f} {change:>+8.0%}{' slower' if slower else ''}")
+        return slower
+
+    regressions = 0
+    print(f"\nAgainst {baseline.get('commit', '?')[:10]}:")
+    print(f"{'case':>28} {'timing':>16} {'before ms':>10} {'after ms':>10} {'change':>8}")
+    for name, case in results["cases"].items():
+        before_case = baseline.get("cases", {}).get(name, {})
+        timings = {**case["stages_ms"], **{f"end_to_end_{f}": ms for f, ms in case["end_to_end_ms"].items()}}
+        before_timings = {
+            **before_case.get("stages_ms", {}),
+            **{f"end_to_end_{f}": ms for f, ms in before_case.get("end_to_end_ms", {}).items()},
+        }
+        for timing, after in timings.items():
+            if before_timings.get(timing):
+                regressions += row(name, timing, before_timings[timing], after)
+    if "load" in results and "load" in baseline:
+        regressions += row("load", "p95", baseline["load"]["latency_ms"]["p95"], results["load"]["latency_ms"]["p95"])
+    return regressions
+
+
+def main(args) -> int:
+    with tempfile.TemporaryDirectory() as directory:
+        env = {
+            **os.environ,
+            "FLASK_ENV": os.environ.get("FLASK_ENV", "development"),
+            "STORAGE_BACKEND": "memory",
+            "RENDER_CACHE_DIR": os.path.join(directory, "render_cache"),
+            "EXPIRY_DIR": os.path.join(directory, "pending_deletions"),
+            "METRICS_DIR": os.path.join(directory, "metrics"),
+        }
+        results = {
+            **git_revision(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "cpus": os.cpu_count(),
+            "repeats": args.repeats,
+            "upload_mbps": args.upload_mbps,
+            "cases": {},
+        }
+        print(f"{'case':>28} {'seconds':>8} {'timeline':>9} {'synth':>7} {'mix':>7} "
+              f"{'encode':>8} {'end to end':>11} {'peak MB':>8}")
+        for name in args.cases or PAYLOADS:
+            case = run_child(args, name, env)
+            results["cases"][name] = case
+            stages = case["stages_ms"]
+            encode = sum(ms for stage, ms in stages.items() if stage.startswith("encode_"))
+            print(
+                f"{name:>28} {case['seconds']:>8} {stages['timeline']:>9.1f} {stages['synthesis']:>7.1f} "
+                f"{stages['mix']:>7.1f} {encode:>8.1f} {sum(case['end_to_end_ms'].values()):>11.1f} "
+                f"{case['rss']['peak_mb']:>8.1f}"
+            )
+        if args.load_requests:
+            results["load"] = load = run_child(args, "load", env)
+            print(
+                f"\nload: {load['requests']} x /api/make_{load['format']}, {load['concurrency']} at a time: "
+                f"{load['throughput_rps']} requests/s, p50 {load['latency_ms']['p50']}ms, "
+                f"p95 {load['latency_ms']['p95']}ms, p99 {load['latency_ms']['p99']}ms, statuses {load['statuses']}"
+            )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            return 1 if compare(results, json.load(f), args.threshold) else 0
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--cases", nargs="*", choices=sorted(PAYLOADS), help="payloads to run, all by default")
+    parser.add_argument("--formats", nargs="*", default=DEFAULT_FORMATS, choices=DEFAULT_FORMATS)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--upload-mbps", type=float, default=0, help="simulated upload bandwidth, unlimited by default")
+    parser.add_argument("--load-requests", type=int, default=40, help="0 to skip the load test")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--load-format", default="flac", choices=DEFAULT_FORMATS)
+    parser.add_argument("--output", help="file to write the JSON results to")
+    parser.add_argument("--compare", help="earlier JSON results to compare against, exits with 1 on a regression")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD)
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child(args)
+    else:
+        sys.exit(main(args))
@@ -0,0 +1,173 @@
+"""Startup benchmark: how long the app takes to import and to start answering, in each STARTUP_MODE.
+
+For each mode, and for gunicorn with and without GUNICORN_PRELOAD when it is installed (otherwise
+python wsgi.py):
+
+- times importing midi_app in a fresh interpreter, best of --repeats, and notes which of the heavy
+  modules it loaded
+- starts the server and times how long until the health check (GET /) first answers, then how
+  long the first render after that takes, which in lazy mode includes loading the audio stack
+
+Renders go to the memory storage backend, so nothing leaves the machine. Run from the repo root:
+
+    python benchmarks/startup.py [--output results.json] [--compare baseline.json]
+"""
+import argparse
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from payloads import PAYLOADS  # noqa: E402
+from pipeline import REGRESSION_MIN_MS, REGRESSION_THRESHOLD, git_revision  # noqa: E402
+
+MODES = ["eager", "lazy"]
+HEAVY_MODULES = ["numpy", "soundfile", "cloudinary", "music21", "midi_app.views"]
+# Longest to wait for a server to answer before giving up on it
+START_TIMEOUT = 60
+
+IMPORT_SCRIPT = f"""
+import json, sys, time
+start = time.perf_counter()
+import midi_app
+ms = (time.perf_counter() - start) * 1000
+print(json.dumps({{"ms": ms, "loaded": [m for m in {HEAVY_MODULES!r} if m in sys.modules]}}))
+"""
+
+
+def import_time(env: dict, repeats: int) -> dict:
+    runs = []
+    for _ in range(repeats):
+        output = subprocess.run([sys.executable, "-c", IMPORT_SCRIPT], capture_output=True, text=True, env=env)
+        if output.returncode:
+            raise RuntimeError(f"Importing the app failed:\n{output.stderr}")
+        # The app logs to stdout too, the result is the last line
+        runs.append(json.loads(output.stdout.strip().splitlines()[-1]))
+    return {"import_ms": round(min(run["ms"] for run in runs), 1), "loaded": runs[0]["loaded"]}
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def request(url: str, payload: dict = None) -> int:
+    data = json.dumps(payload).encode() if payload is not None else None
+    headers = {"Content-Type": "application/json"} if data else {}
+    with urllib.request.urlopen(urllib.request.Request(url, data, headers), timeout=START_TIMEOUT) as response:
+        response.read()
+        return response.status
+
+
+def server_startup(command, env: dict) -> dict:
+    """Time from starting the server to its first healthy response, and to its first render"""
+    port = free_port()
+    url = f"http://127.0.0.1:{port}"
+    start = time.perf_counter()
+    server = subprocess.Popen(
+        [part.format(port=port) for part in command],
+        env={**env, "PORT": str(port)},
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        while True:
+            if server.poll() is not None:
+                raise RuntimeError(f"{' '.join(command)} exited with {server.returncode}")
+            if time.perf_counter() - start > START_TIMEOUT:
+                raise RuntimeError(f"{' '.join(command)} didn't answer within {START_TIMEOUT}s")
+            try:
+                request(url + "/")
+                break
+            except (urllib.error.URLError, ConnectionError):
+                time.sleep(0.005)
+        healthy = time.perf_counter()
+        request(url + "/api/make_wav", PAYLOADS["short"])
+        rendered = time.perf_counter()
+    finally:
+        server.terminate()
+        server.wait()
+    return {
+        "first_healthy_ms": round((healthy - start) * 1000, 1),
+        "first_render_ms": round((rendered - healthy) * 1000, 1),
+    }
+
+
+def servers():
+    """The server commands to benchmark, by name"""
+    if shutil.which("gunicorn"):
+        command = ["gunicorn", "wsgi:app", "--bind", "127.0.0.1:{port}", "--workers", "1"]
+        return {"gunicorn_preload": (command, {"GUNICORN_PRELOAD": "1"}), "gunicorn": (command, {"GUNICORN_PRELOAD": "0"})}
+    return {"wsgi": ([sys.executable, "wsgi.py"], {})}
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> int:
+    """Prints every timing against the baseline's, returning how many got slower by more than
+    threshold"""
+    regressions = 0
+    print(f"\nAgainst {baseline.get('commit', '?')[:10]}:")
+    print(f"{'case':>24} {'timing':>16} {'before ms':>10} {'after ms':>10} {'change':>8}")
+    for name, case in results["cases"].items():
+        for timing, after in case.items():
+            before = baseline.get("cases", {}).get(name, {}).get(timing)
+            if not isinstance(after, (int, float)) or not before:
+                continue
+            change = after / before - 1
+            slower = change > threshold and after - before > REGRESSION_MIN_MS
+            print(f"{name:>24} {timing:>16} {before:>10.1f} {after:>10.1f} {change:>+8.0%}{' slower' if slower else ''}")
+            regressions += slower
+    return regressions
+
+
+def main(args) -> int:
+    with tempfile.TemporaryDirectory() as directory:
+        env = {
+            **os.environ,
+            "FLASK_ENV": os.environ.get("FLASK_ENV", "development"),
+            "STORAGE_BACKEND": "memory",
+            "RENDER_CACHE_DIR": os.path.join(directory, "render_cache"),
+            "EXPIRY_DIR": os.path.join(directory, "pending_deletions"),
+            "METRICS_DIR": os.path.join(directory, "metrics"),
+        }
+        results = {**git_revision(), "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"), "cpus": os.cpu_count(), "cases": {}}
+        print(f"{'case':>24} {'import':>8} {'healthy':>8} {'render':>8}  loaded")
+        for mode in args.modes:
+            mode_env = {**env, "STARTUP_MODE": mode}
+            imported = import_time(mode_env, args.repeats)
+            for server, (command, server_env) in servers().items():
+                # The render cache is cleared so that every first render is really rendered
+                shutil.rmtree(env["RENDER_CACHE_DIR"], ignore_errors=True)
+                case = {**imported, **server_startup(command, {**mode_env, **server_env})}
+                results["cases"][f"{mode}_{server}"] = case
+                print(
+                    f"{mode + '_' + server:>24} {case['import_ms']:>8.1f} {case['first_healthy_ms']:>8.1f} "
+                    f"{case['first_render_ms']:>8.1f}  {', '.join(case['loaded']) or '-'}"
+                )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            return 1 if compare(results, json.load(f), args.threshold) else 0
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--modes", nargs="*", default=MODES, choices=MODES)
+    parser.add_argument("--repeats", type=int, default=5, help="imports to take the fastest of")
+    parser.add_argument("--output", help="file to write the JSON results to")
+    parser.add_argument("--compare", help="earlier JSON results to compare against, exits with 1 on a regression")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD)
+    sys.exit(main(parser.parse_args()))
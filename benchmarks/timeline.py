@@ -0,0 +1,95 @@
+"""Time to work out every click of a clicktrack, against the number of beats.
+
+Compares timeline.build_timeline with a per note loop like the make_section* helpers in
+music21_sections.py, which look every beat up in get_tempo_dict and step a fractional
+offset along a click at a time (without building the music21 objects, which only slow them down
+further). Also times writing the midi file from the timeline.
+
+Run from the repo root:
+
+    python benchmarks/timeline.py [beats ...]
+"""
+import os
+import sys
+import time
+from fractions import Fraction
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from midi_app.midi_writer import timeline_midi_bytes  # noqa: E402
+from midi_app.timeline import build_timeline, get_tempo_dict  # noqa: E402
+
+DEFAULT_BEATS = [1_000, 10_000, 100_000, 400_000]
+
+
+def payload(num_beats: int, tempo_every: int):
+    """A 4/4 section with a 3 against 4 polyrhythm section after it, changing tempo every
+    tempo_every beats"""
+    measures = num_beats // 8
+    section_data = [
+        {"rhythms": [{"timeSig": [4, 4], "accentedBeats": [0]}], "overallData": {"numMeasures": measures}},
+        {
+            "rhythms": [{"timeSig": [4, 4], "accentedBeats": [0]}, {"timeSig": [3, 4], "accentedBeats": []}],
+            "overallData": {"numMeasures": measures},
+        },
+    ]
+    note_bpms = [100 + (i // tempo_every) % 80 for i in range(8 * measures)]
+    return section_data, note_bpms
+
+
+def per_note_timeline(section_data, note_bpms):
+    """Seconds of every main and secondary click, a click at a time"""
+    tempo_dict = get_tempo_dict(note_bpms)
+    seconds, secondary_seconds = [], []
+    num_notes_before = 0
+    bpm = 120
+    time_so_far = 0.0
+    for section in section_data:
+        time_sigs = [r["timeSig"] for r in section["rhythms"]]
+        numerator, denominator = time_sigs[0]
+        num_beats = numerator * section["overallData"]["numMeasures"]
+        quarter_length = Fraction(4, denominator)
+        section_start = time_so_far
+        for i in range(num_beats):
+            if num_notes_before + i in tempo_dict.keys():
+                bpm = tempo_dict[num_notes_before + i]
+            seconds.append(time_so_far)
+            time_so_far += float(quarter_length) * 60 / bpm
+        if len(time_sigs) > 1:
+            secondary_numerator, secondary_denominator = time_sigs[1]
+            secondary_length = Fraction(numerator * 4, secondary_numerator * secondary_denominator)
+            section_seconds = time_so_far - section_start
+            num_secondary = secondary_numerator * section["overallData"]["numMeasures"]
+            for i in range(num_secondary):
+                offset = i * secondary_length / (num_beats * quarter_length)
+                secondary_seconds.append(section_start + float(offset) * section_seconds)
+        num_notes_before += num_beats
+    return seconds, secondary_seconds
+
+
+def best_of(func, repeats: int = 3) -> float:
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main(beat_counts):
+    print(f"{'beats':>8} {'tempo every':>12} {'per note ms':>12} {'timeline ms':>12} {'midi ms':>9}")
+    for num_beats in beat_counts:
+        for tempo_every in (1, 64):
+            section_data, note_bpms = payload(num_beats, tempo_every)
+            per_note = best_of(lambda: per_note_timeline(section_data, note_bpms))
+            vectorised = best_of(lambda: build_timeline(section_data, note_bpms))
+            timeline = build_timeline(section_data, note_bpms)
+            midi = best_of(lambda: timeline_midi_bytes(timeline))
+            print(
+                f"{len(note_bpms):>8} {tempo_every:>12} {per_note * 1000:>12.1f} {vectorised * 1000:>12.1f} "
+                f"{midi * 1000:>9.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main([int(beats) for beats in sys.argv[1:]] or DEFAULT_BEATS)
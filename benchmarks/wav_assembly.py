@@ -0,0 +1,120 @@
+"""Memory use and copying of uploading a WAV, assembled in a memory mapped file or streamed.
+
+Runs jobs.render_and_upload("wav") for each payload in a fresh process per WAV_ASSEMBLY mode
+("stream" encodes the WAV as it is uploaded and copies it into the render cache on the way,
+"mapped" renders it in place in a memory mapped file which is uploaded as it is written and which
+the render cache then takes with a rename, see mapped_wav.py), recording:
+
+- the time taken and how far the render raised the process's peak RSS
+- the peak of the Python heap while rendering, numpy's buffers included, from tracemalloc (in a
+  second render, as tracing slows it down)
+- the bytes the process passed through read and write system calls, from /proc/self/io
+- the memory it newly touched, from its minor page faults, which counts every fresh buffer audio
+  is copied into
+
+Uploads go to the stub storage from pipeline.py, which reads every file in chunks as a real
+upload would. Run from the repo root on linux:
+
+    python benchmarks/wav_assembly.py [payload ...] [--output results.json]
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from payloads import PAYLOADS  # noqa: E402
+from pipeline import clear_render_cache, git_revision, install_stub_storage, peak_rss_mb  # noqa: E402
+
+DEFAULT_PAYLOADS = ["short", "two_instruments", "tempo_ramp", "long"]
+MODES = ["stream", "mapped"]
+
+
+def io_bytes() -> int:
+    with open("/proc/self/io") as f:
+        counters = dict(line.split(": ") for line in f.read().splitlines())
+    return int(counters["rchar"]) + int(counters["wchar"])
+
+
+def page_faults() -> int:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_minflt
+
+
+def run_case(name: str) -> dict:
+    from midi_app import app  # noqa: F401
+    from midi_app.jobs import render_and_upload
+
+    install_stub_storage(0)
+    payload = PAYLOADS[name]
+    args = ("wav", payload["sectionData"], payload["noteBpms"], payload.get("instruments"))
+
+    clear_render_cache()
+    baseline_rss, baseline_io, baseline_faults = peak_rss_mb(), io_bytes(), page_faults()
+    start = time.perf_counter()
+    render_and_upload(*args)
+    elapsed = time.perf_counter() - start
+    result = {
+        "ms": round(elapsed * 1000, 1),
+        "rss_increase_mb": round(peak_rss_mb() - baseline_rss, 1),
+        "syscall_mb": round((io_bytes() - baseline_io) / 1e6, 1),
+        "touched_mb": round((page_faults() - baseline_faults) * resource.getpagesize() / 1e6, 1),
+    }
+
+    clear_render_cache()
+    tracemalloc.start()
+    render_and_upload(*args)
+    result["heap_peak_mb"] = round(tracemalloc.get_traced_memory()[1] / 1e6, 1)
+    tracemalloc.stop()
+    return result
+
+
+def main(args) -> int:
+    results = {**git_revision(), "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"), "payloads": {}}
+    print(f"{'payload':>16} {'mode':>7} {'ms':>8} {'RSS MB':>7} {'heap MB':>8} {'syscall MB':>11} {'touched MB':>11}")
+    for name in args.payloads:
+        for mode in MODES:
+            with tempfile.TemporaryDirectory() as directory:
+                env = {
+                    **os.environ,
+                    "FLASK_ENV": os.environ.get("FLASK_ENV", "development"),
+                    "STORAGE_BACKEND": "memory",
+                    "WAV_ASSEMBLY": mode,
+                    "SCRATCH_DIR": directory,
+                    "RENDER_CACHE_DIR": os.path.join(directory, "render_cache"),
+                    "EXPIRY_DIR": os.path.join(directory, "pending_deletions"),
+                    "METRICS_DIR": os.path.join(directory, "metrics"),
+                }
+                output = subprocess.run([sys.executable, __file__, "--child", name], capture_output=True, text=True, env=env)
+            if output.returncode:
+                raise RuntimeError(f"{name} ({mode}) failed:\n{output.stderr}")
+            # The app logs to stdout too, the result is the last JSON line
+            lines = [line for line in output.stdout.splitlines() if line.startswith("{")]
+            result = results["payloads"].setdefault(name, {})[mode] = json.loads(lines[-1])
+            print(
+                f"{name:>16} {mode:>7} {result['ms']:>8.1f} {result['rss_increase_mb']:>7.1f} "
+                f"{result['heap_peak_mb']:>8.1f} {result['syscall_mb']:>11.1f} {result['touched_mb']:>11.1f}"
+            )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("payloads", nargs="*", default=DEFAULT_PAYLOADS, help=f"any of {', '.join(PAYLOADS)}")
+    parser.add_argument("--output", help="file to write the JSON results to")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        print(json.dumps(run_case(args.child)))
+    else:
+        sys.exit(main(args))
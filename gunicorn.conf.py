@@ -0,0 +1,24 @@
+# Picked up automatically by gunicorn when started from the repo root.
+# Renders use their own scratch directories, so requests can be served concurrently.
+import multiprocessing
+import os
+
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+# For the app, which shares the batch render processes on the host between the workers
+os.environ["WEB_CONCURRENCY"] = str(workers)
+threads = int(os.environ.get("GUNICORN_THREADS", 4))
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 120))
+
+# Import the app once in the master, rather than in every worker, so forked workers share its
+# memory copy-on-write. Turn off with GUNICORN_PRELOAD=0, e.g. to reload code with a HUP
+preload_app = os.environ.get("GUNICORN_PRELOAD", "1") not in ("0", "false")
+
+
+def when_ready(server):
+    """Loads the audio stack in the master before it forks the workers, even with a lazy
+    STARTUP_MODE, so that they share it rather than each loading their own on their first render.
+    For the quickest start, use a lazy STARTUP_MODE with GUNICORN_PRELOAD=0"""
+    if preload_app:
+        from midi_app.startup import preload
+
+        preload()
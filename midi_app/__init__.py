@@ -11,4 +11,13 @@ CORS(app)
 if os.environ["FLASK_ENV"] == "production":
     CORS(app, origins=["https://clicktrack-redux.vercel.app"])
 
+from midi_app.expiry import expiry_scheduler
+from midi_app.startup import STARTUP_MODE, preload
+
+# Load everything requests render with up front, unless starting quickly matters more
+if STARTUP_MODE == "eager":
+    preload()
+# Pick up the deletions of anything uploaded before the last restart, if no other worker has
+expiry_scheduler.resume()
+
 from midi_app import routes
@@ -1,134 +1,116 @@
-import subprocess
+import io
+import os
 import time
 
+from typing import BinaryIO, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
 import soundfile as sf
-from music21 import stream
-
-from .instruments import all_instruments
-from .audio_processing_helpers import *
-
-def make_midi_file(section_data, note_bpms, instruments=None) -> str | List[str]:
-    """Generates a midi file from the given metadata"""
-
-    # Check if the clicktrack contains any polyrhythms
-    has_polyrhythms = any(len(section["rhythms"]) > 1 for section in section_data)
-
-    # If an instrument is specified, use the given note otherwise default to middle C
-    note_pitch_main = "C4"
-    note_pitch_secondary = "C4"
-    if instruments:
-        note_pitch_main: str = instruments[0].playback_note
-        if len(instruments) > 1:
-            note_pitch_secondary: str = instruments[1].playback_note
-        else:
-            note_pitch_secondary: str = instruments[0].playback_note
-
-    
-
-    # From note bpms, generate a tempo_dict of format {note_idx: bpm}, so that we only put tempo markers where
-    # the tempo actually changes
-    tempo_dict: dict = get_tempo_dict(note_bpms)
-    notes_so_far = 0
-
-    # The simplest case, where we dont need to worry about a second part
-    if (not instruments or len(instruments) == 1) and not has_polyrhythms:
-        clicktrack_stream = stream.Stream()
-        for section in section_data:
-            notes_so_far, section_notes = make_section(
-                notes_so_far, 
-                section["rhythms"][0]["timeSig"], 
-                section["overallData"]["numMeasures"], 
-                section["rhythms"][0]["accentedBeats"],
-                note_pitch_main, 
-                tempo_dict
-            )
-            clicktrack_stream.append(section_notes)
-        
-        clicktrack_stream.write("midi", "clicktrack.midi")
-        return "clicktrack.midi"
-
-    # In this case a separate stream made for each instrument
-    elif instruments and len(instruments) > 1 and not has_polyrhythms:
-        main_stream = stream.Stream()
-        secondary_stream = stream.Stream()
-        for section in section_data:
-            notes_so_far, section_notes = make_section_separated(
-                notes_so_far, 
-                section["rhythms"][0]["timeSig"], 
-                section["overallData"]["numMeasures"], 
-                section["rhythms"][0]["accentedBeats"],
-                note_pitch_main,
-                note_pitch_secondary, 
-                tempo_dict
-            )
-            main_stream.append(section_notes["main"])
-            secondary_stream.append(section_notes["secondary"])
-
-        main_stream.write("midi", "main.midi")
-        secondary_stream.write("midi", "secondary.midi")
-        return ["main.midi", "secondary.midi"]
-    
-    # In this case a separate part is made for each instrument but then they are combined
-    elif (not instruments or len(instruments) == 1) and has_polyrhythms:
-        clicktrack_stream = stream.Stream()
-        main_rhythm_part = stream.Part()
-        secondary_rhythm_part = stream.Part()
-
-        for section in section_data:
-            time_sigs = [r["timeSig"] for r in section["rhythms"]]
-            notes_so_far, section_notes = make_section_polyrhythm_one_instrument(
-                notes_so_far,
-                time_sigs,
-                section["overallData"]["numMeasures"],
-                section["rhythms"][0]["accentedBeats"],
-                note_pitch_main,
-                tempo_dict
-            )
-            main_rhythm_part.append(section_notes["main"])
-            secondary_rhythm_part.append(section_notes["secondary"])
-
-        #Combine the two parts
-        clicktrack_stream.insert(0, main_rhythm_part)
-        clicktrack_stream.insert(0, secondary_rhythm_part)
-        clicktrack_stream.write("midi", "clicktrack.midi")
-        return "clicktrack.midi"
-
-    # In this case a separate stream is made for each instrument
-    elif instruments and len(instruments) > 1 and has_polyrhythms:
-        main_stream = stream.Stream()
-        secondary_stream = stream.Stream()
-        for section in section_data:
-            time_sigs = [r["timeSig"] for r in section["rhythms"]]
-            notes_so_far, section_notes = make_section_polyrhythm_two_instruments(
-                notes_so_far,
-                time_sigs,
-                section["overallData"]["numMeasures"],
-                section["rhythms"][0]["accentedBeats"],
-                note_pitch_main,
-                note_pitch_secondary,
-                tempo_dict
-            )
-            main_stream.append(section_notes["main"])
-            secondary_stream.append(section_notes["secondary"])
 
-        main_stream.write("midi", "main.midi")
-        secondary_stream.write("midi", "secondary.midi")
-        return ["main.midi", "secondary.midi"]
+from .encoding import DEFAULT_OPTIONS, AudioOptions, encode_streams, encoded_chunks, encoded_size, render_ahead
+from .file_management import render_workspace
+from .fluidsynth import synthesise_file
+from .instruments import all_instruments, playback_notes
+from .mapped_wav import MappedWav, MappedWavStream
+from .metrics import span
+from .midi_writer import make_midi_bytes
+from .sample_cache import sample_cache
+from .sample_renderer import SAMPLE_RATE, render_blocks, render_timeline
+from .section_renderer import can_render_sections, render_sections
+from .synth_pool import render_timeline_with_synths
+from .timeline import build_timeline
+
+# "samples" (mix the soundfont samples in process), "fluidsynth" (run the fluidsynth CLI) or
+# "synth" (play the clicks on pooled fluidsynth instances in process, see synth_pool.py)
+AUDIO_BACKEND = os.environ.get("AUDIO_BACKEND", "samples")
+# Frames mixed at a time when combining each instrument's part
+MIX_BLOCK_FRAMES = 64 * 1024
+# How WAV files which are uploaded are put together: "mapped" renders them into a memory mapped
+# file (see mapped_wav.py), "stream" encodes them as they are uploaded
+WAV_ASSEMBLY = os.environ.get("WAV_ASSEMBLY", "mapped")
+if WAV_ASSEMBLY not in ("mapped", "stream"):
+    raise ValueError(f"WAV_ASSEMBLY must be mapped or stream, not {WAV_ASSEMBLY}")
+
+def make_midi_file(section_data, note_bpms, instruments=None, directory: str = ".") -> str | List[str]:
+    """Generates a midi file from the given metadata, saved in the given directory"""
+
+    note_pitch_main, note_pitch_secondary = playback_notes(instruments)
+
+    # With more than one instrument a separate file is made for each of them, as each one is
+    # synthesised with its own soundfont
+    separate_instruments = bool(instruments) and len(instruments) > 1
+    midi_files = make_midi_bytes(
+        section_data, note_bpms, note_pitch_main, note_pitch_secondary, separate_instruments
+    )
+
+    if not separate_instruments:
+        filename = os.path.join(directory, "clicktrack.midi")
+        with open(filename, "wb") as f:
+            f.write(midi_files[0])
+        return filename
+
+    filenames = [os.path.join(directory, name) for name in ("main.midi", "secondary.midi")]
+    for filename, midi_bytes in zip(filenames, midi_files):
+        with open(filename, "wb") as f:
+            f.write(midi_bytes)
+    return filenames
+
+
+def make_midi_stream(section_data, note_bpms) -> BinaryIO:
+    """The midi file make_midi_file would save, without writing it to disk"""
+    note_pitch_main, note_pitch_secondary = playback_notes()
+    with span("midi"):
+        midi_files = make_midi_bytes(section_data, note_bpms, note_pitch_main, note_pitch_secondary, False)
+    return io.BytesIO(midi_files[0])
+
+
+def mix_parts(part_filenames: List[str], output_filename: str, blocksize: int = MIX_BLOCK_FRAMES) -> None:
+    """Sums the instruments' parts into the output file a block at a time, so memory use doesn't
+    grow with the length of the track.
+
+    There may be a slightly different amount of silence at the end of each part, so the output is
+    as long as the shortest one.
+    """
+    infos = [sf.info(filename) for filename in part_filenames]
+    frames = min(info.frames for info in infos)
+    channels = infos[0].channels
+    part_blocks = [
+        sf.blocks(
+            filename,
+            frames=frames,
+            dtype="float32",
+            always_2d=True,
+            out=np.empty((blocksize, channels), dtype=np.float32),
+        )
+        for filename in part_filenames
+    ]
+    with sf.SoundFile(output_filename, "w", infos[0].samplerate, channels) as output:
+        for blocks in zip(*part_blocks):
+            # Sum into the first part's buffer, which is refilled for the next block
+            mixed = blocks[0]
+            for block in blocks[1:]:
+                mixed += block
+            output.write(mixed)
+
 
-    else:
-        return "error"
-    
 def make_file_with_fluidsynth(
     section_data: List[dict],
     note_bpms: List[int],
     file_format: str,
     instrument_vals: List[str] = ["woodblock_high"],
+    directory: str = ".",
+    sample_rate: int = SAMPLE_RATE,
 ) -> str:
     """Takes metadata and creates a midi file with it, which is then used along with a soundfont
     to synthesise a wav file
 
     instrument_val is used as a key to look up the correct instrument object in the all_instruments dict
 
+    Where possible the clicktrack is synthesised a section at a time, reusing sections synthesised
+    before, see section_renderer.py.
+
+    All intermediate files and the output are saved in the given directory.
+
     Returns the name of the saved wav file.
     """
 
@@ -137,55 +119,287 @@ def make_file_with_fluidsynth(
     audio_time = 0
 
     instruments = [all_instruments[iv] for iv in instrument_vals]
+    output_filename = os.path.join(directory, f"output.{file_format}")
+
+    if can_render_sections(section_data, instruments):
+        # Each section's midi is made as it is synthesised, so that is all counted as audio time
+        audio_data = render_sections(section_data, note_bpms, instrument_vals, directory, sample_rate)
+        with span("write"):
+            sf.write(output_filename, audio_data, sample_rate)
+        return output_filename, 0, time.time() - start_time
+
     # First make a midi which can then be synthesised into a wav
     # This time the instrument is important as it is used in the wav file synthesis
 
     # Check if a second instrument has been specified
     if len(instruments) > 1:
         # Get a different midi file for each instrument, then combine them after
-        midi_filenames = make_midi_file(section_data, note_bpms, instruments)
+        with span("midi"):
+            midi_filenames = make_midi_file(section_data, note_bpms, instruments, directory)
+        midi_time = time.time()
+        part_filenames = []
         for idx, mfn in enumerate(midi_filenames):
             soundfont_filename = instruments[idx].soundfont_file
-            subprocess.run(
-            [
-                "fluidsynth",
-                "-ni",
-                "-g",
-                "1",
-                soundfont_filename,
-                mfn,
-                "-F",
-                f"part{idx + 1}.{file_format}",
-            ]
-        )
-        audio_data1, sample_rate = sf.read(f"part1.{file_format}")
-        audio_data2, sample_rate = sf.read(f"part2.{file_format}")
-
-        # May be a slightly different amount of silence at the end of each track, so need to trim down
-        # the longer one so that the np arrays can be added
-        shorter_length = min(len(audio_data1), len(audio_data2))
-        audio_data = audio_data1[:shorter_length] + audio_data2[:shorter_length]
-
-        sf.write(f"output.{file_format}", audio_data, sample_rate)
+            part_filenames.append(os.path.join(directory, f"part{idx + 1}.{file_format}"))
+            synthesise_file(soundfont_filename, mfn, part_filenames[-1], sample_rate)
+        with span("mix"):
+            mix_parts(part_filenames, output_filename)
+        audio_time = time.time()
 
     else:
-        midi_filename = make_midi_file(section_data, note_bpms, instruments)
+        with span("midi"):
+            midi_filename = make_midi_file(section_data, note_bpms, instruments, directory)
         midi_time = time.time()
-        subprocess.run(
-            [
-                "fluidsynth",
-                "-ni",
-                "-g",
-                "1",
-                instruments[0].soundfont_file,
-                midi_filename,
-                "-F",
-                f"output.{file_format}",
-            ]
-        )
+        synthesise_file(instruments[0].soundfont_file, midi_filename, output_filename, sample_rate)
         audio_time = time.time()
 
     midi_time_taken = midi_time - start_time
     audio_time_taken = audio_time - midi_time
 
-    return f"output.{file_format}", midi_time_taken, audio_time_taken
\ No newline at end of file
+    return output_filename, midi_time_taken, audio_time_taken
+
+
+def render_with_samples(
+    section_data: List[dict], note_bpms: List[int], instrument_vals: List[str], backend: str = "samples"
+):
+    """Returns the rendered float32 audio along with the time taken to work out the clicks and to
+    render the audio. The synth backend plays the clicks on pooled synthesisers rather than mixing
+    the samples"""
+    start_time = time.time()
+
+    instruments = [all_instruments[iv] for iv in instrument_vals]
+    note_pitch_main, note_pitch_secondary = playback_notes(instruments)
+    with span("timeline"):
+        timeline = build_timeline(
+            section_data, note_bpms, note_pitch_main, note_pitch_secondary, len(instruments) > 1
+        )
+    midi_time = time.time()
+
+    if backend == "synth":
+        audio_data = render_timeline_with_synths(timeline, [i.soundfont_file for i in instruments], SAMPLE_RATE)
+    else:
+        soundfonts = [sample_cache.soundfont(instrument.soundfont_file) for instrument in instruments]
+        audio_data = render_timeline(timeline, soundfonts, SAMPLE_RATE)
+    audio_time = time.time()
+
+    return audio_data, midi_time - start_time, audio_time - midi_time
+
+
+def make_file_with_samples(
+    section_data: List[dict],
+    note_bpms: List[int],
+    file_format: str,
+    instrument_vals: List[str] = ["woodblock_high"],
+    directory: str = ".",
+    backend: str = "samples",
+) -> str:
+    """Takes metadata and renders the clicktrack by mixing each instrument's sample in process,
+    see sample_renderer.py, or with the synth backend on pooled synthesisers. The output is saved
+    in the given directory.
+
+    Returns the name of the saved audio file along with the time taken to work out the clicks and
+    to render the audio.
+    """
+
+    audio_data, midi_time_taken, render_time_taken = render_with_samples(
+        section_data, note_bpms, instrument_vals, backend
+    )
+    write_start_time = time.time()
+    output_filename = os.path.join(directory, f"output.{file_format}")
+    sf.write(output_filename, audio_data, SAMPLE_RATE)
+
+    return output_filename, midi_time_taken, render_time_taken + time.time() - write_start_time
+
+
+def make_audio_file(
+    section_data: List[dict],
+    note_bpms: List[int],
+    file_format: str,
+    instrument_vals: List[str] = ["woodblock_high"],
+    directory: str = ".",
+    backend: str = None,
+) -> str:
+    """Renders the clicktrack into the given directory with the given backend, defaulting to
+    AUDIO_BACKEND"""
+    backend = backend or AUDIO_BACKEND
+    if file_format == "wav" and WAV_ASSEMBLY == "mapped":
+        return make_mapped_wav(section_data, note_bpms, instrument_vals, directory, backend)
+    if backend == "fluidsynth":
+        return make_file_with_fluidsynth(section_data, note_bpms, file_format, instrument_vals, directory)
+    return make_file_with_samples(section_data, note_bpms, file_format, instrument_vals, directory, backend)
+
+
+def render_audio_blocks(
+    section_data: List[dict],
+    note_bpms: List[int],
+    instrument_vals: List[str] = ["woodblock_high"],
+    directory: str = ".",
+    backend: str = None,
+    sample_rate: int = SAMPLE_RATE,
+) -> Tuple[int, Iterator[np.ndarray], float]:
+    """Returns the length of the clicktrack's audio, an iterator of its float32 blocks and the
+    time taken to work out the clicks.
+
+    With the samples backend each block is mixed as it is asked for. fluidsynth synthesises the
+    whole clicktrack in memory a section at a time where it can, otherwise into the given
+    directory first, which it is then read back from, so the blocks must be used up before the
+    directory is deleted. The synth backend synthesises the whole clicktrack in memory.
+    """
+    start_time = time.time()
+    backend = backend or AUDIO_BACKEND
+    if backend == "fluidsynth" and can_render_sections(section_data, [all_instruments[iv] for iv in instrument_vals]):
+        audio = render_sections(section_data, note_bpms, instrument_vals, directory, sample_rate)
+        return len(audio), array_blocks(audio), 0
+    if backend == "fluidsynth":
+        filename, midi_time_taken, _ = make_file_with_fluidsynth(
+            section_data, note_bpms, "wav", instrument_vals, directory, sample_rate
+        )
+        blocks = sf.blocks(filename, blocksize=MIX_BLOCK_FRAMES, dtype="float32", always_2d=True)
+        return sf.info(filename).frames, blocks, midi_time_taken
+
+    instruments = [all_instruments[iv] for iv in instrument_vals]
+    note_pitch_main, note_pitch_secondary = playback_notes(instruments)
+    with span("timeline"):
+        timeline = build_timeline(
+            section_data, note_bpms, note_pitch_main, note_pitch_secondary, len(instruments) > 1
+        )
+    midi_time_taken = time.time() - start_time
+    if backend == "synth":
+        audio = render_timeline_with_synths(timeline, [i.soundfont_file for i in instruments], sample_rate)
+        return len(audio), array_blocks(audio), midi_time_taken
+    soundfonts = [sample_cache.soundfont(instrument.soundfont_file) for instrument in instruments]
+    frames, blocks = render_blocks(timeline, soundfonts, sample_rate)
+    return frames, blocks, midi_time_taken
+
+
+def array_blocks(audio: np.ndarray) -> Iterator[np.ndarray]:
+    """Views of the audio a block at a time"""
+    return (audio[start:start + MIX_BLOCK_FRAMES] for start in range(0, len(audio), MIX_BLOCK_FRAMES))
+
+
+def make_mapped_wav(
+    section_data: List[dict],
+    note_bpms: List[int],
+    instrument_vals: List[str] = ["woodblock_high"],
+    directory: str = ".",
+    backend: str = None,
+    options: AudioOptions = DEFAULT_OPTIONS,
+) -> Tuple[str, float, float]:
+    """Renders the clicktrack into a WAV file in the given directory, which is sized from the
+    length of the audio and memory mapped so each block is written straight into its place, see
+    mapped_wav.py. Returns the filename along with the time taken to work out the clicks and to
+    render the audio"""
+    start_time = time.time()
+    frames, blocks, midi_time_taken = render_audio_blocks(
+        section_data, note_bpms, instrument_vals, directory, backend, options.sample_rate
+    )
+    filename = os.path.join(directory, "mapped.wav")
+    with MappedWav(filename, frames, options.channels, options.sample_rate, options.sample_width) as wav:
+        wav.write_blocks(blocks)
+    return filename, midi_time_taken, time.time() - start_time - midi_time_taken
+
+
+def make_mapped_wav_stream(
+    section_data: List[dict],
+    note_bpms: List[int],
+    instrument_vals: List[str] = ["woodblock_high"],
+    directory: str = ".",
+    backend: str = None,
+    options: AudioOptions = DEFAULT_OPTIONS,
+) -> Tuple[MappedWavStream, float]:
+    """Like make_mapped_wav, but the audio is rendered into the file on a background thread, and a
+    stream of the file is returned which can be uploaded while it is written, along with the time
+    taken to work out the clicks. Once the stream is complete() the file is at its filename"""
+    frames, blocks, midi_time_taken = render_audio_blocks(
+        section_data, note_bpms, instrument_vals, directory, backend, options.sample_rate
+    )
+    wav = MappedWav(os.path.join(directory, "mapped.wav"), frames, options.channels, options.sample_rate, options.sample_width)
+    return wav.stream(blocks), midi_time_taken
+
+
+def make_audio_streams(
+    section_data: List[dict],
+    note_bpms: List[int],
+    file_formats: List[str],
+    instrument_vals: List[str] = ["woodblock_high"],
+    directory: str = ".",
+    backend: str = None,
+    options: AudioOptions = DEFAULT_OPTIONS,
+) -> Tuple[Dict[str, BinaryIO], float, float]:
+    """Renders the clicktrack once and returns a stream of it encoded in each format, see
+    encoding.encode_streams, along with the time taken to work out the clicks and to render the
+    audio. The audio is rendered and encoded as the streams are read, which has to be done
+    concurrently when there is more than one of them, so with the samples backend the time to
+    render it is only how long it took to get started.
+
+    The streams may read from the given directory, so must be used up before it is deleted.
+    """
+    start_time = time.time()
+    frames, blocks, midi_time_taken = render_audio_blocks(
+        section_data, note_bpms, instrument_vals, directory, backend, options.sample_rate
+    )
+    streams = encode_streams(blocks, frames, file_formats, options)
+    return streams, midi_time_taken, time.time() - start_time - midi_time_taken
+
+
+def make_audio_stream(
+    section_data: List[dict],
+    note_bpms: List[int],
+    file_format: str,
+    instrument_vals: List[str] = ["woodblock_high"],
+    directory: str = ".",
+    backend: str = None,
+    options: AudioOptions = DEFAULT_OPTIONS,
+):
+    """Like make_audio_file, but returns a stream of the audio file rather than its name. The file
+    is encoded as the stream is read and never written to disk.
+
+    The stream may read from the given directory, so must be used up before it is deleted.
+    """
+    streams, midi_time_taken, audio_time_taken = make_audio_streams(
+        section_data, note_bpms, [file_format], instrument_vals, directory, backend, options
+    )
+    return streams[file_format], midi_time_taken, audio_time_taken
+
+
+def _workspace_chunks(chunks_in_workspace) -> Iterator[bytes]:
+    """Runs chunks_in_workspace(workspace) with a scratch directory which is kept until all of its
+    chunks have been iterated over"""
+    with render_workspace() as workspace:
+        yield from chunks_in_workspace(workspace)
+
+
+def stream_audio(
+    section_data: List[dict],
+    note_bpms: List[int],
+    file_format: str,
+    instrument_vals: List[str] = ["woodblock_high"],
+    backend: str = None,
+    options: AudioOptions = DEFAULT_OPTIONS,
+) -> Tuple[Iterator[bytes], Optional[int]]:
+    """Returns the chunks of the audio file, which are rendered and encoded section by section as
+    they are iterated over, along with the file size if it is known in advance. Each block is
+    encoded while the next one is rendered.
+
+    Only the samples backend can render incrementally, with fluidsynth and synth the file is
+    rendered in full when the first chunk is asked for.
+    """
+    backend = backend or AUDIO_BACKEND
+    if backend == "synth":
+        def synth_chunks() -> Iterator[bytes]:
+            frames, blocks, _ = render_audio_blocks(section_data, note_bpms, instrument_vals, ".", backend, options.sample_rate)
+            yield from encoded_chunks(render_ahead(blocks), frames, file_format, options)
+
+        return synth_chunks(), None
+
+    if backend == "fluidsynth":
+        def chunks(workspace: str) -> Iterator[bytes]:
+            frames, blocks, _ = render_audio_blocks(
+                section_data, note_bpms, instrument_vals, workspace, backend, options.sample_rate
+            )
+            yield from encoded_chunks(render_ahead(blocks), frames, file_format, options)
+
+        return _workspace_chunks(chunks), None
+
+    frames, blocks, _ = render_audio_blocks(section_data, note_bpms, instrument_vals, ".", backend, options.sample_rate)
+    return encoded_chunks(render_ahead(blocks), frames, file_format, options), encoded_size(frames, file_format, options)
@@ -0,0 +1,302 @@
+"""Renders many clicktracks in one request, e.g. every song in a setlist.
+
+A batch's clicktracks are rendered on a process pool of their own, sized to the cores (shared
+between the gunicorn workers on the host), so a batch neither queues behind nor holds up the
+single renders in jobs.job_queue. Identical clicktracks
+are only rendered once, and each worker uploads its own files, so uploads run in parallel too.
+
+A batch can also ask for a bundle of its files, either a zip of them or, for audio, a single file
+of them played one after another. The bundle is made once every clicktrack has finished, from the
+files in the render cache, and uploaded like any other render. A batch's audio options (see
+encoding.AudioOptions) apply to every clicktrack in it and to its bundle.
+
+Like jobs, a batch is run by the worker which accepted it, which records its progress in the job
+store so that it can be polled through any worker.
+"""
+import hashlib
+import os
+import shutil
+import threading
+import time
+import uuid
+import zipfile
+from typing import Dict, List, Optional, Union
+
+import soundfile as sf
+
+from .audio_processing import MIX_BLOCK_FRAMES, make_audio_stream, make_midi_stream
+from .cost import estimate_cost
+from .encoding import DEFAULT_OPTIONS, AudioOptions
+from .file_management import render_workspace
+from .instruments import all_instruments
+from .job_store import FINISHED, job_store
+from .jobs import RENDER_JOB_RETENTION, Job, JobQueue, QueueFullError, StoredJob, render_key_for
+from .render_cache import cached_upload, render_cache
+
+# gunicorn web workers on the host, each of which has its own batch pool (see gunicorn.conf.py)
+WEB_WORKERS = max(int(os.environ.get("WEB_CONCURRENCY", 1)), 1)
+# Batch render processes on the host, which each web worker has its share of
+RENDER_BATCH_WORKERS = int(os.environ.get("RENDER_BATCH_WORKERS", os.cpu_count() or 2))
+RENDER_BATCH_QUEUE_LIMIT = int(os.environ.get("RENDER_BATCH_QUEUE_LIMIT", 64))
+MAX_BATCH_ITEMS = int(os.environ.get("MAX_BATCH_ITEMS", 50))
+
+BATCH_FORMATS = ("midi", "wav", "flac")
+BUNDLE_TYPES = ("zip", "concat")
+
+
+class BatchError(ValueError):
+    """The batch as a whole is invalid"""
+
+
+def _item_error(file_format: str, item) -> Optional[str]:
+    """Why a clicktrack in a batch can't be rendered, if it can't"""
+    if not isinstance(item, dict) or "sectionData" not in item or "noteBpms" not in item:
+        return "Each item needs sectionData and noteBpms"
+    unknown = [iv for iv in item.get("instruments") or [] if iv not in all_instruments]
+    if unknown:
+        return f"Unknown instruments {', '.join(map(str, unknown))}"
+    try:
+        estimate_cost([file_format], item["sectionData"], item["noteBpms"], item.get("instruments")).check()
+    except ValueError as e:
+        return str(e)
+    return None
+
+
+def _render_args(file_format: str, item: dict, options: AudioOptions) -> tuple:
+    if file_format == "midi":
+        return file_format, item["sectionData"], item["noteBpms"], None
+    return file_format, item["sectionData"], item["noteBpms"], item.get("instruments") or ["woodblock_high"], options
+
+
+def bundle_key(bundle: str, renders: List[tuple]) -> str:
+    return hashlib.sha256(" ".join([bundle, *(render_key_for(*render) for render in renders)]).encode()).hexdigest()
+
+
+def _rendered_file(render: tuple, directory: str) -> str:
+    """The path of a render, from the render cache if it is still there, otherwise rendered again
+    into the directory"""
+    file_format, section_data, note_bpms, instrument_vals, *options = render
+    path = render_cache.get_file(render_key_for(*render), file_format)
+    if path is not None:
+        return path
+    os.makedirs(directory)
+    if file_format == "midi":
+        path = os.path.join(directory, "clicktrack.midi")
+        with open(path, "wb") as f:
+            f.write(make_midi_stream(section_data, note_bpms).read())
+        return path
+    stream, _, _ = make_audio_stream(section_data, note_bpms, file_format, instrument_vals, directory, options=options[0])
+    path = os.path.join(directory, f"clicktrack.{file_format}")
+    with stream, open(path, "wb") as f:
+        shutil.copyfileobj(stream, f)
+    return path
+
+
+def render_bundle(bundle: str, renders: List[tuple], names: List[str]) -> str:
+    """The body of a bundle job: puts the rendered files together and uploads them, returning the
+    url, or "error" if the upload failed"""
+    file_format = renders[0][0]
+    options = renders[0][4] if file_format != "midi" else DEFAULT_OPTIONS
+    bundle_format = "zip" if bundle == "zip" else file_format
+
+    with render_workspace() as workspace:
+        def render() -> str:
+            paths = [_rendered_file(render, os.path.join(workspace, str(idx))) for idx, render in enumerate(renders)]
+            output_filename = os.path.join(workspace, f"bundle.{bundle_format}")
+            if bundle == "zip":
+                # FLAC is already compressed, but midi and the silence between clicks in a wav aren't
+                compression = zipfile.ZIP_STORED if file_format == "flac" else zipfile.ZIP_DEFLATED
+                with zipfile.ZipFile(output_filename, "w", compression) as zf:
+                    for path, name in zip(paths, names):
+                        zf.write(path, f"{name}.{file_format}")
+            else:
+                with sf.SoundFile(
+                    output_filename, "w", options.sample_rate, options.channels, options.subtype(file_format),
+                    format=file_format.upper(),
+                ) as output:
+                    for path in paths:
+                        for block in sf.blocks(path, blocksize=MIX_BLOCK_FRAMES, dtype="float32", always_2d=True):
+                            output.write(block)
+            return output_filename
+
+        return cached_upload(bundle_key(bundle, renders), bundle_format, render)
+
+
+class Batch:
+    """The clicktracks of a batch, each either a job or the reason it couldn't be rendered, and
+    the job making their bundle once they have all finished"""
+
+    def __init__(
+        self, file_format: str, items: List[dict], bundle: Optional[str], options: AudioOptions = DEFAULT_OPTIONS
+    ):
+        self.id = uuid.uuid4().hex
+        self.file_format = file_format
+        self.options = options
+        self.items = items
+        self.bundle = bundle
+        self.errors: List[Optional[str]] = [_item_error(file_format, item) for item in items]
+        self.jobs: List[Optional[Job]] = [None] * len(items)
+        self.bundle_job: Optional[Job] = None
+        self.bundle_error: Optional[str] = None
+        self.submitted_at = time.time()
+        self._pending_jobs = set()
+        self._finished = threading.Event()
+
+    def renders(self) -> Dict[int, tuple]:
+        return {idx: _render_args(self.file_format, item, self.options) for idx, item in enumerate(self.items) if not self.errors[idx]}
+
+    @property
+    def done(self) -> bool:
+        return self._finished.is_set()
+
+    def wait(self, timeout: float) -> bool:
+        return self._finished.wait(timeout)
+
+    def finish(self) -> None:
+        self._finished.set()
+
+    def to_dict(self) -> dict:
+        items = [
+            {"status": "failed", "error": error} if error else self.jobs[idx].to_dict()
+            for idx, error in enumerate(self.errors)
+        ]
+        result = {"batchId": self.id, "status": "done" if self.done else "running", "items": items}
+        if self.bundle:
+            if self.bundle_job is not None:
+                result["bundle"] = self.bundle_job.to_dict()
+            elif self.bundle_error:
+                result["bundle"] = {"status": "failed", "error": self.bundle_error}
+            else:
+                result["bundle"] = {"status": "queued"}
+        return result
+
+
+class StoredBatch:
+    """A batch owned by another worker, as last recorded in the job store. Items which were
+    unfinished when it was recorded are brought up to date from their jobs' records"""
+
+    def __init__(self, record: dict):
+        self.id = record["batchId"]
+        self.record = record
+
+    @property
+    def done(self) -> bool:
+        return self.record["status"] in FINISHED
+
+    def wait(self, timeout: float) -> bool:
+        record = job_store.wait(self.id, timeout, lambda record: record["status"] in FINISHED)
+        if record is not None:
+            self.record = record
+        return self.done
+
+    def to_dict(self) -> dict:
+        result = {k: v for k, v in self.record.items() if k not in ("pid", "savedAt")}
+        items = []
+        for item in result["items"]:
+            job_record = job_store.load(item["jobId"]) if item["status"] not in FINISHED and "jobId" in item else None
+            items.append(StoredJob(job_record).to_dict() if job_record is not None else item)
+        return {**result, "items": items}
+
+
+class BatchRunner:
+    def __init__(self, queue: JobQueue):
+        self.queue = queue
+        self._batches: Dict[str, Batch] = {}
+        self._lock = threading.Lock()
+
+    def submit(
+        self, file_format: str, items: List[dict], bundle: Optional[str] = None, options: AudioOptions = DEFAULT_OPTIONS
+    ) -> Batch:
+        """Queues every valid clicktrack in the batch, rendering audio with the options. Raises
+        BatchError if the batch is invalid and QueueFullError, without queueing anything, if there
+        isn't room for it"""
+        if file_format not in BATCH_FORMATS:
+            raise BatchError(f"Unsupported format {file_format}")
+        if not isinstance(items, list) or not items:
+            raise BatchError("A batch needs a list of items")
+        if len(items) > MAX_BATCH_ITEMS:
+            raise BatchError(f"A batch can have at most {MAX_BATCH_ITEMS} items")
+        if bundle is not None and bundle not in BUNDLE_TYPES:
+            raise BatchError(f"Unsupported bundle {bundle}")
+        if bundle == "concat" and file_format == "midi":
+            raise BatchError("Only audio can be concatenated")
+
+        batch = Batch(file_format, items, bundle, options)
+        renders = batch.renders()
+        for idx, job in zip(renders, self.queue.submit_many(list(renders.values()))):
+            batch.jobs[idx] = job
+
+        jobs = {job.id: job for job in batch.jobs if job is not None}
+        with self._lock:
+            self._prune()
+            self._batches[batch.id] = batch
+            batch._pending_jobs = set(jobs)
+        self._save(batch)
+        if not jobs:
+            self._items_finished(batch)
+        # The same job can be shared by several items, so is only waited on once
+        for job in jobs.values():
+            job.future.add_done_callback(lambda _, job=job: self._job_finished(batch, job))
+        return batch
+
+    def get(self, batch_id: str) -> Optional[Union[Batch, StoredBatch]]:
+        """The batch, whichever worker it was submitted to"""
+        with self._lock:
+            batch = self._batches.get(batch_id)
+        if batch is None:
+            record = job_store.load(batch_id)
+            batch = StoredBatch(record) if record is not None and "batchId" in record else None
+        return batch
+
+    def _save(self, batch: Batch) -> None:
+        job_store.save(batch.id, batch.to_dict())
+
+    def _finish(self, batch: Batch) -> None:
+        batch.finish()
+        self._save(batch)
+
+    def _job_finished(self, batch: Batch, job: Job) -> None:
+        with self._lock:
+            batch._pending_jobs.discard(job.id)
+            finished = not batch._pending_jobs
+        if finished:
+            self._items_finished(batch)
+        else:
+            self._save(batch)
+
+    def _items_finished(self, batch: Batch) -> None:
+        """Finishes the batch, once its bundle is made if it wants one"""
+        if not batch.bundle:
+            self._finish(batch)
+            return
+        succeeded = [
+            idx for idx, job in enumerate(batch.jobs)
+            if job is not None and not job.future.cancelled() and not job.future.exception()
+            and job.future.result() != "error"
+        ]
+        if not succeeded:
+            batch.bundle_error = "None of the clicktracks could be rendered"
+            self._finish(batch)
+            return
+        renders = batch.renders()
+        bundled = [renders[idx] for idx in succeeded]
+        names = [f"{idx + 1:02d}-clicktrack" for idx in succeeded]
+        try:
+            batch.bundle_job = self.queue.submit_task(
+                bundle_key(batch.bundle, bundled), render_bundle, batch.bundle, bundled, names
+            )
+        except QueueFullError as e:
+            batch.bundle_error = str(e)
+            self._finish(batch)
+            return
+        self._save(batch)
+        batch.bundle_job.future.add_done_callback(lambda _: self._finish(batch))
+
+    def _prune(self) -> None:
+        cutoff = time.time() - RENDER_JOB_RETENTION
+        expired = [batch_id for batch_id, batch in self._batches.items() if batch.done and batch.submitted_at < cutoff]
+        for batch_id in expired:
+            del self._batches[batch_id]
+
+
+batch_runner = BatchRunner(JobQueue(max(RENDER_BATCH_WORKERS // WEB_WORKERS, 1), RENDER_BATCH_QUEUE_LIMIT, "batch"))
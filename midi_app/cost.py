@@ -0,0 +1,100 @@
+"""Estimates how long a render will take from its payload, before anything is rendered.
+
+Renders vary in cost by orders of magnitude, from a few milliseconds for the midi of a short loop
+to many seconds for an hour long OGG, so jobs.py uses the estimate to send cheap renders and
+expensive ones to separate lanes, and the views use it to refuse renders too big to do at all.
+
+The estimate is in milliseconds of one core's time. Audio renders cost a fixed overhead, plus per
+second of audio the time to synthesise and mix each instrument's part and to encode it into each
+format. The rates are taken from benchmarks/pipeline.py; they only need to be right to within a
+factor of two or so to pick a lane.
+"""
+import os
+from typing import List, Optional
+
+# Estimated cost above which a render goes to the heavy lane
+FAST_LANE_MAX_MS = float(os.environ.get("FAST_LANE_MAX_MS", 500))
+# Renders estimated to cost more than this, or audio longer than MAX_DURATION_MINUTES, are refused
+MAX_RENDER_MS = float(os.environ.get("MAX_RENDER_MS", 60000))
+MAX_DURATION_MINUTES = float(os.environ.get("MAX_DURATION_MINUTES", 90))
+
+BASE_MS = 20
+# The tempo of beats before the first bpm, as in a midi file without tempo marks
+DEFAULT_BPM = 120
+MIDI_MS_PER_CLICK = 0.002
+SYNTHESIS_MS_PER_SECOND = 0.7  # Per instrument
+ENCODE_MS_PER_SECOND = {"wav": 1.0, "flac": 2.0, "ogg": 11.0}
+
+
+class RenderTooLargeError(ValueError):
+    pass
+
+
+class RenderCost:
+    """The size of a clicktrack and the estimated cost of rendering it into the formats"""
+
+    def __init__(self, file_formats: List[str], clicks: int, seconds: float, instruments: int):
+        self.file_formats = file_formats
+        self.clicks = clicks
+        self.seconds = seconds
+        self.instruments = instruments
+
+    @property
+    def audio(self) -> bool:
+        return self.file_formats != ["midi"]
+
+    @property
+    def ms(self) -> float:
+        if not self.audio:
+            return BASE_MS + self.clicks * MIDI_MS_PER_CLICK
+        per_second = self.instruments * SYNTHESIS_MS_PER_SECOND
+        per_second += sum(ENCODE_MS_PER_SECOND[file_format] for file_format in self.file_formats)
+        return BASE_MS + self.seconds * per_second
+
+    @property
+    def heavy(self) -> bool:
+        return self.ms > FAST_LANE_MAX_MS
+
+    def check(self) -> None:
+        """Raises RenderTooLargeError if the render is too big to do"""
+        minutes = self.seconds / 60
+        if self.audio and minutes > MAX_DURATION_MINUTES:
+            raise RenderTooLargeError(
+                f"Clicktrack is {minutes:.0f} minutes long, the longest that can be rendered is {MAX_DURATION_MINUTES:.0f}"
+            )
+        if self.ms > MAX_RENDER_MS:
+            raise RenderTooLargeError(
+                f"Clicktrack is too big to render as {' and '.join(self.file_formats)} ({minutes:.0f} minutes, "
+                f"{self.clicks} clicks, {self.instruments} instruments), try a shorter clicktrack or fewer formats"
+            )
+
+    def to_dict(self) -> dict:
+        return {"clicks": self.clicks, "seconds": round(self.seconds, 1), "estimatedMs": round(self.ms)}
+
+
+def estimate_cost(file_formats: List[str], section_data, note_bpms, instrument_vals: Optional[List[str]] = None) -> RenderCost:
+    """Works out the size of the clicktrack from its sections, counting the clicks of both parts of
+    a polyrhythm, and its length from the bpm of each beat, which like the tempo marks of the midi
+    file is in quarter notes. Beats past the end of note_bpms are played at the last bpm, as they
+    are in the timeline. Raises ValueError if the payload doesn't describe a clicktrack"""
+    try:
+        clicks = sum(
+            rhythm["timeSig"][0] * section["overallData"]["numMeasures"]
+            for section in section_data
+            for rhythm in section["rhythms"][:2]
+        )
+        if any(bpm <= 0 for bpm in note_bpms):
+            raise ValueError("Every bpm must be positive")
+        seconds = 0
+        beat = 0
+        for section in section_data:
+            numerator, denominator = section["rhythms"][0]["timeSig"]
+            num_beats = numerator * section["overallData"]["numMeasures"]
+            bpms = note_bpms[beat:beat + num_beats]
+            seconds += sum(240 / denominator / bpm for bpm in bpms)
+            last_bpm = note_bpms[-1] if note_bpms else DEFAULT_BPM
+            seconds += (num_beats - len(bpms)) * 240 / denominator / last_bpm
+            beat += num_beats
+    except (KeyError, IndexError, TypeError, ZeroDivisionError):
+        raise ValueError("sectionData and noteBpms don't describe a clicktrack")
+    return RenderCost(list(file_formats), clicks, seconds, len(instrument_vals or []) or 1)
@@ -0,0 +1,386 @@
+"""Turns rendered audio into the bytes of audio files, as streams which can be uploaded as they are
+encoded, or as chunks to be sent as they are encoded.
+
+Audio is encoded from an iterator of blocks (see sample_renderer.render_blocks), so the whole of it
+is never in memory. encode_streams renders the blocks on one thread and encodes them on another per
+format, so the next blocks are rendered while the last ones are encoded, and one render can be
+encoded into several formats at once. How the audio is encoded (sample rate, bit depth and
+channels) is set with AudioOptions.
+
+WAV files are encoded by hand, as their size is known before anything is encoded. Other formats
+are encoded by libsndfile, a block at a time, and their size is only known once they're finished,
+so their streams can't be sought. Either way uploads start with the first encoded chunk, see
+storage.py for how cloudinary is sent a file of unknown size.
+"""
+import io
+import queue
+import struct
+from typing import BinaryIO, Dict, Iterable, Iterator, List, Optional
+
+import numpy as np
+import soundfile as sf
+
+from .metrics import span, start_thread
+from .sample_renderer import SAMPLE_RATE
+
+# Frames encoded at a time
+CHUNK_FRAMES = 64 * 1024
+# 16 bit PCM, soundfile's default subtype for wav
+SAMPLE_WIDTH = 2
+
+AUDIO_FORMATS = ("wav", "flac", "ogg")
+# The libsndfile subtype for each bit depth of the PCM formats, OGG is always Vorbis
+SUBTYPES = {16: "PCM_16", 24: "PCM_24"}
+MIN_SAMPLE_RATE = 8000
+MAX_SAMPLE_RATE = 96000
+
+
+class AudioOptions:
+    """How a clicktrack's audio is rendered and encoded"""
+
+    def __init__(self, sample_rate: int = SAMPLE_RATE, bit_depth: int = 16, channels: int = 2):
+        if not isinstance(sample_rate, int) or not MIN_SAMPLE_RATE <= sample_rate <= MAX_SAMPLE_RATE:
+            raise ValueError(f"sampleRate must be a whole number from {MIN_SAMPLE_RATE} to {MAX_SAMPLE_RATE}")
+        if bit_depth not in SUBTYPES:
+            raise ValueError(f"bitDepth must be one of {', '.join(map(str, SUBTYPES))}")
+        if channels not in (1, 2):
+            raise ValueError("channels must be 1 or 2")
+        self.sample_rate = sample_rate
+        self.bit_depth = bit_depth
+        self.channels = channels
+
+    @classmethod
+    def from_payload(cls, data: dict) -> "AudioOptions":
+        """Reads the optional sampleRate, bitDepth and channels of a request, raising ValueError
+        if they are invalid"""
+        return cls(data.get("sampleRate", SAMPLE_RATE), data.get("bitDepth", 16), data.get("channels", 2))
+
+    @property
+    def sample_width(self) -> int:
+        return self.bit_depth // 8
+
+    def subtype(self, file_format: str) -> str:
+        return "VORBIS" if file_format == "ogg" else SUBTYPES[self.bit_depth]
+
+    def to_dict(self) -> dict:
+        return {"sampleRate": self.sample_rate, "bitDepth": self.bit_depth, "channels": self.channels}
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, AudioOptions) and self.to_dict() == other.to_dict()
+
+
+DEFAULT_OPTIONS = AudioOptions()
+
+
+def wav_size(frames: int, channels: int, sample_width: int = SAMPLE_WIDTH) -> int:
+    return 44 + frames * channels * sample_width
+
+
+def wav_header(frames: int, channels: int, sample_rate: int, sample_width: int = SAMPLE_WIDTH) -> bytes:
+    """The header soundfile writes for a PCM wav"""
+    data_size = frames * channels * sample_width
+    return struct.pack(
+        "<4sI4s4sIHHIIHH4sI",
+        b"RIFF", 36 + data_size, b"WAVE",
+        b"fmt ", 16, 1, channels, sample_rate,
+        sample_rate * channels * sample_width, channels * sample_width, sample_width * 8,
+        b"data", data_size,
+    )
+
+
+def pcm_bytes(block: np.ndarray, sample_width: int = SAMPLE_WIDTH) -> bytes:
+    """Converts float32 samples to 16 or 24 bit PCM exactly as libsndfile does, by scaling to 32
+    bits, rounding, and keeping the top bits"""
+    scaled = (block.astype(np.float32) * np.float32(0x7FFFFFFF)).astype(np.float64)
+    pcm = np.clip(np.rint(scaled), -(2 ** 31), 2 ** 31 - 1).astype(np.int64) >> (32 - 8 * sample_width)
+    if sample_width == 2:
+        return pcm.astype("<i2").tobytes()
+    # Little endian, keeping the low sample_width bytes of each sample
+    return pcm.astype("<i4").reshape(-1, 1).view(np.uint8)[:, :sample_width].tobytes()
+
+
+def pcm_into(block: np.ndarray, out: np.ndarray, sample_width: int = SAMPLE_WIDTH) -> None:
+    """Converts float32 samples to PCM like pcm_bytes, but writes them into out, little endian
+    16 bit samples or, for 24 bit, 3 bytes per sample, without making the bytes in between.
+
+    Scaling by a power of two and flooring is exact in float64, so this matches the shift in
+    pcm_bytes.
+    """
+    scaled = block.astype(np.float64)
+    scaled *= 2.0 ** 31
+    np.rint(scaled, out=scaled)
+    np.clip(scaled, -(2 ** 31), 2 ** 31 - 1, out=scaled)
+    scaled *= 2.0 ** (8 * sample_width - 32)
+    np.floor(scaled, out=scaled)
+    if sample_width == 2:
+        out[...] = scaled
+    else:
+        out[...] = scaled.astype("<i4").view(np.uint8).reshape(*scaled.shape, 4)[..., :sample_width]
+
+
+def _chunks(blocks: Iterable[np.ndarray], chunk_frames: int = CHUNK_FRAMES) -> Iterator[np.ndarray]:
+    """Splits blocks up so that none is longer than chunk_frames. libsndfile's Vorbis encoder can
+    crash when given too much audio at once"""
+    for block in blocks:
+        for start in range(0, len(block), chunk_frames):
+            yield block[start:start + chunk_frames]
+
+
+def wav_chunks(
+    blocks: Iterable[np.ndarray], frames: int, channels: int, sample_rate: int, sample_width: int = SAMPLE_WIDTH
+) -> Iterator[bytes]:
+    """Encodes a wav of the given length from its blocks of audio"""
+    yield wav_header(frames, channels, sample_rate, sample_width)
+    for block in _chunks(blocks):
+        with span("encode_wav"):
+            data = pcm_bytes(block, sample_width)
+        yield data
+
+
+class _StreamSink:
+    """Write only file for soundfile which hands over what has been written so far with take().
+
+    Formats like FLAC seek back to fill in their header once the whole file has been written,
+    writes which are dropped as the header will already have been sent.
+    """
+
+    def __init__(self):
+        self._pending = bytearray()
+        self._taken = 0
+        self._pos = 0
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        if self._pos == self._taken + len(self._pending):
+            self._pending += data
+        self._pos += len(data)
+        return len(data)
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        end = self._taken + len(self._pending)
+        self._pos = {io.SEEK_SET: 0, io.SEEK_CUR: self._pos, io.SEEK_END: end}[whence] + offset
+        return self._pos
+
+    def tell(self) -> int:
+        return self._pos
+
+    def read(self, size: int = -1) -> bytes:
+        return b""
+
+    def take(self) -> bytes:
+        data = bytes(self._pending)
+        self._taken += len(data)
+        self._pending.clear()
+        return data
+
+
+def _set_flac_total_samples(header: bytes, frames: int) -> bytes:
+    """Fills in the total samples in the STREAMINFO block at the start of a FLAC file, which is
+    otherwise only written once encoding is finished. The MD5 and frame sizes are left unknown, as
+    the spec allows"""
+    if header[:4] != b"fLaC" or len(header) < 26:
+        raise ValueError("Expected the FLAC header in the first block")
+    # Bytes 18-25 hold the sample rate, channels and bits per sample, then 36 bits of total samples
+    packed = int.from_bytes(header[18:26], "big")
+    packed = (packed & ~((1 << 36) - 1)) | frames
+    return header[:18] + packed.to_bytes(8, "big") + header[26:]
+
+
+def sndfile_chunks(
+    blocks: Iterable[np.ndarray], frames: int, channels: int, sample_rate: int, file_format: str, subtype: str
+) -> Iterator[bytes]:
+    """Encodes a file of the given length from its blocks of audio with libsndfile"""
+    sink = _StreamSink()
+    header = file_format == "flac"
+    with sf.SoundFile(sink, "w", sample_rate, channels, subtype, format=file_format.upper()) as f:
+        for block in _chunks(blocks):
+            with span(f"encode_{file_format}"):
+                f.write(block)
+            data = sink.take()
+            if data and header:
+                data = _set_flac_total_samples(data, frames)
+                header = False
+            if data:
+                yield data
+    data = sink.take()
+    if data and header:
+        data = _set_flac_total_samples(data, frames)
+    if data:
+        yield data
+
+
+def _downmix(blocks: Iterable[np.ndarray], channels: int) -> Iterator[np.ndarray]:
+    for block in blocks:
+        if channels == 1 and block.shape[1] != 1:
+            block = block.mean(axis=1, dtype=np.float32, keepdims=True)
+        yield block
+
+
+def encoded_chunks(
+    blocks: Iterable[np.ndarray], frames: int, file_format: str, options: AudioOptions = DEFAULT_OPTIONS
+) -> Iterator[bytes]:
+    """Encodes the blocks of audio, which are at options.sample_rate, as they are needed"""
+    blocks = _downmix(blocks, options.channels)
+    if file_format == "wav":
+        return wav_chunks(blocks, frames, options.channels, options.sample_rate, options.sample_width)
+    return sndfile_chunks(
+        blocks, frames, options.channels, options.sample_rate, file_format, options.subtype(file_format)
+    )
+
+
+def encoded_size(frames: int, file_format: str, options: AudioOptions = DEFAULT_OPTIONS) -> Optional[int]:
+    """The size of the encoded file if it can be known before it is encoded"""
+    if file_format == "wav":
+        return wav_size(frames, options.channels, options.sample_width)
+    return None
+
+
+class ChunkStream(io.RawIOBase):
+    """Read only stream of the bytes from an iterator which is run on a background thread, a few
+    chunks ahead of whatever is reading the stream.
+
+    If the total size is known up front, seeking is supported so that readers can find the size by
+    seeking to the end and back, as cloudinary's chunked upload does. Otherwise the size is None
+    and the stream can't be sought.
+    """
+
+    def __init__(self, chunks: Iterable[bytes], size: Optional[int] = None, max_buffered: int = 4):
+        self.size = size
+        self._queue: queue.Queue = queue.Queue(max_buffered)
+        self._buffer = b""
+        self._read_pos = 0
+        self._pos = 0
+        self._finished = False
+        start_thread(self._produce, chunks)
+
+    def _produce(self, chunks: Iterable[bytes]) -> None:
+        try:
+            for chunk in chunks:
+                if not self._put(chunk):
+                    return
+            self._put(None)
+        except Exception as e:
+            self._put(e)
+
+    def _put(self, item) -> bool:
+        """Returns False if the stream was closed before the item could be queued"""
+        while True:
+            try:
+                self._queue.put(item, timeout=1)
+                return True
+            except queue.Full:
+                if self.closed:
+                    return False
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return self.size is not None
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if self.size is None:
+            raise io.UnsupportedOperation("The size of the stream isn't known until it has been read")
+        self._pos = {io.SEEK_SET: 0, io.SEEK_CUR: self._pos, io.SEEK_END: self.size}[whence] + offset
+        return self._pos
+
+    def read(self, size: int = -1) -> bytes:
+        if self._pos != self._read_pos:
+            raise io.UnsupportedOperation("Can only read from where the last read finished")
+        while not self._finished and (size < 0 or len(self._buffer) < size):
+            item = self._queue.get()
+            if item is None:
+                self._finished = True
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                self._buffer += item
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        self._read_pos += len(data)
+        self._pos = self._read_pos
+        return data
+
+    def readall(self) -> bytes:
+        return self.read()
+
+    def readinto(self, b) -> int:
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+
+class _FanOut:
+    """Hands each block from a background thread to several consumers, each through a queue of
+    its own. Consumers which stop early are dropped, so they don't hold up the rest"""
+
+    def __init__(self, blocks: Iterable[np.ndarray], count: int, max_buffered: int):
+        self._queues = [queue.Queue(max_buffered) for _ in range(count)]
+        self._abandoned = [False] * count
+        start_thread(self._produce, blocks)
+
+    def _produce(self, blocks: Iterable[np.ndarray]) -> None:
+        try:
+            for block in blocks:
+                if not self._put(block):
+                    return
+            self._put(None)
+        except Exception as e:
+            self._put(e)
+
+    def _put(self, item) -> bool:
+        """Returns False once every consumer has stopped"""
+        for idx, q in enumerate(self._queues):
+            while not self._abandoned[idx]:
+                try:
+                    q.put(item, timeout=1)
+                    break
+                except queue.Full:
+                    pass
+        return not all(self._abandoned)
+
+    def consume(self, idx: int) -> Iterator[np.ndarray]:
+        try:
+            while True:
+                item = self._queues[idx].get()
+                if item is None:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            self._abandoned[idx] = True
+
+
+def fan_out(blocks: Iterable[np.ndarray], count: int, max_buffered: int = 4) -> List[Iterator[np.ndarray]]:
+    """Iterates over the blocks on a background thread, a few blocks ahead of whatever is using
+    them, handing each block to count iterators. The iterators have to be used concurrently, as
+    the blocks are only produced as fast as the slowest of them takes them"""
+    fan = _FanOut(blocks, count, max_buffered)
+    return [fan.consume(idx) for idx in range(count)]
+
+
+def render_ahead(blocks: Iterable[np.ndarray], max_buffered: int = 4) -> Iterator[np.ndarray]:
+    """Iterates over the blocks on a background thread, so the next ones are rendered while the
+    last ones are being encoded"""
+    return fan_out(blocks, 1, max_buffered)[0]
+
+
+def encode_streams(
+    blocks: Iterable[np.ndarray], frames: int, file_formats: List[str], options: AudioOptions = DEFAULT_OPTIONS
+) -> Dict[str, BinaryIO]:
+    """Encodes the blocks of audio into each format, returning a stream of each file.
+
+    The blocks are rendered on one thread and each format is encoded on another. The streams
+    have to be read concurrently, e.g. uploaded on threads of their own.
+    """
+    streams = {}
+    for file_format, format_blocks in zip(file_formats, fan_out(blocks, len(file_formats))):
+        chunks = encoded_chunks(format_blocks, frames, file_format, options)
+        streams[file_format] = ChunkStream(chunks, encoded_size(frames, file_format, options))
+    return streams
+
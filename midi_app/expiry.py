@@ -0,0 +1,271 @@
+"""Deletes uploaded clicktracks once they expire.
+
+Each process has one scheduler thread holding a heap of (expiry, public_id) which wakes when the
+earliest upload expires and deletes everything due in batches, rather than a sleeping process per
+upload. Pending deletions are also recorded as small files in EXPIRY_DIR, which are removed once the
+file has been deleted, so anything still pending when a process exits is picked up by resume().
+
+Every gunicorn worker has a scheduler on the same EXPIRY_DIR, so each record names the scheduler
+which owns it, and each scheduler holds a lock on a file of its own for as long as its process
+lives. resume() takes over only the records of schedulers whose lock is free, one process at a
+time, so the deletions left by a previous run are resumed by one worker rather than all of them,
+and the scheduler thread runs it every ADOPT_INTERVAL to take over those of workers which have
+exited since. A deletion is only carried out by the scheduler whose record it is, so each happens
+once.
+"""
+import fcntl
+import hashlib
+import heapq
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Callable, Iterable, List, Optional, Set, Tuple
+
+from .log import log
+from .metrics import metrics
+from .storage import storage
+
+EXPIRY_DIR = os.environ.get("EXPIRY_DIR", "pending_deletions")
+# Cloudinary deletes at most 100 resources per call
+DELETE_BATCH_SIZE = 100
+# Deletions are held back for up to this long so that files expiring around the same time are
+# deleted in one batch
+BATCH_WINDOW = 5
+# How long to wait before retrying a batch that failed to delete
+RETRY_DELAY = 60
+# How often to take over the deletions of processes which have exited
+ADOPT_INTERVAL = 60
+
+
+class ExpiryScheduler:
+    def __init__(
+        self,
+        delete: Callable[[List[str]], None] = storage.delete,
+        directory: Optional[str] = EXPIRY_DIR,
+        batch_size: int = DELETE_BATCH_SIZE,
+        batch_window: float = BATCH_WINDOW,
+        retry_delay: float = RETRY_DELAY,
+        adopt_interval: float = ADOPT_INTERVAL,
+    ):
+        self.delete = delete
+        self.directory = directory
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.retry_delay = retry_delay
+        self.adopt_interval = adopt_interval
+        self.deleted = 0
+        self.failed = 0
+        self._heap: List[Tuple[float, str]] = []
+        # The public ids in the heap
+        self._scheduled: Set[str] = set()
+        self._condition = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._pid = os.getpid()
+        self._adopt_at = 0.0
+        self._token = uuid.uuid4().hex
+        self._owner_file = None
+        self._owner_lock = threading.Lock()
+        # The scheduler thread may hold the lock when the process forks, e.g. when gunicorn
+        # preloads the app, which would leave it locked for good in the child
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self) -> None:
+        self._condition = threading.Condition()
+        self._owner_lock = threading.Lock()
+        # The child is a scheduler of its own, while the parent keeps its records and its lock
+        self._token = uuid.uuid4().hex
+        if self._owner_file is not None:
+            self._owner_file.close()
+            self._owner_file = None
+
+    def schedule(self, public_id: str, expires_at: float) -> None:
+        """Deletes the file with the given public id at the expires_at timestamp"""
+        self._record(public_id, expires_at)
+        self._push([(expires_at, public_id)])
+
+    def resume(self) -> int:
+        """Takes over and schedules the deletions recorded on disk by schedulers which have gone,
+        e.g. those left pending by a previous run, and starts the scheduler thread. Returns how many
+        there were"""
+        self._adopt_at = time.time() + self.adopt_interval
+        entries = []
+        if self.directory is not None:
+            with self._resume_lock():
+                for path in self._record_paths():
+                    try:
+                        with open(path) as f:
+                            record = json.load(f)
+                    except (FileNotFoundError, ValueError):
+                        continue
+                    owner = record.get("owner")
+                    if owner == self._token or self._owner_alive(owner):
+                        continue
+                    self._record(record["public_id"], record["expires_at"])
+                    entries.append((record["expires_at"], record["public_id"]))
+        self._push(entries)
+        if entries:
+            log(f"Resumed {len(entries)} pending deletions")
+        return len(entries)
+
+    def stats(self) -> dict:
+        with self._condition:
+            return {
+                "pending": len(self._heap),
+                "next_expiry": self._heap[0][0] if self._heap else None,
+                "deleted": self.deleted,
+                "failed": self.failed,
+            }
+
+    def run_due(self, now: float = None) -> int:
+        """Deletes everything which has expired by now, returning how many files were deleted"""
+        now = time.time() if now is None else now
+        deleted = 0
+        while True:
+            with self._condition:
+                batch = []
+                while self._heap and self._heap[0][0] <= now and len(batch) < self.batch_size:
+                    batch.append(heapq.heappop(self._heap))
+                    self._scheduled.discard(batch[-1][1])
+            if not batch:
+                return deleted
+            public_ids = [public_id for _, public_id in batch if self._owns(public_id)]
+            if not public_ids:
+                continue
+            try:
+                self.delete(public_ids)
+            except Exception as e:
+                log(f"Failed to delete {len(public_ids)} files, retrying in {self.retry_delay}s: {e}")
+                with self._condition:
+                    self.failed += len(public_ids)
+                self._push([(now + self.retry_delay, public_id) for public_id in public_ids])
+                return deleted
+            for public_id in public_ids:
+                self._forget(public_id)
+                log(f"Deleted {public_id}")
+            with self._condition:
+                self.deleted += len(public_ids)
+            deleted += len(public_ids)
+
+    def _push(self, entries: Iterable[Tuple[float, str]]) -> None:
+        with self._condition:
+            if self._pid != os.getpid():
+                # Forked from a process with a scheduler, which remains responsible for its
+                # deletions, and whose thread didn't come along
+                self._heap = []
+                self._scheduled = set()
+                self._thread = None
+                self._pid = os.getpid()
+            for entry in entries:
+                if entry[1] not in self._scheduled:
+                    self._scheduled.add(entry[1])
+                    heapq.heappush(self._heap, entry)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="expiry-scheduler", daemon=True)
+                self._thread.start()
+            self._condition.notify()
+
+    def _run(self) -> None:
+        while True:
+            if self.directory is not None and time.time() >= self._adopt_at:
+                self.resume()
+            with self._condition:
+                due_at = self._heap[0][0] + self.batch_window if self._heap else float("inf")
+                if due_at > time.time():
+                    wake_at = due_at if self.directory is None else min(due_at, self._adopt_at)
+                    # Woken early if something expiring sooner is scheduled
+                    self._condition.wait(None if wake_at == float("inf") else max(wake_at - time.time(), 0))
+                    continue
+            self.run_due()
+
+    def _record_path(self, public_id: str) -> str:
+        return os.path.join(self.directory, hashlib.sha256(public_id.encode()).hexdigest() + ".json")
+
+    def _record_paths(self) -> List[str]:
+        if self.directory is None:
+            return []
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        return [os.path.join(self.directory, name) for name in names if name.endswith(".json")]
+
+    def _record(self, public_id: str, expires_at: float) -> None:
+        if self.directory is None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix=".")
+        with os.fdopen(fd, "w") as f:
+            json.dump({"public_id": public_id, "expires_at": expires_at, "owner": self._owner()}, f)
+        os.replace(tmp_path, self._record_path(public_id))
+
+    def _owns(self, public_id: str) -> bool:
+        """Whether the deletion is still this scheduler's to carry out, which it isn't once its
+        record is gone or has been taken over"""
+        if self.directory is None:
+            return True
+        try:
+            with open(self._record_path(public_id)) as f:
+                return json.load(f).get("owner") == self._token
+        except (FileNotFoundError, ValueError):
+            return False
+
+    def _owner_path(self, token: str) -> str:
+        return os.path.join(self.directory, f".owner.{token}.lock")
+
+    def _owner(self) -> str:
+        """This scheduler's token, first taking the lock which shows it is alive"""
+        with self._owner_lock:
+            if self._owner_file is None:
+                owner_file = open(self._owner_path(self._token), "w")
+                fcntl.flock(owner_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                self._owner_file = owner_file
+        return self._token
+
+    def _owner_alive(self, token: Optional[str]) -> bool:
+        """Whether the scheduler with the given token still holds its lock, removing the lock file
+        of one which has gone"""
+        if token is None:
+            return False
+        path = self._owner_path(token)
+        try:
+            owner_file = open(path)
+        except FileNotFoundError:
+            return False
+        with owner_file:
+            try:
+                fcntl.flock(owner_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return True
+            os.remove(path)
+            return False
+
+    @contextmanager
+    def _resume_lock(self):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, ".resume.lock"), "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+
+    def _forget(self, public_id: str) -> None:
+        if self.directory is None:
+            return
+        try:
+            os.remove(self._record_path(public_id))
+        except FileNotFoundError:
+            pass
+
+
+expiry_scheduler = ExpiryScheduler()
+
+
+def collect_stats() -> None:
+    stats = expiry_scheduler.stats()
+    for name in ("pending", "deleted", "failed"):
+        metrics.set(f"clicktrack_expiry_{name}", stats[name])
+
+
+metrics.register_collector(collect_stats)
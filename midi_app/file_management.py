@@ -1,39 +1,43 @@
-import cloudinary
-import cloudinary.uploader
-import cloudinary.api
-
-import multiprocessing as mp
+import os
+import tempfile
 import time
+from contextlib import contextmanager
 
 from dotenv import load_dotenv
 
-from .log import log
+from .expiry import expiry_scheduler
+from .metrics import span
+from .storage import Source, storage
 
 load_dotenv()
 
-config = cloudinary.config(secure=True)
 
+DELETE_TIMEOUT = 15 * 60 # Automatically deletes the track from storage after 15 minutes
+
+# Parent of the per-render scratch directories, defaults to the system temp directory
+SCRATCH_DIR = os.environ.get("SCRATCH_DIR")
 
-DELETE_TIMEOUT = 15 * 60 # Automatically deletes the track from cloudinary after 15 minutes
+@contextmanager
+def render_workspace():
+    """Yields a fresh directory for a single render's files, which is deleted afterwards.
 
-def delete_file_after_timeout(public_id):
-    time.sleep(DELETE_TIMEOUT)
-    cloudinary.uploader.destroy(public_id, resource_type = 'video')
-    log(f'Deleted {public_id}')
-    return
+    Every render writes its midi, intermediate and output files into its own workspace, so
+    concurrent requests in the same container can't overwrite each other's files.
+    """
+    with tempfile.TemporaryDirectory(prefix="render-", dir=SCRATCH_DIR) as workspace:
+        yield workspace
 
-def upload_file(filename: str) -> str:
-    """Returns the https url of the file once it is uploaded to cloudinary"""
+def upload_file(source: Source, file_format: str = None) -> str:
+    """Uploads a filename, bytes or binary stream to the storage backend and returns its url, or
+    "error". The file is deleted again after DELETE_TIMEOUT"""
 
-    print("Uploading file", filename)
-    # Cloudinary considers audio to be a subset of the video resource type
-    upload_response = cloudinary.uploader.upload(
-        filename, resource_type="video", folder="clicktracks"
-    )
+    if file_format is None:
+        file_format = os.path.splitext(source)[1][1:]
+    print("Uploading file", source if isinstance(source, str) else f"stream ({file_format})")
+    with span("upload"):
+        url, public_id = storage.upload(source, file_format)
 
-    mp.Process(target=delete_file_after_timeout, args=(upload_response['public_id'],)).start()
+    if public_id is not None:
+        expiry_scheduler.schedule(public_id, time.time() + DELETE_TIMEOUT)
 
-    try:
-        return upload_response["secure_url"]
-    except:
-        return "error"
+    return url
@@ -0,0 +1,20 @@
+"""Runs the fluidsynth CLI, for the fluidsynth audio backend"""
+import subprocess
+
+from .log import log
+from .metrics import SUBPROCESS_FAILURES, metrics, span
+
+
+def synthesise_file(soundfont_file: str, midi_filename: str, output_filename: str, sample_rate: int, check: bool = False) -> int:
+    """Synthesises the midi file with the soundfont into the output file, whose format is taken
+    from its extension. Returns fluidsynth's exit code, raising CalledProcessError if it failed
+    and check is set"""
+    command = ["fluidsynth", "-ni", "-g", "1", "-r", str(sample_rate), soundfont_file, midi_filename, "-F", output_filename]
+    with span("synthesis"):
+        result = subprocess.run(command)
+    if result.returncode:
+        metrics.inc(SUBPROCESS_FAILURES, command="fluidsynth")
+        log(f"fluidsynth exited with {result.returncode} synthesising {midi_filename}")
+        if check:
+            raise subprocess.CalledProcessError(result.returncode, command)
+    return result.returncode
@@ -1,8 +1,15 @@
+import os
+
+# The soundfonts are kept at the root of the repo, which they are found relative to, so that the
+# app can be imported from any working directory
+SOUNDFONT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
 class Instrument:
     def __init__(self, name: str, playback_note: str, soundfont_file: str):
         self.name = name
         self.playback_note = playback_note
-        self.soundfont_file = soundfont_file
+        self.soundfont_file = os.path.join(SOUNDFONT_DIR, soundfont_file)
 
 
 all_instruments: dict = {
@@ -15,3 +22,15 @@ all_instruments: dict = {
     "woodblock_high": Instrument("High pitched Woodblock", "E7", "Woodblocks.sf2"),
     "woodblock_lower": Instrument("Lower pitched Woodblock", "B6", "Woodblocks.sf2"),
 }
+
+
+def playback_notes(instruments=None) -> tuple:
+    """Returns the (main, secondary) notes to play the clicktrack with.
+
+    If an instrument is specified, use the given note otherwise default to middle C
+    """
+    if not instruments:
+        return "C4", "C4"
+    if len(instruments) > 1:
+        return instruments[0].playback_note, instruments[1].playback_note
+    return instruments[0].playback_note, instruments[0].playback_note
@@ -0,0 +1,160 @@
+"""Records of render jobs and batches, shared by every gunicorn worker on the host.
+
+A job is run by the worker which accepted it, but polls for it can go to any worker, so the owning
+worker writes the job's status to a small JSON file in JOB_DIR whenever it changes, and a worker
+asked about a job it doesn't have reads that instead. Records hold the pid of the worker which
+owns them, so that jobs whose worker has died are reported as failed rather than pending forever.
+
+Each unfinished job also has an empty marker file named after its queue and worker, so that a
+queue's limit can be applied to the pending jobs of every worker on the host by counting them.
+Two workers submitting at the same moment can both get the last place, so the limit can be
+overshot by a job or two.
+
+Records are removed once they're older than the jobs are kept for.
+"""
+import json
+import os
+import re
+import tempfile
+import time
+from typing import Callable, Optional
+
+from .file_management import DELETE_TIMEOUT
+
+JOB_DIR = os.environ.get("JOB_DIR", "jobs")
+# How often a worker waiting on another worker's job checks its record
+POLL_INTERVAL = 0.2
+# Least time between looking for old records to delete
+PRUNE_INTERVAL = 60
+
+FINISHED = ("done", "failed")
+_ID = re.compile(r"^[0-9a-f]{32}$")
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class JobStore:
+    def __init__(self, directory: Optional[str] = JOB_DIR, retention: float = DELETE_TIMEOUT):
+        self.directory = directory
+        self.retention = retention
+        self._pruned_at = 0.0
+
+    def _path(self, record_id: str) -> str:
+        return os.path.join(self.directory, f"{record_id}.json")
+
+    def _marker_path(self, queue: str, pid: int, job_id: str) -> str:
+        return os.path.join(self.directory, f"{queue}.{pid}.{job_id}.pending")
+
+    def save(self, record_id: str, record: dict) -> None:
+        """Writes the record of a job or batch, which has a "status", owned by this process unless
+        the record has the "pid" of its owner"""
+        if self.directory is None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix=".")
+        with os.fdopen(fd, "w") as f:
+            # Keeping the owner's pid when a pool process updates the record
+            json.dump({"pid": os.getpid(), **record, "savedAt": time.time()}, f)
+        os.replace(tmp_path, self._path(record_id))
+
+    def load(self, record_id: str) -> Optional[dict]:
+        """The record of a job or batch, or None if there isn't one. One which is unfinished but
+        whose worker has gone is returned as failed"""
+        if self.directory is None or not _ID.match(record_id):
+            return None
+        try:
+            with open(self._path(record_id)) as f:
+                record = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        if record["status"] not in FINISHED and not _alive(record["pid"]):
+            record["status"] = "failed"
+            record["error"] = "The worker rendering this stopped before it finished"
+        return record
+
+    def update_status(self, record_id: str, status: str) -> None:
+        """Moves an unfinished record on to the given status, e.g. once its job starts running"""
+        record = self.load(record_id)
+        if record is not None and record["status"] not in FINISHED:
+            self.save(record_id, {**record, "status": status})
+
+    def wait(self, record_id: str, timeout: float, finished: Callable[[dict], bool]) -> Optional[dict]:
+        """Polls the record until finished(record) or the timeout passes, and returns it"""
+        deadline = time.monotonic() + timeout
+        record = self.load(record_id)
+        while record is not None and not finished(record) and time.monotonic() < deadline:
+            time.sleep(min(POLL_INTERVAL, max(deadline - time.monotonic(), 0)))
+            record = self.load(record_id)
+        return record
+
+    def add_pending(self, queue: str, job_id: str) -> None:
+        if self.directory is None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        open(self._marker_path(queue, os.getpid(), job_id), "w").close()
+
+    def remove_pending(self, queue: str, job_id: str) -> None:
+        if self.directory is None:
+            return
+        try:
+            os.remove(self._marker_path(queue, os.getpid(), job_id))
+        except FileNotFoundError:
+            pass
+
+    def pending(self, queue: str) -> int:
+        """How many jobs in the queue are pending in every live worker, removing the markers of
+        workers which have gone"""
+        if self.directory is None:
+            return 0
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return 0
+        count = 0
+        alive = {}
+        for name in names:
+            parts = name.split(".")
+            if len(parts) != 4 or parts[0] != queue or parts[3] != "pending":
+                continue
+            pid = int(parts[1])
+            if pid not in alive:
+                alive[pid] = _alive(pid)
+            if alive[pid]:
+                count += 1
+            else:
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    pass
+        return count
+
+    def prune(self) -> None:
+        """Deletes records which haven't changed for longer than the retention"""
+        if self.directory is None or time.time() - self._pruned_at < PRUNE_INTERVAL:
+            return
+        self._pruned_at = time.time()
+        cutoff = time.time() - self.retention
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return
+        for name in names:
+            if not name.endswith(".json"):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+job_store = JobStore()
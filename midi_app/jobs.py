@@ -0,0 +1,431 @@
+"""In process render job queue.
+
+Renders (and their uploads) run on a bounded process pool rather than in the request handlers,
+so a long render can't tie up a gunicorn worker. Submissions get a job id which can be polled,
+identical submissions which are already queued or running share the one job, and once too many
+jobs are pending new submissions are refused so that callers can back off.
+
+Renders are split between two lanes by their estimated cost (see cost.py), each a queue with its
+own pool, so short renders never wait behind long ones. The heavy lane's processes also run at a
+lower priority, so they get whatever CPU the fast lane leaves.
+
+Jobs are run by the gunicorn worker which accepted them, but their status is recorded in the
+job store (see job_store.py), so they can be polled through any worker, and each queue's limit
+applies to the jobs pending in all of them.
+
+A render can also be split into loops (see loops.py), in which case the job's url is that of a
+manifest of the loops' audio, each uploaded like any other render.
+"""
+import json
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+from .audio_processing import (
+    AUDIO_BACKEND, WAV_ASSEMBLY, make_audio_stream, make_audio_streams, make_mapped_wav_stream, make_midi_stream
+)
+from .cost import RenderCost, estimate_cost
+from .encoding import DEFAULT_OPTIONS, AudioOptions
+from .file_management import DELETE_TIMEOUT, render_workspace, upload_file
+from .job_store import FINISHED, job_store
+from .log import log
+from .loops import Segment, find_segments, loop_manifest
+from .metrics import JOBS, metrics, trace
+from .profiler import profiler
+from .render_cache import cached_upload, render_cache, render_key
+
+RENDER_JOB_WORKERS = int(os.environ.get("RENDER_JOB_WORKERS", 2))
+RENDER_JOB_QUEUE_LIMIT = int(os.environ.get("RENDER_JOB_QUEUE_LIMIT", 16))
+HEAVY_JOB_WORKERS = int(os.environ.get("HEAVY_JOB_WORKERS", 1))
+HEAVY_JOB_QUEUE_LIMIT = int(os.environ.get("HEAVY_JOB_QUEUE_LIMIT", 4))
+# How much the heavy lane's processes are niced by
+HEAVY_JOB_NICENESS = int(os.environ.get("HEAVY_JOB_NICENESS", 10))
+# Finished jobs are forgotten once their file will have been deleted from cloudinary
+RENDER_JOB_RETENTION = DELETE_TIMEOUT
+
+
+class QueueFullError(Exception):
+    pass
+
+
+def render_key_for(file_format: str, section_data, note_bpms, instrument_vals=None, options: AudioOptions = None) -> str:
+    if file_format == "midi":
+        return render_key(section_data, note_bpms, None, "midi")
+    options = options.to_dict() if options is not None and options != DEFAULT_OPTIONS else None
+    return render_key(section_data, note_bpms, instrument_vals, file_format, AUDIO_BACKEND, options)
+
+
+def formats_key(file_formats: List[str], section_data, note_bpms, instrument_vals=None, options: AudioOptions = None) -> str:
+    """Key of a job rendering the clicktrack into several formats"""
+    return " ".join(
+        render_key_for(file_format, section_data, note_bpms, instrument_vals, options) for file_format in file_formats
+    )
+
+
+def render_and_upload(file_format: str, section_data, note_bpms, instrument_vals=None, options: AudioOptions = None) -> str:
+    """The body of a render job: renders the clicktrack and streams it to storage as it is
+    encoded, unless the render cache already has it. WAVs are instead assembled in a memory
+    mapped file which is uploaded as it is written, see WAV_ASSEMBLY. Any files the render needs
+    are kept in a scratch directory. Returns the url, or "error" if the upload failed"""
+    key = render_key_for(file_format, section_data, note_bpms, instrument_vals, options)
+    if file_format == "midi":
+        return cached_upload(key, "midi", lambda: make_midi_stream(section_data, note_bpms))
+
+    with render_workspace() as workspace:
+        def render():
+            if file_format == "wav" and WAV_ASSEMBLY == "mapped":
+                stream, _ = make_mapped_wav_stream(
+                    section_data, note_bpms, instrument_vals, workspace, options=options or DEFAULT_OPTIONS
+                )
+                return stream
+            stream, _, _ = make_audio_stream(
+                section_data, note_bpms, file_format, instrument_vals, workspace, options=options or DEFAULT_OPTIONS
+            )
+            return stream
+
+        return cached_upload(key, file_format, render)
+
+
+def render_and_upload_formats(
+    file_formats: List[str], section_data, note_bpms, instrument_vals=None, options: AudioOptions = None
+) -> Dict[str, str]:
+    """The body of a job rendering the clicktrack into several audio formats: it is rendered once,
+    and encoded into each format and uploaded in parallel. Formats which are already in the render
+    cache aren't encoded again. Returns each format's url, or "error" if its upload failed"""
+    options = options or DEFAULT_OPTIONS
+    keys = {file_format: render_key_for(file_format, section_data, note_bpms, instrument_vals, options) for file_format in file_formats}
+    missing = [
+        file_format for file_format in file_formats
+        if not render_cache.get_url(keys[file_format]) and render_cache.get_file(keys[file_format], file_format) is None
+    ]
+    with render_workspace() as workspace:
+        streams = {}
+        if missing:
+            streams, _, _ = make_audio_streams(section_data, note_bpms, missing, instrument_vals, workspace, options=options)
+
+        def upload(file_format: str) -> str:
+            def render():
+                if file_format in streams:
+                    return streams.pop(file_format)
+                # Dropped from the render cache since it was checked
+                stream, _, _ = make_audio_stream(
+                    section_data, note_bpms, file_format, instrument_vals, workspace, options=options
+                )
+                return stream
+
+            url = cached_upload(keys[file_format], file_format, render)
+            # A stream which wasn't needed after all is closed, so it doesn't hold up the others
+            if file_format in streams:
+                streams.pop(file_format).close()
+            return url
+
+        with ThreadPoolExecutor(len(file_formats)) as pool:
+            return dict(zip(file_formats, pool.map(upload, file_formats)))
+
+
+def loops_key(file_format: str, section_data, note_bpms, instrument_vals=None, options: AudioOptions = None) -> str:
+    """Key of a job splitting the clicktrack into loops"""
+    options = options.to_dict() if options is not None and options != DEFAULT_OPTIONS else None
+    return render_key(section_data, note_bpms, instrument_vals, f"{file_format}-loops", AUDIO_BACKEND, options)
+
+
+def render_loop_manifest(file_format: str, segments: List[Segment], instrument_vals=None, options: AudioOptions = None) -> str:
+    """The body of a loops job: renders and uploads each segment's audio, unless the render cache
+    already has it, then uploads the manifest. Returns the manifest's url, or "error" if any upload
+    failed.
+
+    The manifest itself isn't cached, as the segments' urls it lists may expire before it would.
+    """
+    options = options or DEFAULT_OPTIONS
+    urls = []
+    for segment in segments:
+        url = render_and_upload(file_format, segment.section_data, segment.note_bpms, instrument_vals, options)
+        if url == "error":
+            return "error"
+        urls.append(url)
+    manifest = loop_manifest(segments, urls, file_format, options.sample_rate)
+    return upload_file(json.dumps(manifest).encode(), "json")
+
+
+def run_task(job_id: str, fn: Callable, *args):
+    """Runs a task on the render pool, returning its result along with the metrics it recorded,
+    which are merged into those of the process that queued it"""
+    job_store.update_status(job_id, "running")
+    # Pool processes are forked with a copy of their parent's metrics, which it already has
+    metrics.reset()
+    with trace("task", task=fn.__name__), profiler.profile(fn.__name__, all_threads=True):
+        result = fn(*args)
+    return result, metrics.snapshot()
+
+
+class TaskFuture(Future):
+    """The future of a task's result, unwrapped from the result and metrics run_task returns"""
+
+    def __init__(self, pool_future: Future):
+        super().__init__()
+        self._pool_future = pool_future
+        pool_future.add_done_callback(self._unwrap)
+
+    def running(self) -> bool:
+        return not self.done() and self._pool_future.running()
+
+    def _unwrap(self, pool_future: Future) -> None:
+        if pool_future.cancelled():
+            self.cancel()
+        elif pool_future.exception() is not None:
+            self.set_exception(pool_future.exception())
+        else:
+            result, snapshot = pool_future.result()
+            metrics.merge(snapshot)
+            self.set_result(result)
+
+
+class Job:
+    def __init__(self, key: str, future: Future, job_id: str = None):
+        self.id = job_id or uuid.uuid4().hex
+        self.key = key
+        self.future = future
+        self.submitted_at = time.time()
+
+    @property
+    def status(self) -> str:
+        if not self.future.done():
+            return "running" if self.future.running() else "queued"
+        return "failed" if self.future.cancelled() or self.future.exception() else "done"
+
+    def to_dict(self) -> dict:
+        result = {"jobId": self.id, "status": self.status}
+        if self.status == "done":
+            url = self.future.result()
+            if isinstance(url, dict):
+                # A job rendering several formats
+                result["urls"] = {file_format: u for file_format, u in url.items() if u != "error"}
+                failed = [file_format for file_format, u in url.items() if u == "error"]
+                if failed:
+                    result["error"] = f"Something went wrong with the {', '.join(failed)} file"
+            elif url != "error":
+                result["url"] = url
+            else:
+                result["error"] = "Something went wrong with the file"
+        elif self.future.cancelled():
+            result["error"] = "The render was cancelled"
+        elif self.status == "failed":
+            result["error"] = str(self.future.exception())
+        return result
+
+
+class StoredJob:
+    """A job owned by another worker, as last recorded in the job store"""
+
+    def __init__(self, record: dict):
+        self.id = record["jobId"]
+        self.record = record
+
+    @property
+    def status(self) -> str:
+        return self.record["status"]
+
+    def to_dict(self) -> dict:
+        return {k: v for k, v in self.record.items() if k not in ("pid", "savedAt")}
+
+
+class JobQueue:
+    def __init__(
+        self,
+        max_workers: int = RENDER_JOB_WORKERS,
+        max_pending: int = RENDER_JOB_QUEUE_LIMIT,
+        name: str = "render",
+        niceness: int = 0,
+    ):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.name = name
+        self.niceness = niceness
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._jobs: Dict[str, Job] = {}
+        self._in_flight: Dict[str, Job] = {}
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        metrics.register_collector(self._collect_stats)
+
+    def pending(self) -> int:
+        with self._lock:
+            return len(self._in_flight)
+
+    def submit(self, file_format: str, section_data, note_bpms, instrument_vals=None, options: AudioOptions = None) -> Job:
+        """Queues a render, or returns the existing job if an identical one is already queued or
+        running. Raises QueueFullError if too many jobs are pending"""
+        return self.submit_many([(file_format, section_data, note_bpms, instrument_vals, options)])[0]
+
+    def submit_formats(
+        self, file_formats: List[str], section_data, note_bpms, instrument_vals=None, options: AudioOptions = None
+    ) -> Job:
+        """Queues a render encoded into each of the audio formats, see render_and_upload_formats"""
+        render = (file_formats, section_data, note_bpms, instrument_vals, options)
+        return self.submit_task(formats_key(*render), render_and_upload_formats, *render)
+
+    def submit_many(self, renders: List[Tuple]) -> List[Job]:
+        """Queues renders given as (file_format, section_data, note_bpms, instrument_vals) and
+        optionally options, like submit, returning a job for each. Either all of them are queued or, if there isn't room
+        for all of them, none are and QueueFullError is raised"""
+        return self._submit_tasks([(render_key_for(*render), render_and_upload, *render) for render in renders])
+
+    def submit_task(self, key: str, fn: Callable[..., Union[str, Dict[str, str]]], *args) -> Job:
+        """Queues fn(*args), which returns a url or a url per format, sharing the job with any queued or running task
+        with the same key"""
+        return self._submit_tasks([(key, fn, *args)])[0]
+
+    def _submit_tasks(self, tasks: List[Tuple]) -> List[Job]:
+        new_jobs = []
+        with self._lock:
+            self._prune()
+            new_keys = {key for key, *_ in tasks if key not in self._in_flight}
+            pending = max(len(self._in_flight), job_store.pending(self.name))
+            if new_keys and pending + len(new_keys) > self.max_pending:
+                metrics.inc(JOBS, len(tasks), queue=self.name, result="rejected")
+                raise QueueFullError(f"{pending} renders are already pending")
+
+            jobs = []
+            for key, *args in tasks:
+                if key not in self._in_flight:
+                    # Recorded before it is queued, so that it can't start running first
+                    job_id = uuid.uuid4().hex
+                    job_store.save(job_id, {"jobId": job_id, "status": "queued"})
+                    job_store.add_pending(self.name, job_id)
+                    job = Job(key, self._submit_to_pool([job_id, *args]), job_id)
+                    self._jobs[job.id] = job
+                    self._in_flight[key] = job
+                    new_jobs.append(job)
+                else:
+                    metrics.inc(JOBS, queue=self.name, result="shared")
+                jobs.append(self._in_flight[key])
+        for job in new_jobs:
+            job.future.add_done_callback(lambda _, job=job: self._finished(job))
+        return jobs
+
+    def _submit_to_pool(self, args: List) -> Future:
+        metrics.inc(JOBS, queue=self.name, result="queued")
+        try:
+            return TaskFuture(self._pool().submit(run_task, *args))
+        except BrokenProcessPool:
+            # A worker died (e.g. was OOM killed), start a fresh pool
+            log("Render pool was broken, restarting it")
+            self._executor = None
+            return TaskFuture(self._pool().submit(run_task, *args))
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def wait(self, job: Union[Job, StoredJob], timeout: float) -> Union[Job, StoredJob]:
+        """Blocks until the job is finished or the timeout passes"""
+        if isinstance(job, StoredJob):
+            record = job_store.wait(job.id, timeout, lambda record: record["status"] in FINISHED)
+            if record is not None:
+                job.record = record
+            return job
+        try:
+            job.future.exception(timeout=timeout)
+        except TimeoutError:
+            pass
+        return job
+
+    def _pool(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            if self.niceness:
+                self._executor = ProcessPoolExecutor(self.max_workers, initializer=os.nice, initargs=(self.niceness,))
+            else:
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+        return self._executor
+
+    def _finished(self, job: Job) -> None:
+        if job.future.exception() is not None:
+            result = "failed"
+        else:
+            urls = job.future.result()
+            failed = "error" in urls.values() if isinstance(urls, dict) else urls == "error"
+            result = "upload_failed" if failed else "done"
+        metrics.inc(JOBS, queue=self.name, result=result)
+        job_store.save(job.id, job.to_dict())
+        job_store.remove_pending(self.name, job.id)
+        with self._lock:
+            if self._in_flight.get(job.key) is job:
+                del self._in_flight[job.key]
+
+    def _collect_stats(self) -> None:
+        # Only the process which made the queue has its jobs, pool processes have a stale copy
+        if os.getpid() == self._pid:
+            metrics.set("clicktrack_jobs_pending", self.pending(), queue=self.name)
+
+    def _prune(self) -> None:
+        cutoff = time.time() - RENDER_JOB_RETENTION
+        expired: List[str] = [
+            job_id for job_id, job in self._jobs.items() if job.future.done() and job.submitted_at < cutoff
+        ]
+        for job_id in expired:
+            del self._jobs[job_id]
+        job_store.prune()
+
+
+class RenderLanes:
+    """Sends each render to the fast or heavy lane's queue by its estimated cost, refusing those
+    too big to render"""
+
+    def __init__(self, fast: JobQueue, heavy: JobQueue):
+        self.fast = fast
+        self.heavy = heavy
+
+    def lane(self, cost: RenderCost) -> JobQueue:
+        """The queue for a render, raising RenderTooLargeError if it is too big"""
+        cost.check()
+        return self.heavy if cost.heavy else self.fast
+
+    def submit(self, file_format: str, section_data, note_bpms, instrument_vals=None, options: AudioOptions = None) -> Job:
+        """Queues a render on its lane, see JobQueue.submit. Raises ValueError if the payload
+        isn't a clicktrack and RenderTooLargeError if it is too big"""
+        cost = estimate_cost([file_format], section_data, note_bpms, instrument_vals)
+        return self.lane(cost).submit(file_format, section_data, note_bpms, instrument_vals, options)
+
+    def submit_formats(
+        self, file_formats: List[str], section_data, note_bpms, instrument_vals=None, options: AudioOptions = None
+    ) -> Job:
+        cost = estimate_cost(file_formats, section_data, note_bpms, instrument_vals)
+        return self.lane(cost).submit_formats(file_formats, section_data, note_bpms, instrument_vals, options)
+
+    def submit_loops(
+        self, file_format: str, section_data, note_bpms, instrument_vals=None, options: AudioOptions = None
+    ) -> Job:
+        """Queues the clicktrack split into loops, see render_loop_manifest. The whole clicktrack
+        must be small enough to render, but the lane is picked by the cost of the segments' audio.
+        Raises ValueError if it can't be split into loops"""
+        estimate_cost([file_format], section_data, note_bpms, instrument_vals).check()
+        segments = find_segments(section_data, note_bpms, instrument_vals)
+        cost = estimate_cost(
+            [file_format],
+            [section for segment in segments for section in segment.section_data],
+            [bpm for segment in segments for bpm in segment.note_bpms],
+            instrument_vals,
+        )
+        key = loops_key(file_format, section_data, note_bpms, instrument_vals, options)
+        return self.lane(cost).submit_task(key, render_loop_manifest, file_format, segments, instrument_vals, options)
+
+    def get(self, job_id: str) -> Optional[Union[Job, StoredJob]]:
+        """The job, whichever worker it was submitted to"""
+        job = self.fast.get(job_id) or self.heavy.get(job_id)
+        if job is None:
+            record = job_store.load(job_id)
+            job = StoredJob(record) if record is not None and "jobId" in record else None
+        return job
+
+    def wait(self, job: Union[Job, StoredJob], timeout: float) -> Union[Job, StoredJob]:
+        return self.fast.wait(job, timeout)
+
+
+job_queue = RenderLanes(
+    JobQueue(RENDER_JOB_WORKERS, RENDER_JOB_QUEUE_LIMIT, "fast"),
+    JobQueue(HEAVY_JOB_WORKERS, HEAVY_JOB_QUEUE_LIMIT, "heavy", HEAVY_JOB_NICENESS),
+)
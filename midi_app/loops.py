@@ -0,0 +1,129 @@
+"""Splits clicktracks into loops, for clients which can play a loop rather than download all of it.
+
+Most clicktracks are long runs of the same measure at one tempo. find_segments splits a
+clicktrack into segments, each either a loop, a run of at least LOOP_MIN_REPEATS identical
+measures (same time signatures and accents, and one tempo throughout) or the measures between
+loops, played once. A loop's audio is its measure played on its own, so a ten minute clicktrack
+at one tempo comes down to a couple of seconds of audio.
+
+A loop manifest lists each segment's audio along with where it starts and how often it repeats,
+in samples. Copy k of a segment starts at round(start + k * period), from the exact start and
+period, so rounding never drifts however long the loop is, and every click is within a sample of
+where it would be in the clicktrack rendered whole. Each copy is mixed with those around it, as
+the tail of a measure's last click rings on into the next.
+
+Like section_renderer.py, this relies on every part of the clicktrack sounding the same as it
+would on its own, which isn't so for some polyrhythms (see can_render_sections).
+"""
+import os
+from fractions import Fraction
+from typing import List, Optional
+
+import numpy as np
+
+from .instruments import all_instruments
+from .section_renderer import can_render_sections
+from .timeline import TICKS_PER_QUARTER, build_timeline, conductor_tempos, round_ticks, ticks_to_seconds
+
+# Fewest identical measures in a row which are made a loop
+LOOP_MIN_REPEATS = int(os.environ.get("LOOP_MIN_REPEATS", 2))
+
+
+class Segment:
+    """A stretch of the clicktrack, section_data and note_bpms being the payload of its audio,
+    which is played repeats times, period seconds apart, from start seconds"""
+
+    def __init__(self, section_data: List[dict], note_bpms: List[int], start: float, period: float, repeats: int):
+        self.section_data = section_data
+        self.note_bpms = note_bpms
+        self.start = start
+        self.period = period
+        self.repeats = repeats
+
+    def to_dict(self, url: str, sample_rate: int) -> dict:
+        return {
+            "url": url,
+            "start": round(self.start * sample_rate, 6),
+            "period": round(self.period * sample_rate, 6),
+            "repeats": self.repeats,
+        }
+
+
+def _measure_key(section: dict, bpms: List[int]) -> Optional[tuple]:
+    """What a measure sounds like, or None if its tempo changes part way through"""
+    if any(bpm != bpms[0] for bpm in bpms):
+        return None
+    rhythms = tuple((tuple(r["timeSig"]), tuple(r["accentedBeats"])) for r in section["rhythms"])
+    return rhythms, bpms[0]
+
+
+def _payload(measures: List[tuple], note_bpms: List[int]) -> tuple:
+    """The sections and bpms of consecutive measures, given as (section index, section, first beat)"""
+    sections, bpms = [], []
+    for idx, (section_idx, section, beat) in enumerate(measures):
+        numerator = section["rhythms"][0]["timeSig"][0]
+        if idx and measures[idx - 1][0] == section_idx:
+            sections[-1]["overallData"]["numMeasures"] += 1
+        else:
+            sections.append({**section, "overallData": {**section["overallData"], "numMeasures": 1}})
+        bpms += note_bpms[beat:beat + numerator]
+    return sections, bpms
+
+
+def find_segments(section_data: List[dict], note_bpms: List[int], instrument_vals: List[str]) -> List[Segment]:
+    """Splits the clicktrack into loops and the measures between them. Raises ValueError if it
+    can't be split"""
+    try:
+        instruments = [all_instruments[iv] for iv in instrument_vals]
+    except (KeyError, TypeError):
+        raise ValueError("instruments must be a list of known instruments")
+    if not can_render_sections(section_data, instruments):
+        raise ValueError("Clicktracks with these polyrhythms can't be split into loops")
+
+    # (section index, section, first beat) of every measure, and the tick each one starts at
+    measures, keys, starts = [], [], []
+    beat, offset = 0, Fraction(0)
+    for section_idx, section in enumerate(section_data):
+        numerator, denominator = section["rhythms"][0]["timeSig"]
+        for _ in range(section["overallData"]["numMeasures"]):
+            measures.append((section_idx, section, beat))
+            keys.append(_measure_key(section, note_bpms[beat:beat + numerator]))
+            starts.append(round_ticks(offset.numerator * TICKS_PER_QUARTER, offset.denominator))
+            beat += numerator
+            offset += Fraction(4 * numerator, denominator)
+    starts.append(round_ticks(offset.numerator * TICKS_PER_QUARTER, offset.denominator))
+    timeline = build_timeline(section_data, note_bpms, separate_instruments=len(instruments) > 1)
+    seconds = ticks_to_seconds(np.array(starts, dtype=np.int64), conductor_tempos(timeline.tracks[0][0])).tolist()
+
+    segments = []
+    once_from = 0  # First measure not yet in a segment
+
+    def add(first: int, stop: int, repeats: int) -> None:
+        section_data, bpms = _payload(measures[first:first + (1 if repeats > 1 else stop - first)], note_bpms)
+        segments.append(Segment(section_data, bpms, seconds[first], (seconds[stop] - seconds[first]) / repeats, repeats))
+
+    idx = 0
+    while idx < len(measures):
+        run_end = idx + 1
+        while keys[idx] is not None and run_end < len(measures) and keys[run_end] == keys[idx]:
+            run_end += 1
+        if run_end - idx >= LOOP_MIN_REPEATS:
+            if once_from < idx:
+                add(once_from, idx, 1)
+            add(idx, run_end, run_end - idx)
+            once_from = run_end
+        idx = run_end
+    if once_from < len(measures):
+        add(once_from, len(measures), 1)
+    return segments
+
+
+def loop_manifest(segments: List[Segment], urls: List[str], file_format: str, sample_rate: int) -> dict:
+    """The manifest of a clicktrack split into segments, given the url of each one's audio"""
+    end = segments[-1].start + segments[-1].period * segments[-1].repeats if segments else 0
+    return {
+        "format": file_format,
+        "sampleRate": sample_rate,
+        "length": round(end * sample_rate, 6),
+        "segments": [segment.to_dict(url, sample_rate) for segment, url in zip(segments, urls)],
+    }
@@ -0,0 +1,192 @@
+"""Assembles WAV files in place, in a file of the exact size mapped into memory.
+
+A WAV's size is known as soon as the length of its audio is, so the whole file (its header and
+data) is allocated up front and memory mapped, and each block of audio is converted to PCM
+straight into its place in the file. Nothing of the file is ever held on the Python heap, and
+once a block has been written the pages behind it are dropped from the process (they are still
+in the page cache), so its memory use doesn't grow with the length of the track. The finished
+file is handed over by name, so the render cache takes it with a rename.
+
+The file can also be written on a background thread while a MappedWavStream reads it back through
+a file of its own, so that it is uploaded as it is rendered.
+"""
+import io
+import mmap
+import os
+import threading
+from typing import Iterable, Optional
+
+import numpy as np
+
+from .encoding import CHUNK_FRAMES, SAMPLE_WIDTH, pcm_into, wav_header
+from .metrics import span, start_thread
+
+
+class MappedWav:
+    """A PCM WAV file of a known length being written in place"""
+
+    def __init__(self, filename: str, frames: int, channels: int, sample_rate: int, sample_width: int = SAMPLE_WIDTH):
+        self.filename = filename
+        self.frames = frames
+        self.channels = channels
+        self.sample_width = sample_width
+        header = wav_header(frames, channels, sample_rate, sample_width)
+        self._header_size = len(header)
+        self.size = self._header_size + frames * channels * sample_width
+        with open(filename, "w+b") as f:
+            f.truncate(self.size)
+            self._mmap = mmap.mmap(f.fileno(), self.size)
+        self._mmap[:self._header_size] = header
+        data = np.frombuffer(self._mmap, dtype=np.uint8, offset=self._header_size)
+        if sample_width == 2:
+            self._pcm = data.view("<i2").reshape(frames, channels)
+        else:
+            self._pcm = data.reshape(frames, channels, sample_width)
+        self._released = 0
+        # How much of the file has been written from its start, and whether writing has stopped
+        self._written = self._header_size
+        self._finished = False
+        self._error: Optional[BaseException] = None
+        self._progress = threading.Condition()
+
+    def write(self, start: int, block: np.ndarray) -> None:
+        """Writes float32 audio of shape (samples, channels) from frame start, mixing it down to
+        mono if the file is mono"""
+        if self.channels == 1 and block.shape[1] != 1:
+            block = block.mean(axis=1, dtype=np.float32, keepdims=True)
+        for offset in range(0, len(block), CHUNK_FRAMES):
+            chunk = block[offset:offset + CHUNK_FRAMES]
+            with span("encode_wav"):
+                pcm_into(chunk, self._pcm[start + offset:start + offset + len(chunk)], self.sample_width)
+
+    def write_blocks(self, blocks: Iterable[np.ndarray]) -> None:
+        """Writes consecutive blocks from the start of the audio, dropping each one's pages from
+        the process once it is written"""
+        position = 0
+        try:
+            for block in blocks:
+                self.write(position, block)
+                position += len(block)
+                written = self._header_size + position * self.channels * self.sample_width
+                self._release(written)
+                with self._progress:
+                    self._written = written
+                    self._progress.notify_all()
+            if position != self.frames:
+                raise ValueError(f"Expected {self.frames} frames of audio, got {position}")
+        except BaseException as e:
+            self._finish(e)
+            raise
+        self._finish()
+
+    def stream(self, blocks: Iterable[np.ndarray]) -> "MappedWavStream":
+        """Writes the blocks on a background thread, then closes the file, returning a stream of
+        the file which can be read while it is being written"""
+        stream = MappedWavStream(self)
+        start_thread(self._write_and_close, blocks)
+        return stream
+
+    def _write_and_close(self, blocks: Iterable[np.ndarray]) -> None:
+        try:
+            with self:
+                self.write_blocks(blocks)
+        except Exception:
+            pass  # Raised by the stream's reads instead
+
+    def _finish(self, error: BaseException = None) -> None:
+        with self._progress:
+            self._finished = True
+            self._error = error
+            self._progress.notify_all()
+
+    def wait_for(self, end: int) -> None:
+        """Waits until the file has been written up to the end offset, raising the error writing
+        it failed with if it never will be"""
+        with self._progress:
+            while self._written < end and not self._finished:
+                self._progress.wait()
+            if self._written < end:
+                raise self._error or ValueError("The file was never written")
+
+    def wait_finished(self) -> bool:
+        """Waits until writing has stopped, returning whether the whole file was written"""
+        with self._progress:
+            while not self._finished:
+                self._progress.wait()
+            return self._error is None
+
+    def _release(self, end: int) -> None:
+        """Drops the pages before end from the process's memory. The mapping is shared, so what was
+        written to them is kept in the page cache and written back to the file"""
+        end -= end % mmap.PAGESIZE
+        if end > self._released:
+            self._mmap.madvise(mmap.MADV_DONTNEED, self._released, end - self._released)
+            self._released = end
+
+    def close(self) -> None:
+        if self._mmap.closed:
+            return
+        # The arrays are views of the mapping, which can't be closed while they exist
+        self._pcm = None
+        self._mmap.flush()
+        self._mmap.close()
+
+    def __enter__(self) -> "MappedWav":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+        if exc_info[0] is not None:
+            try:
+                os.remove(self.filename)
+            except FileNotFoundError:
+                pass
+
+
+class MappedWavStream(io.RawIOBase):
+    """Read only stream of a MappedWav's file while it is written on another thread. Reads wait
+    for the part of the file they cover to be written. Its size is known up front, so it can be
+    sought, e.g. by cloudinary's chunked upload to find the size"""
+
+    def __init__(self, wav: MappedWav):
+        self.filename = wav.filename
+        self.size = wav.size
+        self._wav = wav
+        self._file = open(wav.filename, "rb")
+
+    def complete(self) -> bool:
+        """Waits until the file has been written, returning whether all of it was, in which case
+        it can be moved into place"""
+        return self._wav.wait_finished()
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._file.tell()
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        return self._file.seek(offset, whence)
+
+    def read(self, size: int = -1) -> bytes:
+        start = self._file.tell()
+        end = self.size if size is None or size < 0 else min(start + size, self.size)
+        if end <= start:
+            return b""
+        self._wav.wait_for(end)
+        return self._file.read(end - start)
+
+    def readall(self) -> bytes:
+        return self.read()
+
+    def readinto(self, b) -> int:
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def close(self) -> None:
+        self._file.close()
+        super().close()
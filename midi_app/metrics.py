@@ -0,0 +1,321 @@
+"""Lightweight instrumentation: counters, gauges and histograms served as Prometheus text from
+/metrics, and spans which time the stages of each request.
+
+Wrapping a stage in span(name) records its duration in the clicktrack_stage_seconds histogram
+and, within a trace (a request, or a task on the render pool), adds it to the trace's per stage
+totals, which are logged as one JSON line when the trace ends. Spans cost a couple of clock reads
+and a dict update, so are cheap enough to leave on everywhere.
+
+Renders run on process pools, so each task's metrics are sent back with its result and merged in
+(see jobs.py). gunicorn workers share theirs by writing them to METRICS_DIR every few seconds,
+and /metrics adds up those of every live worker. Gauges, mostly cache stats, are collected when
+the metrics are read and labelled with the pid of their process, and those of processes which have
+exited, such as replaced pool workers, are dropped.
+"""
+import contextvars
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from .log import log
+
+# Shared by the gunicorn workers, unset to only report on the process serving /metrics
+METRICS_DIR = os.environ.get("METRICS_DIR", "metrics") or None
+METRICS_FLUSH_SECONDS = float(os.environ.get("METRICS_FLUSH_SECONDS", 5))
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 60)
+
+REQUEST_SECONDS = "clicktrack_request_seconds"
+STAGE_SECONDS = "clicktrack_stage_seconds"
+CACHE_LOOKUPS = "clicktrack_cache_lookups_total"
+SUBPROCESS_FAILURES = "clicktrack_subprocess_failures_total"
+JOBS = "clicktrack_jobs_total"
+SYNTH_INSTANCES = "clicktrack_synth_instances_total"
+
+DESCRIPTIONS = {
+    REQUEST_SECONDS: ("histogram", "Time to serve a request, including streaming its response"),
+    STAGE_SECONDS: ("histogram", "Time spent in each stage of a render"),
+    CACHE_LOOKUPS: ("counter", "Cache lookups by cache and whether they hit"),
+    SUBPROCESS_FAILURES: ("counter", "Subprocesses which exited with an error"),
+    JOBS: ("counter", "Render jobs by what became of them"),
+    SYNTH_INSTANCES: ("counter", "Pooled synthesisers created, and discarded by reason"),
+    "clicktrack_cache_entries": ("gauge", "Entries in each in memory cache"),
+    "clicktrack_cache_bytes": ("gauge", "Bytes held by each in memory cache"),
+    "clicktrack_cache_evictions": ("gauge", "Entries evicted from each in memory cache"),
+    "clicktrack_jobs_pending": ("gauge", "Render jobs queued or running"),
+    "clicktrack_synth_pool_instances": ("gauge", "Pooled synthesisers, busy or idle"),
+    "clicktrack_expiry_pending": ("gauge", "Uploads waiting to be deleted"),
+    "clicktrack_expiry_deleted": ("gauge", "Uploads deleted"),
+    "clicktrack_expiry_failed": ("gauge", "Upload deletions which failed and were retried"),
+}
+
+Key = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+
+def _key(name: str, labels: dict) -> Key:
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+class Metrics:
+    def __init__(self):
+        self._counters: Dict[Key, float] = {}
+        self._histograms: Dict[Key, List[float]] = {}  # Bucket counts, then the sum
+        self._gauges: Dict[Key, float] = {}
+        self._collectors: List[Callable[[], None]] = []
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, amount: float = 1, **labels) -> None:
+        key = _key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = _key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * (len(BUCKETS) + 2)
+            for idx, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    histogram[idx] += 1
+                    break
+            else:
+                histogram[len(BUCKETS)] += 1
+            histogram[-1] += value
+
+    def set(self, name: str, value: float, **labels) -> None:
+        with self._lock:
+            self._gauges[_key(name, {**labels, "pid": os.getpid()})] = value
+
+    def register_collector(self, collect: Callable[[], None]) -> None:
+        """Adds a function which sets gauges, called whenever the metrics are read"""
+        self._collectors.append(collect)
+
+    def snapshot(self) -> dict:
+        """The metrics as plain data, which can be pickled or written as JSON and merged in
+        elsewhere"""
+        for collect in self._collectors:
+            collect()
+        with self._lock:
+            self._drop_dead_gauges()
+            return {
+                kind: [[name, list(labels), value] for (name, labels), value in values.items()]
+                for kind, values in (("counters", self._counters), ("histograms", self._histograms), ("gauges", self._gauges))
+            }
+
+    def _drop_dead_gauges(self) -> None:
+        """Drops the gauges labelled with the pids of processes which have exited"""
+        pids = {dict(labels).get("pid") for _, labels in self._gauges}
+        dead = {pid for pid in pids if pid is not None and int(pid) != os.getpid() and not _is_alive(int(pid))}
+        if dead:
+            self._gauges = {key: value for key, value in self._gauges.items() if dict(key[1]).get("pid") not in dead}
+
+    def merge(self, snapshot: dict) -> None:
+        """Adds the counts of another process' snapshot to these, and takes its gauges"""
+        with self._lock:
+            for name, labels, value in snapshot["counters"]:
+                key = (name, tuple(map(tuple, labels)))
+                self._counters[key] = self._counters.get(key, 0) + value
+            for name, labels, value in snapshot["histograms"]:
+                key = (name, tuple(map(tuple, labels)))
+                histogram = self._histograms.setdefault(key, [0] * len(value))
+                for idx, count in enumerate(value):
+                    histogram[idx] += count
+            for name, labels, value in snapshot["gauges"]:
+                self._gauges[(name, tuple(map(tuple, labels)))] = value
+
+    def reset(self) -> None:
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+            self._gauges.clear()
+
+    def render(self) -> str:
+        """The metrics in the Prometheus text format"""
+        with self._lock:
+            samples: Dict[str, List[str]] = {}
+            for (name, labels), value in sorted(self._counters.items()):
+                samples.setdefault(name, []).append(f"{name}{_labels(labels)} {value:g}")
+            for (name, labels), value in sorted(self._gauges.items()):
+                samples.setdefault(name, []).append(f"{name}{_labels(labels)} {value:g}")
+            for (name, labels), histogram in sorted(self._histograms.items()):
+                lines = samples.setdefault(name, [])
+                cumulative = 0
+                for bound, count in zip((*BUCKETS, "+Inf"), histogram):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_labels(labels + (('le', str(bound)),))} {cumulative:g}")
+                lines.append(f"{name}_sum{_labels(labels)} {histogram[-1]:g}")
+                lines.append(f"{name}_count{_labels(labels)} {cumulative:g}")
+
+        output = []
+        for name in sorted(samples):
+            kind, description = DESCRIPTIONS.get(name, ("untyped", name))
+            output += [f"# HELP {name} {description}", f"# TYPE {name} {kind}", *samples[name]]
+        return "\n".join(output) + "\n"
+
+
+def _labels(labels) -> str:
+    if not labels:
+        return ""
+    escaped = (f'{k}="{_escape(v)}"' for k, v in labels)
+    return "{" + ",".join(escaped) + "}"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+metrics = Metrics()
+
+
+class Trace:
+    """Total time spent in each stage of one request or task, added to by spans on any thread
+    it has handed its context to"""
+
+    def __init__(self, name: str, **fields):
+        self.name = name
+        self.fields = fields
+        self.stages: Dict[str, float] = {}
+        self.start = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def add(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            self.stages[stage] = self.stages.get(stage, 0) + seconds
+
+    def log(self, **fields) -> None:
+        with self._lock:
+            stages = {stage: round(seconds, 4) for stage, seconds in self.stages.items()}
+        seconds = round(time.perf_counter() - self.start, 4)
+        log(json.dumps({"event": self.name, **self.fields, **fields, "seconds": seconds, "stages": stages}))
+
+
+_trace: contextvars.ContextVar = contextvars.ContextVar("trace", default=None)
+
+
+def start_trace(name: str, **fields) -> Tuple[Trace, contextvars.Token]:
+    trace = Trace(name, **fields)
+    return trace, _trace.set(trace)
+
+
+def end_trace(token: contextvars.Token) -> None:
+    try:
+        _trace.reset(token)
+    except ValueError:
+        # Ended from another context, e.g. when a streamed response is closed
+        _trace.set(None)
+
+
+@contextmanager
+def trace(name: str, **fields) -> Iterator[Trace]:
+    """Collects the stages of everything run within it, logging them at the end"""
+    current, token = start_trace(name, **fields)
+    try:
+        yield current
+    finally:
+        end_trace(token)
+        current.log()
+
+
+@contextmanager
+def span(stage: str) -> Iterator[None]:
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        metrics.observe(STAGE_SECONDS, seconds, stage=stage)
+        current = _trace.get()
+        if current is not None:
+            current.add(stage, seconds)
+
+
+def start_thread(target: Callable, *args) -> threading.Thread:
+    """Starts a daemon thread running target(*args) in the current context, so that its spans
+    count towards the current trace"""
+    thread = threading.Thread(target=contextvars.copy_context().run, args=(target, *args), daemon=True)
+    thread.start()
+    return thread
+
+
+class _SharedMetrics:
+    """Writes this process' metrics to METRICS_DIR every METRICS_FLUSH_SECONDS and reads every
+    live process' back"""
+
+    def __init__(self, directory: Optional[str], interval: float):
+        self.directory = directory
+        self.interval = interval
+        self._pid: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def start(self) -> None:
+        """Starts writing this process' metrics, once per process as forked children don't
+        inherit the thread"""
+        if self.directory is None:
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+        os.makedirs(self.directory, exist_ok=True)
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self) -> None:
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.write()
+            except OSError as e:
+                log(f"Failed to write metrics: {e}")
+
+    def write(self) -> None:
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(metrics.snapshot(), f)
+        os.replace(tmp_path, os.path.join(self.directory, f"{os.getpid()}.json"))
+
+    def combined(self) -> Metrics:
+        """This process' metrics plus the last written by every other live process"""
+        combined = Metrics()
+        combined.merge(metrics.snapshot())
+        if self.directory is None or not os.path.isdir(self.directory):
+            return combined
+        for filename in os.listdir(self.directory):
+            pid, ext = os.path.splitext(filename)
+            if ext != ".json" or not pid.isdigit() or int(pid) == os.getpid():
+                continue
+            path = os.path.join(self.directory, filename)
+            if not _is_alive(int(pid)):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                continue
+            try:
+                with open(path) as f:
+                    combined.merge(json.load(f))
+            except (FileNotFoundError, ValueError):
+                continue
+        return combined
+
+
+def _is_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+shared_metrics = _SharedMetrics(METRICS_DIR, METRICS_FLUSH_SECONDS)
+
+
+def render_metrics() -> str:
+    """Every live process' metrics in the Prometheus text format"""
+    return shared_metrics.combined().render()
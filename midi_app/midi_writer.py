@@ -0,0 +1,124 @@
+"""Builds clicktrack midi files straight from the request metadata.
+
+Rather than building a music21 stream with a Note and a Rest per click and letting music21 walk the
+object graph, the clicks, tempo changes and time signatures are worked out as arrays (see
+timeline.py) and serialised to standard midi file bytes. The output is byte for byte what music21
+(v7) writes for the streams built by the make_section* helpers kept in
+benchmarks/music21_sections.py, including its quirks, so the synthesised audio does not change.
+"""
+from fractions import Fraction
+from typing import List
+
+import numpy as np
+
+from .timeline import (
+    TICKS_PER_QUARTER,
+    ClickLane,
+    Timeline,
+    build_timeline,
+    conductor_tempos,
+    first_per_offset,
+)
+
+
+def _var_len(value: int) -> bytes:
+    """Encodes a midi variable length quantity"""
+    result = [value & 0x7F]
+    value >>= 7
+    while value:
+        result.append(0x80 | (value & 0x7F))
+        value >>= 7
+    return bytes(reversed(result))
+
+
+def _events_bytes(ticks: np.ndarray, events: np.ndarray, lengths: np.ndarray = None) -> bytes:
+    """Serialises events, given as their sorted absolute ticks and an array with a row of bytes
+    per event, of which only the first lengths bytes are used if given, prefixing each event with
+    the delta time since the one before as a variable length quantity"""
+    deltas = np.diff(ticks.astype(np.int64), prepend=0)
+    # Up to four bytes of seven bits each, most significant first, all but the last flagged with 0x80
+    shifts = np.array([21, 14, 7, 0])
+    groups = ((deltas[:, None] >> shifts) & 0x7F) | np.array([0x80, 0x80, 0x80, 0])
+    sizes = 1 + (deltas >= 1 << 7) + (deltas >= 1 << 14) + (deltas >= 1 << 21)
+    rows = np.hstack([groups, events]).astype(np.uint8)
+    if lengths is None:
+        used = np.ones(events.shape, dtype=bool)
+    else:
+        used = np.arange(events.shape[1]) < lengths[:, None]
+    return rows[np.hstack([np.arange(4) >= 4 - sizes[:, None], used])].tobytes()
+
+
+def _track_chunk(data: bytes) -> bytes:
+    """Wraps serialised events in an MTrk chunk, finishing with music21's end of track a quarter
+    note after the last event"""
+    data += _var_len(TICKS_PER_QUARTER) + b"\xff\x2f\x00"
+    return b"MTrk" + len(data).to_bytes(4, "big") + data
+
+
+def conductor_track(lane: ClickLane) -> bytes:
+    tempo_ticks, mspq = conductor_tempos(lane)
+    time_sigs = first_per_offset(lane.time_sigs) or [(Fraction(0), [4, 4])]
+    time_sig_ticks = np.array([round(offset * TICKS_PER_QUARTER) for offset, _ in time_sigs], dtype=np.int64)
+
+    # Tempos (ff 51 03 and three bytes of microseconds per quarter) sort before time signatures
+    # (ff 58 04 and four bytes) at the same tick
+    tempos = np.column_stack([
+        np.full((len(mspq), 3), [0xFF, 0x51, 0x03]),
+        (mspq[:, None] >> np.array([16, 8, 0])) & 0xFF,
+        np.zeros(len(mspq), dtype=np.int64),
+    ])
+    signatures = np.array(
+        [[0xFF, 0x58, 0x04, numerator, denominator.bit_length() - 1, 24, 8] for _, (numerator, denominator) in time_sigs]
+    )
+    ticks = np.concatenate([tempo_ticks, time_sig_ticks])
+    kinds = np.concatenate([np.zeros(len(tempo_ticks)), np.ones(len(time_sig_ticks))])
+    order = np.lexsort((np.arange(len(ticks)), kinds, ticks))
+    events = np.vstack([tempos, signatures])[order]
+    lengths = np.where(kinds == 0, 6, 7)[order]
+    return _track_chunk(_events_bytes(ticks[order], events, lengths))
+
+
+def note_track(lane: ClickLane) -> bytes:
+    on_ticks, off_ticks, pitches, velocities, _ = lane.notes()
+    data = b"\x00\xff\x03\x00"
+    if not len(on_ticks):
+        return _track_chunk(data)
+    # music21 resets the pitch bend of every channel it plays notes on
+    data += b"\x00\xe0\x00\x40"
+
+    # A note on then a note off per note, note offs sorting before note ons at the same tick and
+    # otherwise keeping the order the notes were added
+    ticks = np.column_stack([on_ticks, off_ticks]).ravel()
+    is_on = np.tile([1, 0], len(on_ticks))
+    order = np.lexsort((np.arange(len(ticks)), is_on, ticks))
+    events = np.column_stack([
+        np.where(is_on, 0x90, 0x80),
+        np.repeat(pitches, 2),
+        np.column_stack([velocities, np.zeros_like(velocities)]).ravel(),
+    ])[order]
+    return _track_chunk(data + _events_bytes(ticks[order], events))
+
+
+def midi_file_bytes(conductor: ClickLane, lanes: List[ClickLane]) -> bytes:
+    """Serialises a format 1 midi file with a conductor track followed by a track per lane"""
+    header = b"MThd" + (6).to_bytes(4, "big") + (1).to_bytes(2, "big")
+    header += (len(lanes) + 1).to_bytes(2, "big") + TICKS_PER_QUARTER.to_bytes(2, "big")
+    return header + conductor_track(conductor) + b"".join(note_track(lane) for lane in lanes)
+
+
+def timeline_midi_bytes(timeline: Timeline) -> List[bytes]:
+    """Returns the contents of the midi file(s) making up the timeline"""
+    return [midi_file_bytes(conductor, lanes) for conductor, lanes in timeline.tracks]
+
+
+def make_midi_bytes(
+    section_data: List[dict],
+    note_bpms: List[int],
+    note_pitch_main: str = "C4",
+    note_pitch_secondary: str = "C4",
+    separate_instruments: bool = False,
+) -> List[bytes]:
+    """Returns the contents of the midi file(s) for the clicktrack, see timeline.Timeline"""
+    return timeline_midi_bytes(
+        build_timeline(section_data, note_bpms, note_pitch_main, note_pitch_secondary, separate_instruments)
+    )
@@ -0,0 +1,113 @@
+"""Optional sampling profiler which keeps profiles of slow requests and render tasks.
+
+Set SLOW_PROFILE_MS to profile every request and task: a background thread samples their stacks
+every PROFILE_INTERVAL_MS, and those that take longer than SLOW_PROFILE_MS have their samples
+written to PROFILE_DIR in the collapsed stack format flamegraph.pl and speedscope read. The rest
+are thrown away. Sampling only walks the stacks of the threads being profiled, so with the default
+interval it costs well under a percent of a core.
+"""
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional
+
+from .log import log
+
+SLOW_PROFILE_MS = float(os.environ.get("SLOW_PROFILE_MS", 0))
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+PROFILE_INTERVAL_MS = float(os.environ.get("PROFILE_INTERVAL_MS", 10))
+
+
+class _Capture:
+    def __init__(self, thread_id: Optional[int]):
+        # None samples every thread in the process, e.g. a render task and its encoder threads
+        self.thread_id = thread_id
+        self.stacks: Counter = Counter()
+
+
+def _collapse(frame) -> str:
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class SamplingProfiler:
+    def __init__(self, threshold_ms: float = SLOW_PROFILE_MS, directory: str = PROFILE_DIR, interval_ms: float = PROFILE_INTERVAL_MS):
+        self.threshold_ms = threshold_ms
+        self.directory = directory
+        self.interval = interval_ms / 1000
+        self._captures: Dict[int, _Capture] = {}
+        self._lock = threading.Lock()
+        self._thread_pid: Optional[int] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.threshold_ms > 0
+
+    def _ensure_thread(self) -> None:
+        """Starts the sampling thread, once per process as forked children don't inherit it"""
+        if self._thread_pid != os.getpid():
+            self._thread_pid = os.getpid()
+            threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self) -> None:
+        own_id = threading.get_ident()
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                captures = list(self._captures.values())
+            if not captures:
+                continue
+            frames = sys._current_frames()
+            for capture in captures:
+                if capture.thread_id is None:
+                    stacks = [_collapse(frame) for thread_id, frame in frames.items() if thread_id != own_id]
+                elif capture.thread_id in frames:
+                    stacks = [_collapse(frames[capture.thread_id])]
+                else:
+                    continue
+                capture.stacks.update(stacks)
+
+    def start(self, all_threads: bool = False) -> Optional[_Capture]:
+        if not self.enabled:
+            return None
+        capture = _Capture(None if all_threads else threading.get_ident())
+        with self._lock:
+            self._ensure_thread()
+            self._captures[id(capture)] = capture
+        return capture
+
+    def finish(self, capture: Optional[_Capture], name: str, elapsed_ms: float) -> Optional[str]:
+        """Stops the capture, writing it out if it was slow. Returns the profile's filename"""
+        if capture is None:
+            return None
+        with self._lock:
+            self._captures.pop(id(capture), None)
+        if elapsed_ms < self.threshold_ms or not capture.stacks:
+            return None
+        os.makedirs(self.directory, exist_ok=True)
+        safe_name = "".join(c if c.isalnum() or c in "-_" else "_" for c in name.strip("/"))
+        filename = os.path.join(self.directory, f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{safe_name}.folded")
+        with open(filename, "w") as f:
+            for stack, count in capture.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        log(f"Profiled slow {name} ({elapsed_ms:.0f}ms) to {filename}")
+        return filename
+
+    @contextmanager
+    def profile(self, name: str, all_threads: bool = False) -> Iterator[None]:
+        capture = self.start(all_threads)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.finish(capture, name, (time.perf_counter() - start) * 1000)
+
+
+profiler = SamplingProfiler()
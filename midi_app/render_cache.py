@@ -0,0 +1,260 @@
+"""Content addressed cache of rendered clicktracks and the urls they were uploaded to.
+
+Requests are keyed by a hash of everything that affects the rendered file, so repeats of popular
+clicktracks are served the url of an earlier upload, or if that has been (or is about to be)
+deleted from cloudinary, a re-upload of the cached file, without rendering anything.
+
+Entries live in RENDER_CACHE_DIR as <key>.<format> with a <key>.json sidecar holding the url and
+upload time, so the cache is shared by all the gunicorn workers in a container. The files'
+modification times double as the last used time for least recently used eviction: a file is
+touched when it is used, and its sidecar when its url is. An entry's file and sidecar are evicted
+together, and a sidecar without a file (e.g. of a render too big to cache) once its url expires.
+"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+from contextlib import contextmanager
+from typing import BinaryIO, Callable, Dict, Iterator, List, Optional, Union
+
+from .file_management import DELETE_TIMEOUT, upload_file
+from .log import log
+from .metrics import CACHE_LOOKUPS, metrics
+
+RENDER_CACHE_DIR = os.environ.get("RENDER_CACHE_DIR", "render_cache")
+RENDER_CACHE_BYTES = int(os.environ.get("RENDER_CACHE_MB", 256)) * 1024 * 1024
+RENDER_CACHE_TTL = int(os.environ.get("RENDER_CACHE_TTL", 24 * 60 * 60))  # Seconds a rendered file is kept
+# Cached urls are only handed out if they have at least this long before cloudinary deletes them
+URL_MIN_LIFETIME = int(os.environ.get("RENDER_CACHE_URL_MIN_LIFETIME", 5 * 60))
+
+
+def _canonical(value):
+    """Makes equal payloads serialise identically, e.g. 120.0 and 120"""
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, dict):
+        return {k: _canonical(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_canonical(v) for v in value]
+    return value
+
+
+def render_key(
+    section_data, note_bpms, instrument_vals, file_format: str, backend: str = None, options: dict = None
+) -> str:
+    """Hash of everything that determines the rendered file. options, how the audio is encoded, is
+    only included when it isn't the default, so that the keys of earlier renders still match"""
+    description = [section_data, note_bpms, instrument_vals, file_format, backend]
+    if options:
+        description.append(options)
+    payload = json.dumps(
+        _canonical(description),
+        sort_keys=True,
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class RenderCache:
+    def __init__(
+        self,
+        directory: str = RENDER_CACHE_DIR,
+        max_bytes: int = RENDER_CACHE_BYTES,
+        ttl: float = RENDER_CACHE_TTL,
+        url_min_lifetime: float = URL_MIN_LIFETIME,
+    ):
+        # Cached files are sent by flask, which resolves relative paths against the app's package
+        # rather than the working directory
+        self.directory = os.path.abspath(directory)
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.url_min_lifetime = url_min_lifetime
+
+    def _path(self, key: str, file_format: str) -> str:
+        return os.path.join(self.directory, f"{key}.{file_format}")
+
+    def _meta_path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get_file(self, key: str, file_format: str) -> Optional[str]:
+        """Returns the path of the cached file, or None if it isn't cached or has expired"""
+        path = self._path(key, file_format)
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                return None
+            os.utime(path)  # Mark as recently used
+        except FileNotFoundError:
+            return None
+        return path
+
+    def get_url(self, key: str) -> Optional[str]:
+        """Returns the url the file was uploaded to, as long as it will be around for a while yet"""
+        try:
+            with open(self._meta_path(key)) as f:
+                meta = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        if time.time() + self.url_min_lifetime > meta["uploaded_at"] + DELETE_TIMEOUT:
+            return None
+        try:
+            os.utime(self._meta_path(key))  # Mark as recently used
+        except FileNotFoundError:
+            pass
+        return meta["url"]
+
+    def set_url(self, key: str, url: str) -> None:
+        self._write_atomic(self._meta_path(key), json.dumps({"url": url, "uploaded_at": time.time()}).encode())
+
+    def put(self, key: str, filename: str, file_format: str) -> str:
+        """Moves a freshly rendered file into the cache and returns its new path"""
+        if os.path.getsize(filename) > self.max_bytes:
+            return filename
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(key, file_format)
+        shutil.move(filename, path)
+        self.evict(keep=path)
+        return path
+
+    @contextmanager
+    def tee(self, key: str, stream: BinaryIO, file_format: str) -> Iterator[BinaryIO]:
+        """Yields a stream reading from the given one which also writes everything read into the
+        cache, so that a render can be cached while it is being uploaded. The file is only added
+        to the cache once the with block exits without an error"""
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix=".")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                yield _TeeStream(stream, f)
+                shutil.copyfileobj(stream, f)  # Anything the reader didn't get to
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        if os.path.getsize(tmp_path) > self.max_bytes:
+            os.remove(tmp_path)
+            return
+        path = self._path(key, file_format)
+        os.replace(tmp_path, path)
+        self.evict(keep=path)
+
+    def evict(self, keep: str = None) -> None:
+        """Deletes expired entries and orphaned sidecars, then the least recently used entries until
+        within the byte budget"""
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return
+        paths_by_key: Dict[str, List[str]] = {}
+        for name in names:
+            if not name.startswith("."):
+                paths_by_key.setdefault(os.path.splitext(name)[0], []).append(os.path.join(self.directory, name))
+
+        now = time.time()
+        entries = []  # (last used, size of its files, key, paths)
+        kept_bytes = 0
+        for key, paths in paths_by_key.items():
+            stats = {}
+            for path in paths:
+                try:
+                    stats[path] = os.stat(path)
+                except FileNotFoundError:
+                    pass
+            last_used = max((stat.st_mtime for stat in stats.values()), default=0)
+            size = sum(stat.st_size for path, stat in stats.items() if not path.endswith(".json"))
+            if keep in paths:
+                kept_bytes += size
+            elif all(path.endswith(".json") for path in paths):
+                # Only a sidecar, which is no use once its url has expired
+                if now - last_used > DELETE_TIMEOUT:
+                    self._remove(paths)
+            elif now - last_used > self.ttl:
+                self._remove(paths)
+            else:
+                entries.append((last_used, size, key, paths))
+
+        total = sum(size for _, size, _, _ in entries) + kept_bytes
+        for _, size, _, paths in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self._remove(paths)
+            total -= size
+
+    def _remove(self, paths: List[str]) -> None:
+        """Removes an entry's file and sidecar"""
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _write_atomic(self, path: str, data: bytes) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix=".")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+
+class _TeeStream:
+    """Reads from a stream, writing whatever is read to a file"""
+
+    def __init__(self, stream: BinaryIO, file: BinaryIO):
+        self.stream = stream
+        self.file = file
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.stream.read(size)
+        self.file.write(data)
+        return data
+
+    def seekable(self) -> bool:
+        return self.stream.seekable()
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        return self.stream.seek(offset, whence)
+
+    def tell(self) -> int:
+        return self.stream.tell()
+
+
+render_cache = RenderCache()
+
+
+def cached_upload(key: str, file_format: str, render: Callable[[], Union[str, BinaryIO]]) -> str:
+    """Returns a url for the clicktrack identified by key, only calling render and uploading if
+    there is no usable cached url or file.
+
+    render returns either the rendered filename or a stream of the file, which is uploaded as it
+    is read and cached at the same time. A stream of a file being written in place, like a
+    mapped_wav.MappedWavStream, is uploaded as it is written and the file is then moved into the
+    cache.
+    """
+    url = render_cache.get_url(key)
+    if url:
+        log(f"Render cache hit for {key}")
+        metrics.inc(CACHE_LOOKUPS, cache="render", result="hit")
+        return url
+
+    path = render_cache.get_file(key, file_format)
+    if path is not None:
+        log(f"Render cache hit for {key}, re-uploading")
+        metrics.inc(CACHE_LOOKUPS, cache="render", result="file_hit")
+        url = upload_file(path, file_format)
+    else:
+        metrics.inc(CACHE_LOOKUPS, cache="render", result="miss")
+        rendered = render()
+        if isinstance(rendered, str):
+            url = upload_file(render_cache.put(key, rendered, file_format), file_format)
+        elif hasattr(rendered, "complete"):
+            with rendered:
+                url = upload_file(rendered, file_format)
+            if rendered.complete():
+                render_cache.put(key, rendered.filename, file_format)
+        else:
+            with render_cache.tee(key, rendered, file_format) as stream:
+                url = upload_file(stream, file_format)
+
+    if url != "error":
+        render_cache.set_url(key, url)
+    return url
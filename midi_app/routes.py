@@ -1,84 +1,66 @@
-from flask import request
+from flask import Response, g, request
 from midi_app import app
-from .audio_processing import (
-    make_midi_file,
-    make_file_with_fluidsynth,
-)
-from .file_management import upload_file
-from .instruments import all_instruments
-
-from .log import log
+from .metrics import REQUEST_SECONDS, end_trace, metrics, render_metrics, shared_metrics, start_trace
+from .profiler import profiler
+from .startup import LazyView
+
 import time
 
+# Requests which are timed but not logged, as they are made every few seconds
+QUIET_ROUTES = ("/", "/metrics")
+
+
+@app.before_request
+def start_request_trace():
+    shared_metrics.start()
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    g.trace, g.trace_token = start_trace("request", method=request.method, route=route)
+    g.profile = profiler.start()
+
+
+@app.after_request
+def finish_request_trace(response: Response) -> Response:
+    """Records the request once its response has been sent, which for a streamed response is
+    only once all of it has been rendered"""
+    request_trace, token, capture = g.trace, g.trace_token, g.profile
+    method, route = request_trace.fields["method"], request_trace.fields["route"]
+
+    def finish():
+        end_trace(token)
+        seconds = time.perf_counter() - request_trace.start
+        metrics.observe(REQUEST_SECONDS, seconds, method=method, route=route, status=response.status_code)
+        if route not in QUIET_ROUTES:
+            request_trace.log(status=response.status_code)
+        profiler.finish(capture, f"{method} {route}", seconds * 1000)
+
+    response.call_on_close(finish)
+    return response
+
+
 # Health check to quickly verify if the API is running or not
 @app.route("/", methods=["GET", "POST"])
 def home():
     return {"marco": "polo"}
 
 
-@app.route("/api/make_midi", methods=["POST"])
-def make_midi() -> dict:
-    received_time = time.time()
-    
-    data = request.json
-    section_data = data["sectionData"]
-    note_bpms = data["noteBpms"]
-    midi_filename = make_midi_file(section_data, note_bpms)
-    midi_url = upload_file(midi_filename)
-
-    resolved_time = time.time()
-
-    log(f'Request received at {received_time}')
-    log(f'Request resolved at {resolved_time}')
-    log(f'Total MIDI processing time = {resolved_time - received_time}')
-
-    return (
-        {"url": midi_url}
-        if midi_url != "error"
-        else {"error": "Something went wrong with the file"}
-    )
-
-@app.route("/api/make_wav", methods=["POST"])
-def make_wav() -> dict:
-    received_time = time.time()
-    
-    
-    data = request.json
-    section_data = data["sectionData"]
-    note_bpms = data["noteBpms"]
-    instrument_vals = data["instruments"]
-    wav_filename, midi_time_taken, audio_time_taken = make_file_with_fluidsynth(section_data, note_bpms, 'wav', instrument_vals)
-    wav_url = upload_file(wav_filename)
-
-    resolved_time = time.time()
-
-    log(f'Request received at {received_time}')
-    log(f'Request resolved at {resolved_time}')
-    log(f'Total WAV processing time = {resolved_time - received_time}')
-
-    return (
-        {"url": wav_url}
-        if wav_url != "error"
-        else {"error": "Something went wrong with the file"}
-    )
-
-
-@app.route("/api/make_flac", methods=["POST"])
-def make_flac() -> dict:
-    data = request.json
-    section_data = data["sectionData"]
-    note_bpms = data["noteBpms"]
-    instrument_vals = data["instruments"]
-    flac_filename, midi_time_taken, audio_time_taken = make_file_with_fluidsynth(section_data, note_bpms, 'flac', instrument_vals)
-
-    upload_start_time = time.time()
-    flac_url = upload_file(flac_filename)
-    upload_time_taken = time.time() - upload_start_time
-
-    log(f'MIDI: {midi_time_taken}s --- FLAC: {audio_time_taken}s --- UPLOAD: {upload_time_taken}s')
-
-    return (
-        {"url": flac_url}
-        if flac_url != "error"
-        else {"error": "Something went wrong with the file"}
-    )
\ No newline at end of file
+@app.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    """Metrics of every worker in the Prometheus text format"""
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
+
+
+
+def lazy_route(rule: str, name: str, methods) -> None:
+    """Routes rule to views.<name>, which isn't imported until it is first requested"""
+    app.add_url_rule(rule, endpoint=name, view_func=LazyView(name), methods=methods)
+
+
+lazy_route("/api/make_midi", "make_midi", ["POST"])
+lazy_route("/api/make_wav", "make_wav", ["POST"])
+lazy_route("/api/make_flac", "make_flac", ["POST"])
+lazy_route("/api/make_ogg", "make_ogg", ["POST"])
+lazy_route("/api/jobs", "submit_job", ["POST"])
+lazy_route("/api/jobs/<job_id>", "get_job", ["GET"])
+lazy_route("/api/batch", "submit_batch", ["POST"])
+lazy_route("/api/batch/<batch_id>", "get_batch", ["GET"])
+lazy_route("/files/<name>", "stored_file", ["GET"])
@@ -0,0 +1,147 @@
+"""Process wide caches of loaded soundfonts, of the notes rendered from them, and of rendered
+sections of clicktracks (see section_renderer.py).
+
+The cache is warmed when the app is created (see midi_app/__init__.py) with every note the
+instruments in all_instruments can play, so that requests never have to parse a soundfont or
+render a click. When gunicorn preloads the app the warmed cache is inherited by the workers through
+fork, and the soundfonts' sample data is memory mapped so is shared between all processes anyway.
+
+Rendered notes and sections are kept in least recently used caches with byte budgets, so adding
+instruments or rendering lots of clicktracks can't grow worker memory without bound.
+"""
+import os
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Hashable, Optional
+
+import numpy as np
+
+from .instruments import all_instruments
+from .log import log
+from .metrics import CACHE_LOOKUPS, metrics
+from .timeline import ACCENTED_VELOCITY, DEFAULT_VELOCITY, UNACCENTED_VELOCITY, note_name_to_midi
+from .soundfont import SoundFont
+
+SAMPLE_CACHE_BYTES = int(os.environ.get("SAMPLE_CACHE_MB", 64)) * 1024 * 1024
+SECTION_CACHE_BYTES = int(os.environ.get("SECTION_CACHE_MB", 256)) * 1024 * 1024
+
+# Every velocity the timeline gives a click
+CLICK_VELOCITIES = (ACCENTED_VELOCITY, DEFAULT_VELOCITY, UNACCENTED_VELOCITY)
+
+
+class ArrayCache:
+    """LRU cache of numpy arrays, bounded by their total size"""
+
+    def __init__(self, max_bytes: int, name: str = "arrays"):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_render(self, key: Hashable, render: Callable[[], np.ndarray]) -> np.ndarray:
+        """Returns the cached array for the key, calling render to make it if it isn't cached.
+
+        The returned array is shared so is read only.
+        """
+        with self._lock:
+            array = self._entries.get(key)
+            if array is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                metrics.inc(CACHE_LOOKUPS, cache=self.name, result="hit")
+                return array
+            self.misses += 1
+        metrics.inc(CACHE_LOOKUPS, cache=self.name, result="miss")
+
+        array = render()
+        array.setflags(write=False)
+        if array.nbytes > self.max_bytes:
+            return array
+
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = array
+                self.bytes += array.nbytes
+            while self.bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.bytes -= evicted.nbytes
+                self.evictions += 1
+        return array
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+
+class SampleCache(ArrayCache):
+    """LRU cache of rendered notes keyed by (soundfont, key, velocity, sample rate, hold), bounded
+    by the total size of the cached arrays, along with the loaded soundfonts"""
+
+    def __init__(self, max_bytes: int = SAMPLE_CACHE_BYTES):
+        super().__init__(max_bytes, "samples")
+        self._soundfonts: Dict[str, SoundFont] = {}
+
+    def soundfont(self, filename: str) -> SoundFont:
+        with self._lock:
+            if filename not in self._soundfonts:
+                self._soundfonts[filename] = SoundFont(filename)
+            return self._soundfonts[filename]
+
+    def render_note(
+        self,
+        soundfont: SoundFont,
+        key: int,
+        velocity: int,
+        sample_rate: int,
+        hold_samples: Optional[int] = None,
+    ) -> np.ndarray:
+        """Returns soundfont.render_note(...), rendering it only if it isn't already cached.
+
+        The returned array is shared so is read only.
+        """
+        return self.get_or_render(
+            (soundfont.filename, key, velocity, sample_rate, hold_samples),
+            lambda: soundfont.render_note(key, velocity, sample_rate, hold_samples),
+        )
+
+
+sample_cache = SampleCache()
+# Rendered sections of clicktracks, keyed by a hash of everything that determines their audio
+section_cache = ArrayCache(SECTION_CACHE_BYTES, "sections")
+
+
+def collect_stats() -> None:
+    for cache in (sample_cache, section_cache):
+        stats = cache.stats()
+        metrics.set("clicktrack_cache_entries", stats["entries"], cache=cache.name)
+        metrics.set("clicktrack_cache_bytes", stats["bytes"], cache=cache.name)
+        metrics.set("clicktrack_cache_evictions", stats["evictions"], cache=cache.name)
+
+
+metrics.register_collector(collect_stats)
+
+
+def warm_up(sample_rate: int) -> None:
+    """Loads every instrument's soundfont and renders each note it can play at every click velocity,
+    as an unreleased note, which is how clicks that finish ringing before their note off are played"""
+    for instrument in all_instruments.values():
+        soundfont = sample_cache.soundfont(instrument.soundfont_file)
+        for velocity in CLICK_VELOCITIES:
+            sample_cache.render_note(soundfont, note_name_to_midi(instrument.playback_note), velocity, sample_rate)
+    log(f"Sample cache warmed: {sample_cache.stats()}")
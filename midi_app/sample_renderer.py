@@ -0,0 +1,121 @@
+"""Renders clicktracks by placing the instruments' one-shot samples straight into a numpy buffer.
+
+A clicktrack is only ever a handful of distinct sounds (one per instrument, pitch and velocity)
+repeated at known times, so each sound is rendered from its soundfont once and then added into a
+preallocated output buffer at the sample offset of every click, taken from the clicktrack's timeline,
+which is timed by the same tempo map that is written to the midi file.
+
+The audio can be mixed all at once or a block at a time, in which case only the current block is
+ever held in memory.
+"""
+from typing import Iterator, List, Tuple
+
+import numpy as np
+
+from .metrics import span
+from .sample_cache import sample_cache
+from .soundfont import SoundFont
+from .timeline import Timeline
+
+SAMPLE_RATE = 44100  # fluidsynth's default
+# Longest block render_blocks mixes at once
+MAX_BLOCK_SECONDS = 5
+
+Clicks = List[Tuple[np.ndarray, np.ndarray]]  # (sound, sorted sample offsets it is played at)
+
+
+def mix_clicks(out: np.ndarray, pcm: np.ndarray, offsets: np.ndarray) -> None:
+    """Adds pcm into out at each of the given sample offsets.
+
+    Each click is added as one contiguous slice, which is much faster than np.add.at or a fancy
+    indexed add, as those need an index for every sample of every click.
+    """
+    length = len(pcm)
+    for offset in offsets.tolist():
+        out[offset:offset + length] += pcm
+
+
+def plan_clicks(timeline: Timeline, soundfonts: List[SoundFont], sample_rate: int = SAMPLE_RATE) -> Tuple[Clicks, int]:
+    """Works out every sound in the timeline, the clicks in each of its midi files being played
+    with the corresponding soundfont, and the sample offsets it is played at.
+
+    Returns the sounds and offsets along with the total length of the audio in samples.
+    """
+    on_samples = np.rint(timeline.seconds * sample_rate).astype(np.int64)
+    holds = np.rint(timeline.off_seconds * sample_rate).astype(np.int64) - on_samples
+
+    groups = []  # (soundfont, pitch, velocity, hold, sample offsets)
+    for file_idx, soundfont in enumerate(soundfonts):
+        in_file = timeline.files == file_idx
+        if not in_file.any():
+            continue
+        pitches, velocities = timeline.pitches[in_file], timeline.velocities[in_file]
+        file_on_samples, file_holds = on_samples[in_file], holds[in_file]
+
+        # Notes which are still sounding when they are released need a render per hold length,
+        # the rest all sound the same so share one unreleased render, marked by a hold of -1
+        sounds, sound_idxs = np.unique(np.stack([pitches, velocities]), axis=1, return_inverse=True)
+        sound_idxs = sound_idxs.ravel()
+        lengths = np.array([soundfont.note_length(int(p), int(v), sample_rate) for p, v in sounds.T])
+        file_holds = np.where(file_holds >= lengths[sound_idxs], -1, file_holds)
+
+        keys, key_idxs = np.unique(np.stack([pitches, velocities, file_holds]), axis=1, return_inverse=True)
+        key_idxs = key_idxs.ravel()
+        for idx, (pitch, velocity, hold) in enumerate(keys.T):
+            groups.append((soundfont, int(pitch), int(velocity), int(hold), file_on_samples[key_idxs == idx]))
+
+    clicks = []
+    total_samples = 0
+    for soundfont, pitch, velocity, hold, offsets in groups:
+        pcm = sample_cache.render_note(soundfont, pitch, velocity, sample_rate, hold if hold >= 0 else None)
+        clicks.append((pcm, np.sort(offsets, kind="stable")))
+        total_samples = max(total_samples, int(offsets.max()) + len(pcm))
+    return clicks, total_samples
+
+
+def mix_block(clicks: Clicks, start: int, stop: int) -> np.ndarray:
+    """Mixes the samples from start to stop, including the tails of earlier clicks"""
+    out = np.zeros((stop - start, 2), dtype=np.float32)
+    for pcm, offsets in clicks:
+        length = len(pcm)
+        window = offsets[np.searchsorted(offsets, start - length, side="right"):np.searchsorted(offsets, stop)]
+        inside = (window >= start) & (window + length <= stop)
+        mix_clicks(out, pcm, window[inside] - start)
+        # Clicks cut off by either end of the block
+        for offset in window[~inside].tolist():
+            lo, hi = max(offset, start), min(offset + length, stop)
+            out[lo - start:hi - start] += pcm[lo - offset:hi - offset]
+    return out
+
+
+def render_blocks(
+    timeline: Timeline,
+    soundfonts: List[SoundFont],
+    sample_rate: int = SAMPLE_RATE,
+    max_block_seconds: float = MAX_BLOCK_SECONDS,
+) -> Tuple[int, Iterator[np.ndarray]]:
+    """Like render_timeline, but returns the length of the audio and an iterator of its blocks, one
+    per section, with long sections split so that no block is longer than max_block_seconds"""
+    with span("synthesis"):
+        clicks, total_samples = plan_clicks(timeline, soundfonts, sample_rate)
+    max_block = int(max_block_seconds * sample_rate)
+    section_starts = np.rint(timeline.section_seconds * sample_rate).astype(np.int64).tolist()
+    boundaries = sorted({0, total_samples, *(s for s in section_starts if 0 < s < total_samples)})
+
+    def blocks() -> Iterator[np.ndarray]:
+        for section_start, section_stop in zip(boundaries, boundaries[1:]):
+            for start in range(section_start, section_stop, max_block):
+                with span("mix"):
+                    block = mix_block(clicks, start, min(start + max_block, section_stop))
+                yield block
+
+    return total_samples, blocks()
+
+
+def render_timeline(timeline: Timeline, soundfonts: List[SoundFont], sample_rate: int = SAMPLE_RATE) -> np.ndarray:
+    """Renders the timeline, the clicks in each of its midi files being played with the
+    corresponding soundfont, and returns the mixed float32 audio of shape (samples, 2)"""
+    with span("synthesis"):
+        clicks, total_samples = plan_clicks(timeline, soundfonts, sample_rate)
+    with span("mix"):
+        return mix_block(clicks, 0, total_samples)
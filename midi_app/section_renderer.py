@@ -0,0 +1,191 @@
+"""Synthesises clicktracks with fluidsynth a section at a time, so that sections which have already
+been synthesised, in this clicktrack or an earlier one, aren't synthesised again.
+
+A section of a clicktrack starts with its own first tempo and its clicks are timed from its start,
+so it sounds the same wherever it is. Each section is written to a midi file of its own,
+synthesised, and kept in sample_cache.section_cache under everything which decides how it sounds:
+its rhythms, number of measures and tempos, the instruments and the sample rate. The clicktrack is
+then put together by adding each section in at the sample it starts at, along with the tail of its
+last clicks, which rings on into the next section.
+
+When a section keeps to one tempo, only its first measure is synthesised, and that is repeated.
+Each copy starts at its measure's exact start rounded to the nearest sample, so measures which
+aren't a whole number of samples long don't drift out of time.
+
+The secondary part of a polyrhythm doesn't always line up with the sections (see
+can_render_sections), in which case the clicktrack has to be synthesised whole.
+"""
+import hashlib
+import json
+import os
+from fractions import Fraction
+from typing import List, Optional, Tuple
+
+import numpy as np
+import soundfile as sf
+
+from .fluidsynth import synthesise_file
+from .instruments import Instrument, all_instruments, playback_notes
+from .midi_writer import timeline_midi_bytes
+from .metrics import span
+from .sample_cache import section_cache
+from .sample_renderer import SAMPLE_RATE, mix_clicks
+from .timeline import TICKS_PER_QUARTER, Timeline, build_timeline, conductor_tempos
+
+
+def can_render_sections(section_data: List[dict], instruments: List[Instrument]) -> bool:
+    """Whether every section of the clicktrack sounds the same as it would on its own.
+
+    With two instruments, music21 puts the tempo marks of a polyrhythm section at the start of the
+    secondary part's section, which depend on the sections before it. With one, the secondary part
+    of a polyrhythm only stays in step with the sections if both time signatures have the same
+    denominator.
+    """
+    polyrhythms = [section["rhythms"] for section in section_data if len(section["rhythms"]) > 1]
+    if polyrhythms and len(instruments) > 1:
+        return False
+    return all(rhythms[0]["timeSig"][1] == rhythms[1]["timeSig"][1] for rhythms in polyrhythms)
+
+
+def section_key(section: dict, note_bpms: List[int], instrument_vals: List[str], sample_rate: int) -> str:
+    rhythms = [(rhythm["timeSig"], rhythm["accentedBeats"]) for rhythm in section["rhythms"]]
+    description = [rhythms, section["overallData"]["numMeasures"], note_bpms, instrument_vals, sample_rate]
+    return hashlib.sha1(json.dumps(description).encode()).hexdigest()
+
+
+def overlap_add(parts: List[Tuple[int, np.ndarray]]) -> np.ndarray:
+    """Adds together float32 audio of shape (samples, 2) starting at the given sample offsets.
+
+    Audio is copied where it doesn't overlap anything before it and only added where it does, so
+    the output is only written about once, rather than zeroed and then added to.
+    """
+    out = np.empty((max((start + len(pcm) for start, pcm in parts), default=0), 2), dtype=np.float32)
+    filled = 0
+    for start, pcm in sorted(parts, key=lambda part: part[0]):
+        stop = start + len(pcm)
+        if start > filled:
+            out[filled:start] = 0
+        overlap = min(max(filled - start, 0), len(pcm))
+        out[start:start + overlap] += pcm[:overlap]
+        out[start + overlap:stop] = pcm[overlap:]
+        filled = max(filled, stop)
+    return out
+
+
+def tile_measure(measure: np.ndarray, period: Fraction, count: int) -> np.ndarray:
+    """Overlap-adds count copies of measure, the kth starting at k * period samples, rounded.
+
+    When period is a whole number of samples, once a measure's tail has rung out every period of
+    the result is the same sum of the measure's periods, so that is only worked out once and
+    copied. Otherwise the copies are added in one by one.
+    """
+    if Fraction(period).denominator != 1:
+        period = Fraction(period)
+        offsets = (np.arange(count) * period.numerator * 2 + period.denominator) // (2 * period.denominator)
+        out = np.zeros((int(offsets[-1]) + len(measure), 2), dtype=np.float32)
+        mix_clicks(out, measure, offsets)
+        return out
+    period = int(period)
+    num_parts = -(-len(measure) // period)
+    length = (count - 1) * period + len(measure)
+    if not num_parts or count < num_parts:
+        out = np.zeros((length, 2), dtype=np.float32)
+        mix_clicks(out, measure, np.arange(count) * period)
+        return out
+    padded = np.zeros((num_parts * period, 2), dtype=np.float32)
+    padded[:len(measure)] = measure
+    parts = padded.reshape(num_parts, period, 2)
+    out = np.empty((count + num_parts - 1, period, 2), dtype=np.float32)
+    for idx in range(num_parts - 1):
+        out[idx] = parts[:idx + 1].sum(axis=0)
+        out[count + idx] = parts[idx + 1:].sum(axis=0)
+    out[num_parts - 1:count] = parts.sum(axis=0)
+    return out.reshape(-1, 2)[:length]
+
+
+def measure_period(timeline: Timeline, num_measures: int, sample_rate: int) -> Optional[Fraction]:
+    """If the timeline, of a single section, has one tempo and the same clicks in every measure,
+    returns the exact length of its measures in samples"""
+    if num_measures < 2 or not len(timeline):
+        return None
+    tempos = [conductor_tempos(conductor) for conductor, _ in timeline.tracks]
+    if any(len(mspq) != 1 or mspq[0] != tempos[0][1][0] for _, mspq in tempos):
+        return None
+    measure_ticks = timeline.tracks[0][0].offset * TICKS_PER_QUARTER / num_measures
+    period = measure_ticks * int(tempos[0][1][0]) * sample_rate / Fraction(1_000_000 * TICKS_PER_QUARTER)
+    if measure_ticks.denominator != 1:
+        return None
+
+    measures, ticks = np.divmod(timeline.ticks, int(measure_ticks))
+    if (np.bincount(measures, minlength=num_measures) != len(timeline) // num_measures).any():
+        return None
+    columns = (ticks, timeline.off_ticks - timeline.ticks, timeline.files, timeline.lanes, timeline.pitches, timeline.velocities)
+    order = np.lexsort((*reversed(columns), measures))
+    for column in columns:
+        rows = column[order].reshape(num_measures, -1)
+        if not (rows == rows[0]).all():
+            return None
+    return period
+
+
+def synthesise(midi_files: List[bytes], soundfont_files: List[str], directory: str, sample_rate: int) -> np.ndarray:
+    """Synthesises each midi file with the corresponding soundfont and returns their sum"""
+    parts = []
+    for idx, (midi_bytes, soundfont_file) in enumerate(zip(midi_files, soundfont_files)):
+        midi_filename = os.path.join(directory, f"section{idx + 1}.midi")
+        part_filename = os.path.join(directory, f"section{idx + 1}.wav")
+        with open(midi_filename, "wb") as f:
+            f.write(midi_bytes)
+        synthesise_file(soundfont_file, midi_filename, part_filename, sample_rate, check=True)
+        parts.append((0, sf.read(part_filename, dtype="float32", always_2d=True)[0]))
+    return overlap_add(parts)
+
+
+def render_section(
+    section: dict, note_bpms: List[int], instrument_vals: List[str], directory: str, sample_rate: int = SAMPLE_RATE
+) -> np.ndarray:
+    """Returns the audio of a section played on its own, synthesising it if it isn't cached"""
+
+    def synthesise_section() -> np.ndarray:
+        instruments = [all_instruments[iv] for iv in instrument_vals]
+        note_pitch_main, note_pitch_secondary = playback_notes(instruments)
+        with span("timeline"):
+            timeline = build_timeline([section], note_bpms, note_pitch_main, note_pitch_secondary, len(instruments) > 1)
+        num_measures = section["overallData"]["numMeasures"]
+        period = measure_period(timeline, num_measures, sample_rate)
+        if period is None:
+            soundfont_files = [instrument.soundfont_file for instrument in instruments]
+            with span("midi"):
+                midi_files = timeline_midi_bytes(timeline)
+            return synthesise(midi_files, soundfont_files, directory, sample_rate)
+        first_measure = {**section, "overallData": {**section["overallData"], "numMeasures": 1}}
+        beats_per_measure = len(note_bpms) // num_measures
+        measure = render_section(first_measure, note_bpms[:beats_per_measure], instrument_vals, directory, sample_rate)
+        with span("mix"):
+            return tile_measure(measure, period, num_measures)
+
+    key = section_key(section, note_bpms, instrument_vals, sample_rate)
+    return section_cache.get_or_render(key, synthesise_section)
+
+
+def render_sections(
+    section_data: List[dict], note_bpms: List[int], instrument_vals: List[str], directory: str, sample_rate: int = SAMPLE_RATE
+) -> np.ndarray:
+    """Synthesises the clicktrack a section at a time, see can_render_sections, and returns the
+    float32 audio of shape (samples, 2)"""
+    instruments = [all_instruments[iv] for iv in instrument_vals]
+    note_pitch_main, note_pitch_secondary = playback_notes(instruments)
+    with span("timeline"):
+        timeline = build_timeline(section_data, note_bpms, note_pitch_main, note_pitch_secondary, len(instruments) > 1)
+    section_starts = np.rint(timeline.section_seconds * sample_rate).astype(np.int64).tolist()
+
+    parts = []
+    notes_so_far = 0
+    for section, start in zip(section_data, section_starts):
+        num_beats = section["rhythms"][0]["timeSig"][0] * section["overallData"]["numMeasures"]
+        if num_beats:
+            section_bpms = note_bpms[notes_so_far:notes_so_far + num_beats]
+            parts.append((start, render_section(section, section_bpms, instrument_vals, directory, sample_rate)))
+        notes_so_far += num_beats
+    with span("mix"):
+        return overlap_add(parts)
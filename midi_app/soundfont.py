@@ -0,0 +1,290 @@
+"""Minimal SoundFont 2 reader, used to pull the one-shot click samples out of the .sf2 files so
+that they can be mixed with numpy rather than synthesised by fluidsynth.
+
+Only what matters for percussive one-shots is modelled: zone selection by key and velocity,
+sample offsets and loops, tuning, pan, attenuation, the default velocity curve and the volume
+envelope. Filters, LFOs, modulators and effects are ignored.
+"""
+import math
+import mmap
+import struct
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+# Generator operators from the SoundFont 2.04 spec
+START_OFFSET = 0
+END_OFFSET = 1
+START_LOOP_OFFSET = 2
+END_LOOP_OFFSET = 3
+START_COARSE_OFFSET = 4
+END_COARSE_OFFSET = 12
+PAN = 17
+ATTACK_VOL_ENV = 34
+HOLD_VOL_ENV = 35
+DECAY_VOL_ENV = 36
+SUSTAIN_VOL_ENV = 37
+RELEASE_VOL_ENV = 38
+INSTRUMENT = 41
+KEY_RANGE = 43
+VEL_RANGE = 44
+START_LOOP_COARSE_OFFSET = 45
+KEYNUM = 46
+VELOCITY = 47
+INITIAL_ATTENUATION = 48
+END_LOOP_COARSE_OFFSET = 50
+COARSE_TUNE = 51
+FINE_TUNE = 52
+SAMPLE_ID = 53
+SAMPLE_MODES = 54
+SCALE_TUNING = 56
+OVERRIDING_ROOT_KEY = 58
+
+GENERATOR_DEFAULTS = {
+    ATTACK_VOL_ENV: -12000,
+    HOLD_VOL_ENV: -12000,
+    DECAY_VOL_ENV: -12000,
+    RELEASE_VOL_ENV: -12000,
+    KEYNUM: -1,
+    VELOCITY: -1,
+    SCALE_TUNING: 100,
+    OVERRIDING_ROOT_KEY: -1,
+}
+
+# Generators which only make sense at instrument level, or which are ranges, and so are never
+# added to from the preset level
+NON_ADDITIVE = {
+    START_OFFSET, END_OFFSET, START_LOOP_OFFSET, END_LOOP_OFFSET, START_COARSE_OFFSET,
+    END_COARSE_OFFSET, START_LOOP_COARSE_OFFSET, END_LOOP_COARSE_OFFSET, INSTRUMENT, KEY_RANGE,
+    VEL_RANGE, KEYNUM, VELOCITY, SAMPLE_ID, SAMPLE_MODES, OVERRIDING_ROOT_KEY,
+}
+
+SILENCE_CENTIBELS = 960  # Voices are considered finished once they are 96dB down
+MAX_LOOPED_SECONDS = 10  # Looped samples with a long release are cut off after this long
+
+
+class SoundFontError(Exception):
+    pass
+
+
+def timecents_to_seconds(timecents: int) -> float:
+    return 0.0 if timecents <= -12000 else 2 ** (timecents / 1200)
+
+
+def _chunks(data: bytes, start: int, end: int):
+    """Yields (chunk id, data offset, size) for the RIFF chunks between start and end"""
+    while start + 8 <= end:
+        chunk_id = data[start:start + 4]
+        size = struct.unpack_from("<I", data, start + 4)[0]
+        yield chunk_id, start + 8, size
+        start += 8 + size + (size & 1)
+
+
+def _records(data: bytes, offset: int, size: int, fmt: str) -> List[tuple]:
+    record_size = struct.calcsize(fmt)
+    return [struct.unpack_from(fmt, data, offset + i * record_size) for i in range(size // record_size)]
+
+
+def _zones(headers: List[tuple], bags: List[tuple], gens: List[tuple], terminal_gen: int) -> List[List[dict]]:
+    """Splits the hydra records into a list of zones (generator dicts) for each preset/instrument,
+    with the global zone, if any, merged into every other zone"""
+    result = []
+    for idx in range(len(headers) - 1):
+        zones = []
+        global_zone = {}
+        for bag_idx in range(headers[idx][-1], headers[idx + 1][-1]):
+            zone = {}
+            for oper, amount in gens[bags[bag_idx][0]:bags[bag_idx + 1][0]]:
+                zone[oper] = amount
+            if terminal_gen in zone:
+                zones.append(zone)
+            elif not zones:
+                global_zone = zone
+        result.append([{**global_zone, **zone} for zone in zones])
+    return result
+
+
+def _in_range(zone: dict, gen: int, value: int) -> bool:
+    if gen not in zone:
+        return True
+    low, high = zone[gen] & 0xFF, (zone[gen] >> 8) & 0xFF
+    return low <= value <= high
+
+
+class SampleHeader:
+    def __init__(self, name, start, end, loop_start, loop_end, sample_rate, original_pitch, pitch_correction):
+        self.name = name
+        self.start = start
+        self.end = end
+        self.loop_start = loop_start
+        self.loop_end = loop_end
+        self.sample_rate = sample_rate
+        self.original_pitch = original_pitch
+        self.pitch_correction = pitch_correction
+
+
+class SoundFont:
+    """The samples and preset/instrument zones of an .sf2 file"""
+
+    def __init__(self, filename: str):
+        # The file is memory mapped rather than read, so its sample data lives in the page cache and
+        # is shared by every process using the soundfont
+        with open(filename, "rb") as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if data[:4] != b"RIFF" or data[8:12] != b"sfbk":
+            raise SoundFontError(f"{filename} is not a SoundFont 2 file")
+
+        self.filename = filename
+        self._note_lengths: Dict[Tuple[int, int, int], int] = {}
+        hydra = {}
+        for chunk_id, offset, size in _chunks(data, 12, len(data)):
+            if chunk_id != b"LIST":
+                continue
+            for sub_id, sub_offset, sub_size in _chunks(data, offset + 4, offset + size):
+                if sub_id == b"smpl":
+                    self.samples = np.frombuffer(data, dtype="<i2", count=sub_size // 2, offset=sub_offset)
+                else:
+                    hydra[sub_id] = (sub_offset, sub_size)
+
+        def records(chunk_id, fmt):
+            return _records(data, *hydra[chunk_id], fmt)
+
+        # Names are dropped, the last field of each header is the index of its first zone
+        presets = [(program, bank, bag) for _, program, bank, bag, *_ in records(b"phdr", "<20sHHHIII")]
+        instruments = [(bag,) for _, bag in records(b"inst", "<20sH")]
+        self.preset_zones = _zones(presets, records(b"pbag", "<HH"), records(b"pgen", "<Hh"), INSTRUMENT)
+        self.instrument_zones = _zones(instruments, records(b"ibag", "<HH"), records(b"igen", "<Hh"), SAMPLE_ID)
+        self.presets = {(bank, program): idx for idx, (program, bank, _) in enumerate(presets[:-1])}
+        self.sample_headers = [
+            SampleHeader(name.split(b"\0")[0].decode("latin-1"), *fields)
+            for name, *fields, _, _ in records(b"shdr", "<20sIIIIIBbHH")[:-1]
+        ]
+
+    def voices(self, key: int, velocity: int, bank: int = 0, program: int = 0) -> List[Tuple[dict, SampleHeader]]:
+        """Returns the (generators, sample) pair of every voice a note on would start"""
+        preset_idx = self.presets.get((bank, program), 0)
+        result = []
+        for preset_zone in self.preset_zones[preset_idx]:
+            if not (_in_range(preset_zone, KEY_RANGE, key) and _in_range(preset_zone, VEL_RANGE, velocity)):
+                continue
+            for inst_zone in self.instrument_zones[preset_zone[INSTRUMENT]]:
+                if not (_in_range(inst_zone, KEY_RANGE, key) and _in_range(inst_zone, VEL_RANGE, velocity)):
+                    continue
+                gens = dict(GENERATOR_DEFAULTS)
+                gens.update(inst_zone)
+                for oper, amount in preset_zone.items():
+                    if oper not in NON_ADDITIVE:
+                        gens[oper] = gens.get(oper, 0) + amount
+                result.append((gens, self.sample_headers[inst_zone[SAMPLE_ID]]))
+        return result
+
+    def _voice_source(self, gens: dict, header: SampleHeader, key: int, sample_rate: int):
+        """Returns the voice's sample data, loop points (or None) and playback step, which is the
+        number of source samples to advance per output sample"""
+        start = header.start + gens.get(START_OFFSET, 0) + 32768 * gens.get(START_COARSE_OFFSET, 0)
+        end = header.end + gens.get(END_OFFSET, 0) + 32768 * gens.get(END_COARSE_OFFSET, 0)
+        pcm = self.samples[start:end].astype(np.float32) / 32768
+
+        loop = None
+        if gens.get(SAMPLE_MODES, 0) & 1:
+            loop_start = header.loop_start + gens.get(START_LOOP_OFFSET, 0) + 32768 * gens.get(START_LOOP_COARSE_OFFSET, 0)
+            loop_end = header.loop_end + gens.get(END_LOOP_OFFSET, 0) + 32768 * gens.get(END_LOOP_COARSE_OFFSET, 0)
+            if start <= loop_start < loop_end <= end:
+                loop = (loop_start - start, loop_end - start)
+
+        root_key = gens[OVERRIDING_ROOT_KEY]
+        if root_key < 0:
+            root_key = header.original_pitch if header.original_pitch <= 127 else 60
+        played_key = gens[KEYNUM] if gens[KEYNUM] >= 0 else key
+        cents = (
+            (played_key - root_key) * gens[SCALE_TUNING]
+            + 100 * gens.get(COARSE_TUNE, 0)
+            + gens.get(FINE_TUNE, 0)
+            + header.pitch_correction
+        )
+        step = 2 ** (cents / 1200) * header.sample_rate / sample_rate
+        return pcm, loop, step
+
+    def note_length(self, key: int, velocity: int, sample_rate: int) -> int:
+        """Number of output samples the note sounds for if it is never released"""
+        if (key, velocity, sample_rate) in self._note_lengths:
+            return self._note_lengths[(key, velocity, sample_rate)]
+        length = 0
+        for gens, header in self.voices(key, velocity):
+            pcm, loop, step = self._voice_source(gens, header, key, sample_rate)
+            if loop:
+                length = max(length, MAX_LOOPED_SECONDS * sample_rate)
+            else:
+                length = max(length, int((len(pcm) - 1) / step) + 1)
+        self._note_lengths[(key, velocity, sample_rate)] = length
+        return length
+
+    def render_note(self, key: int, velocity: int, sample_rate: int, hold_samples: int = None) -> np.ndarray:
+        """Renders a single note as a float32 array of shape (samples, 2).
+
+        hold_samples is how long after the note on the note off comes, if it is None the note
+        rings for as long as its samples do.
+        """
+        rendered = []
+        for gens, header in self.voices(key, velocity):
+            pcm, loop, step = self._voice_source(gens, header, key, sample_rate)
+            if len(pcm) < 2:
+                continue
+            release = timecents_to_seconds(gens[RELEASE_VOL_ENV])
+            if loop:
+                num_samples = MAX_LOOPED_SECONDS * sample_rate
+            else:
+                num_samples = int((len(pcm) - 1) / step) + 1
+            if hold_samples is not None:
+                release_samples = int(release * SILENCE_CENTIBELS / 1000 * sample_rate)
+                num_samples = min(num_samples, hold_samples + release_samples + 1)
+
+            positions = np.arange(num_samples, dtype=np.float64) * step
+            if loop:
+                loop_start, loop_end = loop
+                looped = positions >= loop_end
+                positions[looped] = loop_start + (positions[looped] - loop_start) % (loop_end - loop_start)
+            voice = np.interp(positions, np.arange(len(pcm)), pcm).astype(np.float32)
+
+            voice *= self._envelope(gens, num_samples, sample_rate, hold_samples)
+            voice_velocity = gens[VELOCITY] if gens[VELOCITY] >= 0 else velocity
+            # The spec's default velocity to attenuation modulator is a concave curve which works
+            # out as the square of the normalised velocity
+            gain = 10 ** (-max(gens.get(INITIAL_ATTENUATION, 0), 0) / 200) * (voice_velocity / 127) ** 2
+            pan = min(max(gens.get(PAN, 0), -500), 500)
+            angle = (pan + 500) / 1000 * math.pi / 2
+            rendered.append(np.stack([voice * (gain * math.cos(angle)), voice * (gain * math.sin(angle))], axis=1))
+
+        if not rendered:
+            return np.zeros((0, 2), dtype=np.float32)
+        result = np.zeros((max(len(r) for r in rendered), 2), dtype=np.float32)
+        for r in rendered:
+            result[:len(r)] += r
+        return result
+
+    @staticmethod
+    def _envelope(gens: dict, num_samples: int, sample_rate: int, hold_samples: int = None) -> np.ndarray:
+        """Amplitude of the DAHDSR volume envelope (without delay) for each output sample"""
+        t = np.arange(num_samples, dtype=np.float64) / sample_rate
+        attack = timecents_to_seconds(gens[ATTACK_VOL_ENV])
+        hold = timecents_to_seconds(gens[HOLD_VOL_ENV])
+        decay = timecents_to_seconds(gens[DECAY_VOL_ENV])
+        sustain = min(max(gens.get(SUSTAIN_VOL_ENV, 0), 0), 1440)
+
+        # Decay and release are linear in decibels, taking their time to fall by 100dB
+        if decay > 0:
+            attenuation = np.clip((t - attack - hold) / decay * 1000, 0, sustain)
+        else:
+            attenuation = np.where(t < attack + hold, 0, sustain)
+        if hold_samples is not None:
+            release = timecents_to_seconds(gens[RELEASE_VOL_ENV])
+            released = t - hold_samples / sample_rate
+            if release > 0:
+                attenuation = attenuation + np.clip(released / release * 1000, 0, None)
+            else:
+                attenuation = np.where(released > 0, SILENCE_CENTIBELS, attenuation)
+        amplitude = 10 ** (-np.minimum(attenuation, SILENCE_CENTIBELS) / 200)
+        amplitude[attenuation >= SILENCE_CENTIBELS] = 0
+        if attack > 0:
+            amplitude *= np.minimum(t / attack, 1)
+        return amplitude.astype(np.float32)
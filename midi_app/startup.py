@@ -0,0 +1,59 @@
+"""How much of the app is loaded when it starts.
+
+Rendering needs numpy, soundfile, the soundfonts and every instrument's clicks, which take a while
+to load. With STARTUP_MODE=eager (the default) preload() loads them all when the app is imported,
+so no request has to wait for them. With STARTUP_MODE=lazy they're loaded by the first request
+that renders anything, so the app starts serving health checks as soon as flask is imported, which
+is what matters on a dyno scaled to zero.
+
+gunicorn.conf.py calls preload() in the gunicorn master whichever the mode, so when the app is
+preloaded there too, everything is loaded once and the workers share it copy-on-write.
+"""
+import importlib
+import os
+import threading
+
+from .log import log
+
+STARTUP_MODE = os.environ.get("STARTUP_MODE", "eager")
+if STARTUP_MODE not in ("eager", "lazy"):
+    raise ValueError(f"Unknown STARTUP_MODE {STARTUP_MODE}, expected eager or lazy")
+
+_lock = threading.Lock()
+_loaded = False
+
+
+def preload() -> None:
+    """Imports the views and everything they render with, and loads the samples and the storage
+    backend. Only does so once, however many threads call it"""
+    global _loaded
+    if _loaded:
+        return
+    with _lock:
+        if _loaded:
+            return
+        from .sample_cache import warm_up
+        from .sample_renderer import SAMPLE_RATE
+        from .storage import storage
+        from . import views  # noqa: F401
+
+        # Render every instrument's clicks up front, so requests don't have to
+        warm_up(SAMPLE_RATE)
+        storage.load()
+        _loaded = True
+    log(f"Loaded the audio stack ({STARTUP_MODE} startup)")
+
+
+class LazyView:
+    """A view function standing in for views.<name>, which preloads the app the first time it is
+    called"""
+
+    def __init__(self, name: str):
+        self.__name__ = name
+        self._view = None
+
+    def __call__(self, *args, **kwargs):
+        if self._view is None:
+            preload()
+            self._view = getattr(importlib.import_module(".views", __package__), self.__name__)
+        return self._view(*args, **kwargs)
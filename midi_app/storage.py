@@ -0,0 +1,199 @@
+"""Where rendered clicktracks are uploaded to, picked with STORAGE_BACKEND:
+
+- cloudinary, the default
+- local, files saved in STORAGE_DIR and served by the app itself from /files/<name>
+- memory, files kept in a dict, for tests and for benchmarking the whole pipeline offline
+
+Uploads take bytes, a filename or a binary stream. Streams are read a chunk at a time, so a render
+which is still being encoded (see encoding.py) is uploaded as it is produced. Streams which can't
+be sought have no size until they've been read, so they're sent to cloudinary in parts which leave
+the total size out (as -1) until the last one.
+
+The cloudinary SDK is only imported and configured once it is first used, as it is slow to import
+and not needed to start the app.
+"""
+import io
+import os
+import shutil
+import tempfile
+import threading
+import uuid
+from typing import BinaryIO, Dict, List, Optional, Tuple, Union
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "cloudinary")
+STORAGE_DIR = os.environ.get("STORAGE_DIR", "stored_files")
+# Where the app is reachable, for the urls of files served by the local and memory backends
+STORAGE_URL = os.environ.get("STORAGE_URL", f"http://localhost:{os.environ.get('PORT', 5000)}")
+# Cloudinary needs chunks of at least 5MB
+UPLOAD_CHUNK_BYTES = int(os.environ.get("UPLOAD_CHUNK_MB", 6)) * 1024 * 1024
+# Formats cloudinary stores as raw files rather than as audio
+RAW_FORMATS = ("zip", "json")
+# Prefixed to the ids of raw files, as they have to be deleted separately
+RAW_ID_PREFIX = "raw:"
+
+Source = Union[bytes, str, BinaryIO]
+
+
+class Storage:
+    def upload(self, source: Source, file_format: str) -> Tuple[str, Optional[str]]:
+        """Uploads the file and returns its url, or "error", along with the id to delete it by, or
+        None if nothing was stored"""
+        raise NotImplementedError
+
+    def delete(self, public_ids: List[str]) -> None:
+        raise NotImplementedError
+
+    def open(self, name: str) -> Optional[Union[str, BinaryIO]]:
+        """The path or contents of a stored file if the app serves it itself, otherwise None"""
+        return None
+
+    def load(self):
+        """Loads anything the backend needs, which is otherwise done when it is first used"""
+
+
+class CloudinaryStorage(Storage):
+    def __init__(self):
+        self._configured = False
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Imports and configures the cloudinary SDK, returning the module"""
+        import cloudinary
+        import cloudinary.api
+        import cloudinary.uploader
+
+        with self._lock:
+            if not self._configured:
+                cloudinary.config(secure=True)
+                self._configured = True
+        return cloudinary
+
+    def upload(self, source: Source, file_format: str) -> Tuple[str, Optional[str]]:
+        cloudinary = self.load()
+        if isinstance(source, bytes):
+            source = io.BytesIO(source)
+        # Cloudinary considers audio to be a subset of the video resource type
+        resource_type = "raw" if file_format in RAW_FORMATS else "video"
+        options = {"resource_type": resource_type, "folder": "clicktracks", "filename": f"clicktrack.{file_format}"}
+        if isinstance(source, str) or source.seekable():
+            upload_response = cloudinary.uploader.upload_large(source, chunk_size=UPLOAD_CHUNK_BYTES, **options)
+        else:
+            upload_response = self._upload_parts(cloudinary, source, options)
+        public_id = upload_response.get("public_id")
+        if public_id is not None and resource_type == "raw":
+            public_id = RAW_ID_PREFIX + public_id
+        return upload_response.get("secure_url", "error"), public_id
+
+    def _upload_parts(self, cloudinary, source: BinaryIO, options: dict) -> dict:
+        """Uploads a stream of unknown size in parts as it is read, as upload_large would if it
+        didn't need the size first. Each part is read ahead so the last one is known"""
+        headers = {"X-Unique-Upload-Id": cloudinary.utils.random_public_id()}
+        position = 0
+        chunk = source.read(UPLOAD_CHUNK_BYTES)
+        while True:
+            next_chunk = source.read(UPLOAD_CHUNK_BYTES)
+            end = position + len(chunk)
+            headers["Content-Range"] = f"bytes {position}-{end - 1}/{-1 if next_chunk else end}"
+            upload_response = cloudinary.uploader.upload_large_part(
+                (options["filename"], chunk), http_headers=dict(headers), **options
+            )
+            options = {**options, "public_id": upload_response.get("public_id")}
+            if not next_chunk:
+                return upload_response
+            position, chunk = end, next_chunk
+
+    def delete(self, public_ids: List[str]) -> None:
+        raw_ids = [public_id[len(RAW_ID_PREFIX):] for public_id in public_ids if public_id.startswith(RAW_ID_PREFIX)]
+        video_ids = [public_id for public_id in public_ids if not public_id.startswith(RAW_ID_PREFIX)]
+        cloudinary = self.load()
+        if video_ids:
+            cloudinary.api.delete_resources(video_ids, resource_type="video")
+        if raw_ids:
+            cloudinary.api.delete_resources(raw_ids, resource_type="raw")
+
+
+def _new_name(file_format: str) -> str:
+    return f"{uuid.uuid4().hex}.{file_format}"
+
+
+def _is_name(name: str) -> bool:
+    return os.path.basename(name) == name and not name.startswith(".")
+
+
+class LocalStorage(Storage):
+    def __init__(self, directory: str = STORAGE_DIR, base_url: str = STORAGE_URL):
+        # Flask resolves relative paths it sends against the app's package rather than the working
+        # directory
+        self.directory = os.path.abspath(directory)
+        self.base_url = base_url
+
+    def upload(self, source: Source, file_format: str) -> Tuple[str, str]:
+        os.makedirs(self.directory, exist_ok=True)
+        name = _new_name(file_format)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix=".")
+        with os.fdopen(fd, "wb") as f:
+            if isinstance(source, bytes):
+                f.write(source)
+            elif not isinstance(source, str):
+                shutil.copyfileobj(source, f, UPLOAD_CHUNK_BYTES)
+        if isinstance(source, str):
+            # Copied by the kernel where it can, without being read into the process
+            shutil.copyfile(source, tmp_path)
+        os.replace(tmp_path, os.path.join(self.directory, name))
+        return f"{self.base_url}/files/{name}", name
+
+    def delete(self, public_ids: List[str]) -> None:
+        for name in public_ids:
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+
+    def open(self, name: str) -> Optional[str]:
+        path = os.path.join(self.directory, name)
+        return path if _is_name(name) and os.path.isfile(path) else None
+
+
+class MemoryStorage(Storage):
+    def __init__(self, base_url: str = STORAGE_URL):
+        self.base_url = base_url
+        self.files: Dict[str, bytes] = {}
+        self._lock = threading.Lock()
+
+    def upload(self, source: Source, file_format: str) -> Tuple[str, str]:
+        if isinstance(source, str):
+            with open(source, "rb") as f:
+                source = f.read()
+        elif not isinstance(source, bytes):
+            source = source.read()
+        name = _new_name(file_format)
+        with self._lock:
+            self.files[name] = source
+        return f"{self.base_url}/files/{name}", name
+
+    def delete(self, public_ids: List[str]) -> None:
+        with self._lock:
+            for name in public_ids:
+                self.files.pop(name, None)
+
+    def open(self, name: str) -> Optional[BinaryIO]:
+        with self._lock:
+            data = self.files.get(name)
+        return io.BytesIO(data) if data is not None else None
+
+
+def make_storage(backend: str = STORAGE_BACKEND) -> Storage:
+    if backend == "local":
+        return LocalStorage()
+    if backend == "memory":
+        return MemoryStorage()
+    if backend == "cloudinary":
+        return CloudinaryStorage()
+    raise ValueError(f"Unknown storage backend {backend}")
+
+
+storage = make_storage()
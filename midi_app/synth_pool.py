@@ -0,0 +1,273 @@
+"""Renders clicktracks with a pool of long lived fluidsynth synthesisers, for the synth audio backend.
+
+The fluidsynth backend runs the fluidsynth CLI for every part, which loads the soundfont all over
+again and reads the clicks back from a midi file on disk. The synth backend uses the same
+synthesiser in process through pyfluidsynth: each instance loads every soundfont in
+all_instruments once, is played the clicks of the timeline directly and renders into numpy arrays,
+so nothing is written to disk. With two instruments each part is rendered on an instance of its
+own at the same time, as fluidsynth releases the GIL while it renders, and they are mixed in memory.
+
+Each process has a pool of at most SYNTH_POOL_SIZE instances, which renders wait for when all of
+them are in use. An instance is checked before it is handed out (it must render silence once
+reset) and is replaced after SYNTH_RECYCLE_RENDERS renders, so stuck voices or leaks can't build
+up. Instances aren't shared with forked processes, which make their own.
+
+pyfluidsynth is only imported when the first instance is made, so it is only needed for this
+backend.
+"""
+import contextvars
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Dict, Iterator, List
+
+import numpy as np
+
+from .instruments import all_instruments
+from .log import log
+from .metrics import SYNTH_INSTANCES, metrics, span
+from .section_renderer import overlap_add
+from .timeline import Timeline
+
+SYNTH_POOL_SIZE = int(os.environ.get("SYNTH_POOL_SIZE", 4))
+SYNTH_RECYCLE_RENDERS = int(os.environ.get("SYNTH_RECYCLE_RENDERS", 500))
+# How long a render waits for an instance when they are all in use
+SYNTH_WAIT_SECONDS = float(os.environ.get("SYNTH_WAIT_SECONDS", 60))
+
+GAIN = 1.0  # As the fluidsynth backend runs the CLI with -g 1
+CHANNEL = 0  # Every note track of the midi files plays on the first channel
+HEALTH_CHECK_FRAMES = 64
+# After the last note the release is rendered a block at a time until it is silent, for at most
+# MAX_TAIL_SECONDS
+TAIL_BLOCK_FRAMES = 1024
+MAX_TAIL_SECONDS = 5
+# Playing 16 bit samples, like the wav files the fluidsynth CLI writes
+PCM_SCALE = 1 / 32768
+
+
+class SynthError(Exception):
+    pass
+
+
+class SynthInstance:
+    """A fluidsynth synthesiser with every instrument's soundfont loaded"""
+
+    def __init__(self, sample_rate: int):
+        import fluidsynth
+
+        self.sample_rate = sample_rate
+        self.renders = 0
+        self.pid = os.getpid()
+        self.synth = fluidsynth.Synth(gain=GAIN, samplerate=float(sample_rate))
+        self.soundfonts: Dict[str, int] = {}
+        for filename in sorted({instrument.soundfont_file for instrument in all_instruments.values()}):
+            soundfont_id = self.synth.sfload(filename)
+            if soundfont_id < 0:
+                self.close()
+                raise SynthError(f"fluidsynth couldn't load {filename}")
+            self.soundfonts[filename] = soundfont_id
+
+    def healthy(self) -> bool:
+        """Whether it still belongs to this process and renders silence once reset, clearing any
+        notes left sounding by its last render"""
+        if self.pid != os.getpid():
+            return False
+        try:
+            self.synth.system_reset()
+            samples = self.synth.get_samples(HEALTH_CHECK_FRAMES)
+        except Exception as e:
+            log(f"Synthesiser failed its health check: {e}")
+            return False
+        return len(samples) == 2 * HEALTH_CHECK_FRAMES and not samples.any()
+
+    def render(self, timeline: Timeline, file_idx: int, soundfont_file: str) -> np.ndarray:
+        """Plays the clicks in one of the timeline's midi files with the soundfont, returning float32
+        audio of shape (samples, 2).
+
+        Like the fluidsynth CLI playing the midi file, it carries on past the last note off until
+        the notes have died away, i.e. until they'd be silent in the 16 bit wav the CLI writes.
+        """
+        in_file = timeline.files == file_idx
+        on_samples = np.rint(timeline.seconds[in_file] * self.sample_rate).astype(np.int64)
+        off_samples = np.rint(timeline.off_seconds[in_file] * self.sample_rate).astype(np.int64)
+        pitches, velocities = timeline.pitches[in_file], timeline.velocities[in_file]
+
+        # Note offs before note ons at the same sample, as in the midi file, otherwise in order
+        samples = np.concatenate([off_samples, on_samples])
+        is_on = np.concatenate([np.zeros(len(off_samples), dtype=bool), np.ones(len(on_samples), dtype=bool)])
+        order = np.lexsort((is_on, samples))
+        keys = np.concatenate([pitches, pitches])[order].tolist()
+        event_velocities = np.concatenate([np.zeros_like(velocities), velocities])[order].tolist()
+
+        total = int(samples.max()) if len(samples) else 0
+        max_total = total + int(MAX_TAIL_SECONDS * self.sample_rate)
+        out = np.empty((max_total, 2), dtype=np.float32)
+        synth = self.synth
+        synth.program_select(CHANNEL, self.soundfonts[soundfont_file], 0, 0)
+        position = 0
+        for sample, on, key, velocity in zip(samples[order].tolist(), is_on[order].tolist(), keys, event_velocities):
+            if sample > position:
+                out[position:sample] = synth.get_samples(sample - position).reshape(-1, 2) * PCM_SCALE
+                position = sample
+            if on:
+                synth.noteon(CHANNEL, key, velocity)
+            else:
+                synth.noteoff(CHANNEL, key)
+
+        end = position
+        while position < max_total:
+            frames = min(TAIL_BLOCK_FRAMES, max_total - position)
+            pcm = synth.get_samples(frames).reshape(-1, 2)
+            sounding = np.flatnonzero(pcm.any(axis=1))
+            if not len(sounding):
+                break
+            out[position:position + frames] = pcm * PCM_SCALE
+            # Up to the last frame which isn't silent
+            end = position + int(sounding[-1]) + 1
+            position += frames
+        self.renders += 1
+        return out[:end]
+
+    def close(self) -> None:
+        if self.pid == os.getpid():
+            self.synth.delete()
+
+
+class SynthPool:
+    """At most size synthesiser instances, made as they are needed and reused"""
+
+    def __init__(self, size: int = SYNTH_POOL_SIZE, recycle_renders: int = SYNTH_RECYCLE_RENDERS):
+        self.size = size
+        self.recycle_renders = recycle_renders
+        self._idle: List[SynthInstance] = []
+        self._count = 0
+        self._condition = threading.Condition()
+        self._pid = os.getpid()
+        metrics.register_collector(self._collect_stats)
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self) -> None:
+        # The instances are the parent's, and the lock may have been held when it forked
+        self._idle, self._count, self._pid = [], 0, os.getpid()
+        self._condition = threading.Condition()
+
+    @contextmanager
+    def instance(self, sample_rate: int) -> Iterator[SynthInstance]:
+        """An instance rendering at the sample rate, for the duration of the with block. An
+        instance which raises is discarded rather than going back in the pool"""
+        synth = self._acquire(sample_rate)
+        try:
+            yield synth
+        except BaseException:
+            self._discard(synth, "failed")
+            raise
+        self._release(synth)
+
+    def _acquire(self, sample_rate: int) -> SynthInstance:
+        deadline = time.monotonic() + SYNTH_WAIT_SECONDS
+        while True:
+            with self._condition:
+                synth = self._take(sample_rate, deadline)
+            if synth is None:
+                return self._create(sample_rate)
+            if synth.healthy():
+                return synth
+            self._discard(synth, "unhealthy")
+
+    def _take(self, sample_rate: int, deadline: float):
+        """An idle instance at the sample rate, or None once there is room for a new one. Must be
+        called holding the lock"""
+        while True:
+            for idx, synth in enumerate(self._idle):
+                if synth.sample_rate == sample_rate:
+                    return self._idle.pop(idx)
+            if self._count < self.size:
+                self._count += 1
+                return None
+            if self._idle:
+                # Make way for an instance at this sample rate
+                self._idle.pop(0).close()
+                metrics.inc(SYNTH_INSTANCES, event="replaced")
+                return None
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise SynthError(f"Waited {SYNTH_WAIT_SECONDS}s for a free synthesiser")
+            self._condition.wait(remaining)
+
+    def _create(self, sample_rate: int) -> SynthInstance:
+        try:
+            synth = SynthInstance(sample_rate)
+        except BaseException:
+            with self._condition:
+                self._count -= 1
+                self._condition.notify()
+            raise
+        metrics.inc(SYNTH_INSTANCES, event="created")
+        return synth
+
+    def _release(self, synth: SynthInstance) -> None:
+        if synth.renders >= self.recycle_renders:
+            self._discard(synth, "recycled")
+            return
+        with self._condition:
+            if synth.pid == self._pid:
+                self._idle.append(synth)
+                self._condition.notify()
+
+    def _discard(self, synth: SynthInstance, reason: str) -> None:
+        try:
+            synth.close()
+        except Exception as e:
+            log(f"Failed to close a synthesiser: {e}")
+        metrics.inc(SYNTH_INSTANCES, event=reason)
+        with self._condition:
+            if synth.pid == self._pid:
+                self._count -= 1
+                self._condition.notify()
+
+    def stats(self) -> dict:
+        with self._condition:
+            return {"instances": self._count, "idle": len(self._idle), "size": self.size}
+
+    def _collect_stats(self) -> None:
+        stats = self.stats()
+        metrics.set("clicktrack_synth_pool_instances", stats["instances"] - stats["idle"], state="busy")
+        metrics.set("clicktrack_synth_pool_instances", stats["idle"], state="idle")
+
+    def close(self) -> None:
+        """Closes the idle instances"""
+        with self._condition:
+            idle, self._idle = self._idle, []
+            self._count -= len(idle)
+        for synth in idle:
+            synth.close()
+
+
+synth_pool = SynthPool()
+
+
+def render_part(timeline: Timeline, file_idx: int, soundfont_file: str, sample_rate: int) -> np.ndarray:
+    with synth_pool.instance(sample_rate) as synth, span("synthesis"):
+        return synth.render(timeline, file_idx, soundfont_file)
+
+
+def render_timeline_with_synths(timeline: Timeline, soundfont_files: List[str], sample_rate: int) -> np.ndarray:
+    """Renders the timeline, the clicks in each of its midi files being played with the
+    corresponding soundfont, and returns the mixed float32 audio of shape (samples, 2)"""
+    parts = [(idx, soundfont_file) for idx, soundfont_file in enumerate(soundfont_files) if (timeline.files == idx).any()]
+    if not parts:
+        return np.zeros((0, 2), dtype=np.float32)
+    if len(parts) == 1:
+        return render_part(timeline, *parts[0], sample_rate)
+
+    with ThreadPoolExecutor(len(parts)) as executor:
+        # Each in the current context, so that their spans count towards the current trace
+        futures = [
+            executor.submit(contextvars.copy_context().run, render_part, timeline, file_idx, soundfont_file, sample_rate)
+            for file_idx, soundfont_file in parts
+        ]
+        rendered = [future.result() for future in futures]
+    with span("mix"):
+        return overlap_add([(0, pcm) for pcm in rendered])
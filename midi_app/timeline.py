@@ -0,0 +1,352 @@
+"""Works out when every click of a clicktrack happens, with NumPy.
+
+Takes the sectionData and noteBpms of a request and computes the tick and time in seconds of every
+click in the main and secondary lanes, along with its pitch, velocity and whether it is accented,
+as flat arrays. The midi writer and the audio renderers all work from the resulting Timeline.
+
+The loops are over sections rather than clicks, every click in a section being computed in a few
+array operations, so a track of hundreds of thousands of beats takes milliseconds.
+
+Ticks are computed from exact fractions of a quarter note and rounded like music21 (v7) rounds
+them, and the lanes and conductor tracks reproduce the streams built by the make_section* helpers
+in benchmarks/music21_sections.py, quirks included, so the midi files are byte for byte what music21
+writes.
+"""
+import math
+from fractions import Fraction
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+TICKS_PER_QUARTER = 1024  # music21's default resolution
+
+ACCENTED_VELOCITY = 120
+UNACCENTED_VELOCITY = 80
+DEFAULT_VELOCITY = 90  # What music21 uses for notes which never had their volume set
+
+# Offset of each note letter from C, as used in music21 pitch names such as "E7" or "F#3"
+NOTE_STEPS = {"C": 0, "D": 2, "E": 4, "F": 5, "G": 7, "A": 9, "B": 11}
+ACCIDENTALS = {"#": 1, "-": -1, "b": -1}
+
+MAIN_LANE = 0
+SECONDARY_LANE = 1
+
+
+def get_tempo_dict(note_bpms: List[int]) -> dict:
+    return dict((idx, bpm) for idx, bpm in enumerate(note_bpms) if idx == 0 or bpm != note_bpms[idx -1] )
+
+
+def tempo_changes(note_bpms: List[float]) -> Tuple[np.ndarray, np.ndarray]:
+    """The note indices at which the bpm changes, and the bpms they change to, like get_tempo_dict"""
+    bpms = np.asarray(note_bpms)
+    if not len(bpms):
+        return np.zeros(0, dtype=np.int64), bpms
+    idxs = np.concatenate([[0], np.flatnonzero(bpms[1:] != bpms[:-1]) + 1])
+    return idxs, bpms[idxs]
+
+
+def note_name_to_midi(note_name: str) -> int:
+    """Converts a music21 style pitch name (e.g. "C4", "F#3", "B-2") to a midi note number"""
+    step = NOTE_STEPS[note_name[0].upper()]
+    idx = 1
+    while idx < len(note_name) and note_name[idx] in ACCIDENTALS:
+        step += ACCIDENTALS[note_name[idx]]
+        idx += 1
+    octave = int(note_name[idx:]) if idx < len(note_name) else 4
+    return (octave + 1) * 12 + step
+
+
+def round_ticks(numerator: int, denominator: int) -> int:
+    """Rounds numerator / denominator to the nearest tick, with ties to even like python's round"""
+    quotient, remainder = divmod(numerator, denominator)
+    if 2 * remainder > denominator or (2 * remainder == denominator and quotient % 2):
+        quotient += 1
+    return quotient
+
+
+def offset_ticks(start: Fraction, step: Fraction, idxs: np.ndarray) -> np.ndarray:
+    """Returns the ticks of the offsets start + idx * step for each of the idxs, where the offsets
+    are in quarter notes, rounded with ties to even"""
+    idxs = np.asarray(idxs, dtype=np.int64)
+    start = start * TICKS_PER_QUARTER
+    step = step * TICKS_PER_QUARTER
+    denominator = math.lcm(start.denominator, step.denominator)
+    start_numerator = start.numerator * (denominator // start.denominator)
+    step_numerator = step.numerator * (denominator // step.denominator)
+    if denominator * (int(idxs.max(initial=0)) + 1) >= 2 ** 62:
+        # Too big for int64, which takes some extremely awkward time signatures
+        return np.array([round_ticks(start_numerator + int(i) * step_numerator, denominator) for i in idxs], dtype=np.int64)
+
+    # start + idx * step = base + idx * increment + (base_rem + idx * increment_rem) / denominator,
+    # split like this so the fractional parts stay small enough for int64
+    base, base_rem = divmod(start_numerator, denominator)
+    increment, increment_rem = divmod(step_numerator, denominator)
+    carry, remainder = np.divmod(base_rem + idxs * increment_rem, denominator)
+    ticks = base + idxs * increment + carry
+    round_up = (2 * remainder > denominator) | ((2 * remainder == denominator) & (ticks % 2 == 1))
+    return ticks + round_up
+
+
+class ClickLane:
+    """The notes and conductor events of what would have been a single music21 stream or part.
+
+    Offsets are kept as exact fractions of a quarter note, like music21 does, and are only rounded
+    to ticks when notes and tempo marks are added. Each call adding notes or tempo marks adds a
+    whole section's worth as arrays.
+    """
+
+    def __init__(self, lane: int = MAIN_LANE):
+        self.lane = lane
+        self.offset = Fraction(0)
+        self.time_sigs: List[Tuple[Fraction, List[int]]] = []
+        # (offset, step, beat indices, bpms), a tempo mark at offset + idx * step for each index
+        self.tempo_runs: List[Tuple[Fraction, Fraction, np.ndarray, np.ndarray]] = []
+        self._note_chunks: List[Tuple[np.ndarray, ...]] = []
+        self._notes: Optional[Tuple[np.ndarray, ...]] = None
+
+    def add_time_sig(self, time_sig: List[int]) -> None:
+        self.time_sigs.append((self.offset, time_sig))
+
+    def add_tempos(self, bpms, step: Fraction = Fraction(0), idxs=None, offset: Fraction = None) -> None:
+        """Adds a tempo mark for each bpm at offset + idx * step, by default all at the current
+        offset"""
+        bpms = np.asarray(bpms, dtype=np.float64)
+        if not len(bpms):
+            return
+        idxs = np.zeros(len(bpms), dtype=np.int64) if idxs is None else np.asarray(idxs, dtype=np.int64)
+        self.tempo_runs.append((self.offset if offset is None else offset, step, idxs, bpms))
+
+    def add_clicks(self, beat_length: Fraction, beat_idxs, pitch: int, velocities, accents) -> None:
+        """Adds a click on each of the given beats (counted from the current offset), each sounding
+        for half a beat"""
+        beat_idxs = np.asarray(beat_idxs, dtype=np.int64)
+        if not len(beat_idxs):
+            return
+        click_ticks = round_ticks(beat_length.numerator * TICKS_PER_QUARTER, 2 * beat_length.denominator)
+        on_ticks = offset_ticks(self.offset, beat_length, beat_idxs)
+        self._note_chunks.append((
+            on_ticks,
+            on_ticks + click_ticks,
+            np.full(len(beat_idxs), pitch, dtype=np.int64),
+            np.broadcast_to(np.asarray(velocities, dtype=np.int64), beat_idxs.shape),
+            np.broadcast_to(np.asarray(accents, dtype=bool), beat_idxs.shape),
+        ))
+        self._notes = None
+
+    def advance(self, length: Fraction) -> None:
+        self.offset += length
+
+    def notes(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """The (on ticks, off ticks, pitches, velocities, accents) of the lane's notes, in the
+        order they were added"""
+        if self._notes is None:
+            if self._note_chunks:
+                self._notes = tuple(np.concatenate(column) for column in zip(*self._note_chunks))
+            else:
+                empty = np.zeros(0, dtype=np.int64)
+                self._notes = (empty, empty, empty, empty, np.zeros(0, dtype=bool))
+        return self._notes
+
+    def __len__(self) -> int:
+        return sum(len(chunk[0]) for chunk in self._note_chunks)
+
+
+def first_per_offset(marks: List[tuple]) -> List[tuple]:
+    """music21 keeps only the first conductor event of each kind at any one offset"""
+    result = []
+    last_offset = -1
+    for mark in marks:
+        if mark[0] > last_offset:
+            result.append(mark)
+        last_offset = mark[0]
+    return result
+
+
+def conductor_tempos(lane: ClickLane) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns the ticks and microseconds per quarter note of each tempo change written to the
+    lane's conductor track"""
+    ticks, bpms = [], []
+    last_offset = -1
+    for offset, step, idxs, run_bpms in lane.tempo_runs:
+        # Only the first of any marks at the same offset is kept, and within a run that can only
+        # be the run's first mark, or all but its first when all of its marks are at one offset
+        keep = np.ones(len(idxs), dtype=bool) if step else np.zeros(len(idxs), dtype=bool)
+        keep[0] = offset + int(idxs[0]) * step > last_offset
+        last_offset = offset + int(idxs[-1]) * step
+        ticks.append(offset_ticks(offset, step, idxs[keep]))
+        bpms.append(run_bpms[keep])
+    if not ticks or not sum(len(t) for t in ticks):
+        return np.zeros(1, dtype=np.int64), np.array([500_000], dtype=np.int64)
+    return np.concatenate(ticks), np.rint(60_000_000 / np.concatenate(bpms)).astype(np.int64)
+
+
+def ticks_to_seconds(ticks: np.ndarray, tempos: Tuple[np.ndarray, np.ndarray]) -> np.ndarray:
+    """Converts midi ticks to seconds using the tempo changes from conductor_tempos"""
+    tempo_ticks, mspq = tempos
+    seconds_per_tick = mspq.astype(np.float64) / 1_000_000 / TICKS_PER_QUARTER
+    tempo_seconds = np.concatenate([[0.0], np.cumsum(np.diff(tempo_ticks) * seconds_per_tick[:-1])])
+    idx = np.maximum(np.searchsorted(tempo_ticks, ticks, side="right") - 1, 0)
+    return tempo_seconds[idx] + (ticks - tempo_ticks[idx]) * seconds_per_tick[idx]
+
+
+def _accent_mask(num_beats: int, numerator: int, accented_beats: List[int]) -> np.ndarray:
+    return np.isin(np.arange(num_beats) % numerator, accented_beats)
+
+
+def _add_lockstep_tempos(
+    lanes: List[ClickLane], change_idxs: np.ndarray, change_bpms: np.ndarray, notes_before: int, num_beats: int, beat_length: Fraction
+) -> None:
+    lo, hi = np.searchsorted(change_idxs, [notes_before, notes_before + num_beats])
+    for lane in lanes:
+        lane.add_tempos(change_bpms[lo:hi], beat_length, change_idxs[lo:hi] - notes_before)
+
+
+def build_lanes(
+    section_data: List[dict],
+    note_bpms: List[int],
+    note_pitch_main: str,
+    note_pitch_secondary: str,
+    separate_instruments: bool,
+) -> Tuple[List[ClickLane], bool]:
+    """Works out the clicks for the main and secondary lanes of the clicktrack, mirroring the
+    make_section* helpers.
+
+    Returns the lanes along with whether the clicktrack contains polyrhythms.
+    """
+    has_polyrhythms = any(len(section["rhythms"]) > 1 for section in section_data)
+    change_idxs, change_bpms = tempo_changes(note_bpms)
+    pitch_main = note_name_to_midi(note_pitch_main)
+    pitch_secondary = note_name_to_midi(note_pitch_secondary)
+
+    main = ClickLane(MAIN_LANE)
+    secondary = ClickLane(SECONDARY_LANE)
+    notes_so_far = 0
+
+    for section in section_data:
+        time_sigs = [r["timeSig"] for r in section["rhythms"]]
+        num_measures = section["overallData"]["numMeasures"]
+        accented_beats = section["rhythms"][0]["accentedBeats"]
+        numerator, denominator = time_sigs[0]
+        num_beats = numerator * num_measures
+        beat_length = Fraction(4, denominator)
+        beats = np.arange(num_beats)
+        accents = _accent_mask(num_beats, numerator, accented_beats)
+        accent_velocities = np.where(accents, ACCENTED_VELOCITY, UNACCENTED_VELOCITY)
+
+        main.add_time_sig(time_sigs[0])
+
+        if not has_polyrhythms and not separate_instruments:
+            # make_section
+            _add_lockstep_tempos([main], change_idxs, change_bpms, notes_so_far, num_beats, beat_length)
+            main.add_clicks(beat_length, beats, pitch_main, accent_velocities, accents)
+
+        elif not has_polyrhythms:
+            # make_section_separated, accented beats go to the main instrument and the rest to the
+            # secondary one
+            secondary.add_time_sig(time_sigs[0])
+            _add_lockstep_tempos([main, secondary], change_idxs, change_bpms, notes_so_far, num_beats, beat_length)
+            main.add_clicks(beat_length, beats[accents], pitch_main, DEFAULT_VELOCITY, True)
+            secondary.add_clicks(beat_length, beats[~accents], pitch_secondary, DEFAULT_VELOCITY, False)
+            secondary.advance(num_beats * beat_length)
+
+        elif len(time_sigs) == 1:
+            # Non polyrhythmic section of a polyrhythmic clicktrack, the secondary part just rests
+            if separate_instruments:
+                secondary.add_time_sig(time_sigs[0])
+                _add_lockstep_tempos([main, secondary], change_idxs, change_bpms, notes_so_far, num_beats, beat_length)
+            else:
+                _add_lockstep_tempos([main], change_idxs, change_bpms, notes_so_far, num_beats, beat_length)
+            main.add_clicks(beat_length, beats, pitch_main, accent_velocities, accents)
+            secondary.advance(num_beats * beat_length)
+
+        else:
+            secondary_numerator, secondary_denominator = time_sigs[1]
+            secondary_beat_length = Fraction(numerator * 4, secondary_numerator * secondary_denominator)
+            num_secondary_beats = secondary_numerator * num_measures
+            secondary_beats = np.arange(num_secondary_beats)
+            _add_lockstep_tempos([main], change_idxs, change_bpms, notes_so_far, num_beats, beat_length)
+            if separate_instruments:
+                # make_section_polyrhythm_two_instruments appends all of the section's tempo marks
+                # to the secondary part before any of its notes, so they all land on its first beat
+                secondary.add_time_sig(time_sigs[0])
+                lo, hi = np.searchsorted(change_idxs, [notes_so_far, notes_so_far + num_beats])
+                secondary.add_tempos(change_bpms[lo:hi])
+                main.add_clicks(beat_length, beats, pitch_main, DEFAULT_VELOCITY, accents)
+                secondary.add_clicks(secondary_beat_length, secondary_beats, pitch_secondary, DEFAULT_VELOCITY, False)
+            else:
+                main.add_clicks(beat_length, beats, pitch_main, accent_velocities, accents)
+                secondary.add_clicks(secondary_beat_length, secondary_beats, pitch_main, UNACCENTED_VELOCITY, False)
+            secondary.advance(num_secondary_beats * secondary_beat_length)
+
+        main.advance(num_beats * beat_length)
+        notes_so_far += num_beats
+
+    return [main, secondary], has_polyrhythms
+
+
+class Timeline:
+    """Every click of a clicktrack, as arrays with an entry per click.
+
+    tracks holds the conductor lane and note lanes of each midi file making up the clicktrack, and
+    file says which of them each click is in. With separate instruments there is one file per
+    instrument (main then secondary), otherwise there is a single file, which has a second track
+    for polyrhythms. Clicks in different files are timed by their own file's tempo map.
+    """
+
+    def __init__(self, tracks: List[Tuple[ClickLane, List[ClickLane]]]):
+        self.tracks = tracks
+        columns = []
+        for file_idx, (conductor, lanes) in enumerate(tracks):
+            tempos = conductor_tempos(conductor)
+            for lane in lanes:
+                on_ticks, off_ticks, pitches, velocities, accents = lane.notes()
+                columns.append((
+                    on_ticks,
+                    off_ticks,
+                    ticks_to_seconds(on_ticks, tempos),
+                    ticks_to_seconds(off_ticks, tempos),
+                    pitches,
+                    velocities,
+                    accents,
+                    np.full(len(on_ticks), lane.lane, dtype=np.int64),
+                    np.full(len(on_ticks), file_idx, dtype=np.int64),
+                ))
+        (
+            self.ticks,
+            self.off_ticks,
+            self.seconds,
+            self.off_seconds,
+            self.pitches,
+            self.velocities,
+            self.accents,
+            self.lanes,
+            self.files,
+        ) = (np.concatenate(column) for column in zip(*columns))
+
+        conductor = tracks[0][0]
+        self.section_ticks = np.array(
+            [round_ticks(offset.numerator * TICKS_PER_QUARTER, offset.denominator) for offset, _ in conductor.time_sigs],
+            dtype=np.int64,
+        )
+        self.section_seconds = ticks_to_seconds(self.section_ticks, conductor_tempos(conductor))
+
+    def __len__(self) -> int:
+        return len(self.ticks)
+
+
+def build_timeline(
+    section_data: List[dict],
+    note_bpms: List[int],
+    note_pitch_main: str = "C4",
+    note_pitch_secondary: str = "C4",
+    separate_instruments: bool = False,
+) -> Timeline:
+    """Works out the timeline of the clicktrack, see Timeline"""
+    (main, secondary), has_polyrhythms = build_lanes(
+        section_data, note_bpms, note_pitch_main, note_pitch_secondary, separate_instruments
+    )
+    if separate_instruments:
+        return Timeline([(main, [main]), (secondary, [secondary])])
+    if has_polyrhythms:
+        return Timeline([(main, [main, secondary])])
+    return Timeline([(main, [main])])
@@ -0,0 +1,241 @@
+"""The views which render and serve clicktracks, and so import numpy, soundfile and the rest of
+the audio stack. routes.py registers them lazily, so this is only imported by the first request
+for one (or up front by startup.preload)"""
+import math
+import os
+
+from flask import Response, request, send_file
+from .audio_processing import stream_audio
+from .batch import batch_runner
+from .cost import RenderTooLargeError, estimate_cost
+from .encoding import AUDIO_FORMATS, AudioOptions
+from .jobs import QueueFullError, job_queue, render_key_for
+from .render_cache import render_cache
+from .storage import storage
+
+from .log import log
+
+# How long the synchronous endpoints wait for their render before handing back the job to poll
+SYNC_RENDER_TIMEOUT = float(os.environ.get("SYNC_RENDER_TIMEOUT", 25))
+# Longest a job status request can be held open for
+MAX_JOB_WAIT = 30
+
+SUPPORTED_FORMATS = ("midi", *AUDIO_FORMATS)
+
+
+def queue_full_response(error: QueueFullError):
+    log(f'Rejected render: {error}')
+    return {"error": "Too many renders in progress, try again shortly"}, 503, {"Retry-After": "5"}
+
+
+def invalid_response(error: ValueError):
+    """413 for a render too big to do, otherwise 400 for a payload which can't be rendered"""
+    return {"error": str(error)}, 413 if isinstance(error, RenderTooLargeError) else 400
+
+
+def wants_stream(data: dict) -> bool:
+    """Whether the audio should be sent in the response rather than uploaded, asked for with
+    "stream": true in the payload or ?stream=1"""
+    return bool(data.get("stream")) or request.args.get("stream") in ("1", "true")
+
+
+def audio_response(file_format: str, section_data, note_bpms, instrument_vals, options: AudioOptions):
+    """Streams the audio file in the response as it is rendered, or the render cache's copy"""
+    mimetype = f"audio/{file_format}"
+    key = render_key_for(file_format, section_data, note_bpms, instrument_vals, options)
+    cached = render_cache.get_file(key, file_format)
+    if cached:
+        return send_file(cached, mimetype=mimetype, conditional=True)
+
+    chunks, size = stream_audio(section_data, note_bpms, file_format, instrument_vals, options=options)
+    headers = {"Content-Length": str(size)} if size is not None else {}
+    return Response(chunks, mimetype=mimetype, headers=headers)
+
+
+def wait_seconds() -> float:
+    """The ?wait=<seconds> of a status request, clamped to 0 to MAX_JOB_WAIT. Raises ValueError if
+    it isn't a number"""
+    wait = float(request.args.get("wait", 0))
+    if math.isnan(wait):
+        raise ValueError("wait must be a number of seconds")
+    return min(max(wait, 0), MAX_JOB_WAIT)
+
+
+def job_response(job):
+    """The url if the job has finished, otherwise the job to poll for it"""
+    result = job.to_dict()
+    if job.status == "done":
+        return {"url": result["url"]} if "url" in result else {"error": result["error"]}
+    if job.status == "failed":
+        return {"error": "Something went wrong with the file"}, 500
+    return result, 202
+
+
+def make_midi() -> dict:
+    data = request.json
+    section_data = data["sectionData"]
+    note_bpms = data["noteBpms"]
+    try:
+        job = job_queue.submit("midi", section_data, note_bpms)
+    except QueueFullError as e:
+        return queue_full_response(e)
+    except ValueError as e:
+        return invalid_response(e)
+    job_queue.wait(job, SYNC_RENDER_TIMEOUT)
+    return job_response(job)
+
+def make_wav() -> dict:
+    data = request.json
+    section_data = data["sectionData"]
+    note_bpms = data["noteBpms"]
+    instrument_vals = data["instruments"]
+    try:
+        options = AudioOptions.from_payload(data)
+        if data.get("loops"):
+            job = job_queue.submit_loops("wav", section_data, note_bpms, instrument_vals, options)
+        elif wants_stream(data):
+            estimate_cost(["wav"], section_data, note_bpms, instrument_vals).check()
+            return audio_response("wav", section_data, note_bpms, instrument_vals, options)
+        else:
+            job = job_queue.submit("wav", section_data, note_bpms, instrument_vals, options)
+    except QueueFullError as e:
+        return queue_full_response(e)
+    except ValueError as e:
+        return invalid_response(e)
+    job_queue.wait(job, SYNC_RENDER_TIMEOUT)
+    return job_response(job)
+
+
+def make_compressed(file_format: str):
+    """Renders and uploads, or streams, a FLAC or OGG"""
+    data = request.json
+    section_data = data["sectionData"]
+    note_bpms = data["noteBpms"]
+    instrument_vals = data["instruments"]
+    try:
+        options = AudioOptions.from_payload(data)
+        if data.get("loops"):
+            job = job_queue.submit_loops(file_format, section_data, note_bpms, instrument_vals, options)
+        elif wants_stream(data):
+            estimate_cost([file_format], section_data, note_bpms, instrument_vals).check()
+            return audio_response(file_format, section_data, note_bpms, instrument_vals, options)
+        else:
+            job = job_queue.submit(file_format, section_data, note_bpms, instrument_vals, options)
+    except QueueFullError as e:
+        return queue_full_response(e)
+    except ValueError as e:
+        return invalid_response(e)
+    job_queue.wait(job, SYNC_RENDER_TIMEOUT)
+    return job_response(job)
+
+
+def make_flac() -> dict:
+    return make_compressed("flac")
+
+
+def make_ogg() -> dict:
+    return make_compressed("ogg")
+
+
+def submit_job():
+    """Queues a render and returns its job id straight away.
+
+    Takes the same payload as the make_* endpoints plus a "format" of midi, wav, flac or ogg, or
+    "formats", a list of audio formats which the one render is encoded into, giving a url for each.
+    With "loops": true an audio format's url is that of a manifest of the clicktrack's loops.
+    """
+    data = request.json
+    file_formats = data.get("formats") or [data.get("format", "wav")]
+    unsupported = [f for f in file_formats if f not in SUPPORTED_FORMATS]
+    if unsupported:
+        return {"error": f"Unsupported format {', '.join(map(str, unsupported))}"}, 400
+    if "formats" in data and "midi" in file_formats:
+        return {"error": "Only audio formats can be rendered together"}, 400
+    if data.get("loops") and ("formats" in data or file_formats[0] == "midi"):
+        return {"error": "Only a single audio format can be split into loops"}, 400
+    try:
+        options = AudioOptions.from_payload(data)
+        if data.get("loops"):
+            job = job_queue.submit_loops(
+                file_formats[0], data["sectionData"], data["noteBpms"], data.get("instruments"), options
+            )
+        elif "formats" in data:
+            job = job_queue.submit_formats(
+                list(dict.fromkeys(file_formats)), data["sectionData"], data["noteBpms"], data.get("instruments"), options
+            )
+        else:
+            file_format = file_formats[0]
+            job = job_queue.submit(
+                file_format,
+                data["sectionData"],
+                data["noteBpms"],
+                data.get("instruments") if file_format != "midi" else None,
+                options if file_format != "midi" else None,
+            )
+    except QueueFullError as e:
+        return queue_full_response(e)
+    except ValueError as e:
+        return invalid_response(e)
+    return job.to_dict(), 202
+
+
+def get_job(job_id: str):
+    """Returns the job's status, and its url once it is done.
+
+    Pass ?wait=<seconds> to long poll, holding the request open until the job finishes.
+    """
+    job = job_queue.get(job_id)
+    if job is None:
+        return {"error": "No such job"}, 404
+    try:
+        wait = wait_seconds()
+    except ValueError:
+        return {"error": "wait must be a number of seconds"}, 400
+    if wait > 0:
+        job_queue.wait(job, wait)
+    return job.to_dict()
+
+
+def submit_batch():
+    """Renders a list of clicktracks, each with the same payload as the make_* endpoints, in
+    parallel.
+
+    Takes {"items": [...], "format": midi, wav or flac, "bundle": zip or concat}, where the
+    optional bundle asks for a zip of every file, or for audio, one file of them all one after
+    another, and the optional sampleRate, bitDepth and channels of the make_* endpoints, which
+    apply to every item and the bundle. Returns each item's url or error (and the bundle's) if
+    they finish within SYNC_RENDER_TIMEOUT, otherwise the batch to poll for them.
+    """
+    data = request.json
+    try:
+        options = AudioOptions.from_payload(data)
+        batch = batch_runner.submit(data.get("format", "wav"), data.get("items"), data.get("bundle"), options)
+    except ValueError as e:
+        # Invalid audio options, or a BatchError
+        return {"error": str(e)}, 400
+    except QueueFullError as e:
+        return queue_full_response(e)
+    batch.wait(SYNC_RENDER_TIMEOUT)
+    return batch.to_dict(), 200 if batch.done else 202
+
+
+def get_batch(batch_id: str):
+    """Returns the batch's items and bundle, taking ?wait=<seconds> like /api/jobs/<job_id>"""
+    batch = batch_runner.get(batch_id)
+    if batch is None:
+        return {"error": "No such batch"}, 404
+    try:
+        wait = wait_seconds()
+    except ValueError:
+        return {"error": "wait must be a number of seconds"}, 400
+    if wait > 0:
+        batch.wait(wait)
+    return batch.to_dict()
+
+
+def stored_file(name: str):
+    """Serves uploaded files when STORAGE_BACKEND is local or memory, with range request support"""
+    file = storage.open(name)
+    if file is None:
+        return {"error": "No such file"}, 404
+    return send_file(file, download_name=name, conditional=True)
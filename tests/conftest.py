@@ -0,0 +1,18 @@
+"""Runs the app against the in-memory storage backend, with its working directories in a
+temporary directory. These have to be set before midi_app is first imported."""
+import os
+import tempfile
+
+_directory = tempfile.mkdtemp(prefix="clicktrack-tests-")
+
+os.environ.setdefault("FLASK_ENV", "development")
+os.environ.setdefault("STORAGE_BACKEND", "memory")
+os.environ.setdefault("STARTUP_MODE", "lazy")
+for name, subdirectory in [
+    ("STORAGE_DIR", "stored_files"),
+    ("RENDER_CACHE_DIR", "render_cache"),
+    ("EXPIRY_DIR", "pending_deletions"),
+    ("METRICS_DIR", "metrics"),
+    ("JOB_DIR", "jobs"),
+]:
+    os.environ.setdefault(name, os.path.join(_directory, subdirectory))
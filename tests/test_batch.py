@@ -0,0 +1,41 @@
+from concurrent.futures import Future
+
+import soundfile as sf
+
+from midi_app import file_management
+from midi_app.batch import Batch, BatchRunner, render_bundle
+from midi_app.encoding import AudioOptions
+from midi_app.jobs import Job
+from midi_app.storage import MemoryStorage
+
+
+def item(bpm: int) -> dict:
+    section = {"rhythms": [{"timeSig": [4, 4], "accentedBeats": [0]}], "overallData": {"numMeasures": 1}}
+    return {"sectionData": [section], "noteBpms": [bpm] * 4, "instruments": ["woodblock_high"]}
+
+
+def test_concatenates_with_the_batch_audio_options(monkeypatch):
+    storage = MemoryStorage("http://localhost")
+    monkeypatch.setattr(file_management, "storage", storage)
+    options = AudioOptions(22050, 24, 1)
+    batch = Batch("wav", [item(120), item(60)], "concat", options)
+    renders = list(batch.renders().values())
+
+    url = render_bundle("concat", renders, ["01-clicktrack", "02-clicktrack"])
+    with sf.SoundFile(storage.open(url.rsplit("/", 1)[1])) as bundle:
+        assert (bundle.samplerate, bundle.channels, bundle.subtype) == (22050, 1, "PCM_24")
+        # Three beats at 120 and three at 60 bpm before each item's last click
+        assert bundle.frames > 4.5 * 22050
+
+
+def test_finishes_batches_with_cancelled_items():
+    future = Future()
+    future.cancel()
+    batch = Batch("wav", [item(120)], "zip")
+    batch.jobs = [Job("key", future)]
+
+    BatchRunner(queue=None)._items_finished(batch)
+    assert batch.done
+    result = batch.to_dict()
+    assert result["items"][0]["status"] == "failed"
+    assert result["bundle"] == {"status": "failed", "error": "None of the clicktracks could be rendered"}
@@ -0,0 +1,60 @@
+"""Renders run on the threads of each gunicorn worker, so the same renders done at the same time
+have to give the same files as when they're done one at a time."""
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from midi_app import app
+from midi_app.audio_processing import make_audio_file, make_midi_file
+from midi_app.file_management import render_workspace
+
+
+def section(time_sig, num_measures, secondary_time_sig=None) -> dict:
+    rhythms = [{"timeSig": list(time_sig), "accentedBeats": [0]}]
+    if secondary_time_sig:
+        rhythms.append({"timeSig": list(secondary_time_sig), "accentedBeats": [0]})
+    return {"rhythms": rhythms, "overallData": {"numMeasures": num_measures}}
+
+
+PAYLOADS = [
+    {"sectionData": [section((4, 4), 4)], "noteBpms": [120] * 16, "instruments": ["woodblock_high"]},
+    {"sectionData": [section((3, 4), 3), section((7, 8), 2)], "noteBpms": [90] * 9 + [140] * 14, "instruments": ["woodblock_high"]},
+    {"sectionData": [section((5, 4), 2)], "noteBpms": list(range(100, 110)), "instruments": ["woodblock_lower"]},
+    {"sectionData": [section((4, 4), 3, (3, 4))], "noteBpms": [110] * 12, "instruments": ["drum1", "finger_snap"]},
+]
+FORMATS = ["midi", "wav", "flac"]
+CASES = [(idx, file_format) for idx in range(len(PAYLOADS)) for file_format in FORMATS]
+
+
+def render(case) -> bytes:
+    idx, file_format = case
+    payload = PAYLOADS[idx]
+    with render_workspace() as workspace:
+        if file_format == "midi":
+            filename = make_midi_file(payload["sectionData"], payload["noteBpms"], None, workspace)
+        else:
+            filename, _, _ = make_audio_file(payload["sectionData"], payload["noteBpms"], file_format, payload["instruments"], workspace)
+        with open(filename, "rb") as f:
+            return f.read()
+
+
+def test_concurrent_renders_match_serial_renders():
+    serial = {case: render(case) for case in CASES}
+    with ThreadPoolExecutor(8) as pool:
+        concurrent = list(pool.map(render, CASES * 3))
+    for case, data in zip(CASES * 3, concurrent):
+        assert data == serial[case], f"{case} differs when rendered concurrently"
+
+
+@pytest.mark.parametrize("file_format", ["wav", "flac"])
+def test_concurrent_streamed_requests_match_serial_requests(file_format):
+    def request(idx: int) -> bytes:
+        response = app.test_client().post(f"/api/make_{file_format}?stream=1", json=PAYLOADS[idx])
+        assert response.status_code == 200
+        return response.data
+
+    serial = [request(idx) for idx in range(len(PAYLOADS))]
+    with ThreadPoolExecutor(8) as pool:
+        concurrent = list(pool.map(request, list(range(len(PAYLOADS))) * 3))
+    assert concurrent == serial * 3
@@ -0,0 +1,18 @@
+import pytest
+
+from midi_app.cost import RenderTooLargeError, estimate_cost
+
+
+def four_four(num_measures: int) -> list:
+    return [{"rhythms": [{"timeSig": [4, 4], "accentedBeats": [0]}], "overallData": {"numMeasures": num_measures}}]
+
+
+def test_times_beats_past_the_end_of_note_bpms_at_the_last_bpm():
+    assert estimate_cost(["wav"], four_four(2), [60, 60, 120]).seconds == estimate_cost(["wav"], four_four(2), [60, 60] + [120] * 6).seconds == 5
+    assert estimate_cost(["wav"], four_four(1), []).seconds == 2
+
+    cost = estimate_cost(["wav"], four_four(100000), [120])
+    assert cost.seconds == 200000
+    assert cost.heavy
+    with pytest.raises(RenderTooLargeError):
+        cost.check()
@@ -0,0 +1,150 @@
+import os
+import time
+
+from midi_app.expiry import ExpiryScheduler
+
+# Far enough ahead that the scheduler threads never get to anything themselves
+LATER = time.time() + 3600
+
+
+class StubDelete:
+    def __init__(self, failures: int = 0):
+        self.calls = []
+        self.failures = failures
+
+    def __call__(self, public_ids):
+        if self.failures:
+            self.failures -= 1
+            raise RuntimeError("storage is down")
+        self.calls.append(list(public_ids))
+
+    @property
+    def deleted(self):
+        return [public_id for call in self.calls for public_id in call]
+
+
+def make_scheduler(directory, delete=None):
+    return ExpiryScheduler(delete or StubDelete(), str(directory), batch_window=0, retry_delay=30, adopt_interval=3600)
+
+
+def exit_process(scheduler):
+    """Lets go of the lock a scheduler holds while its process is alive, as exiting would"""
+    scheduler._owner_file.close()
+    scheduler._owner_file = None
+
+
+def records(directory):
+    return [name for name in os.listdir(directory) if name.endswith(".json")]
+
+
+def test_deletes_once_expired(tmp_path):
+    scheduler = make_scheduler(tmp_path)
+    scheduler.schedule("a", LATER)
+    scheduler.schedule("b", LATER + 10)
+
+    assert scheduler.run_due(LATER - 1) == 0
+    assert scheduler.run_due(LATER) == 1
+    assert scheduler.delete.deleted == ["a"]
+    assert scheduler.run_due(LATER + 10) == 1
+    assert scheduler.delete.deleted == ["a", "b"]
+    assert records(tmp_path) == []
+
+
+def test_retries_failed_deletions(tmp_path):
+    scheduler = make_scheduler(tmp_path, StubDelete(failures=1))
+    scheduler.schedule("a", LATER)
+
+    assert scheduler.run_due(LATER) == 0
+    assert len(records(tmp_path)) == 1
+    assert scheduler.run_due(LATER + 29) == 0
+    assert scheduler.run_due(LATER + 30) == 1
+    assert scheduler.delete.deleted == ["a"]
+
+
+def test_resumes_deletions_recorded_on_disk(tmp_path):
+    previous = make_scheduler(tmp_path)
+    previous.schedule("a", LATER)
+    previous.schedule("b", LATER + 10)
+    exit_process(previous)
+
+    scheduler = make_scheduler(tmp_path)
+    assert scheduler.resume() == 2
+    assert scheduler.run_due(LATER) == 1
+    assert scheduler.run_due(LATER + 10) == 1
+    assert scheduler.delete.deleted == ["a", "b"]
+    assert records(tmp_path) == []
+
+
+def test_leaves_deletions_of_live_schedulers(tmp_path):
+    owner = make_scheduler(tmp_path)
+    owner.schedule("a", LATER)
+
+    scheduler = make_scheduler(tmp_path)
+    assert scheduler.resume() == 0
+    assert scheduler.run_due(LATER) == 0
+    assert owner.run_due(LATER) == 1
+    assert scheduler.delete.deleted == []
+    assert owner.delete.deleted == ["a"]
+
+
+def test_deletes_each_file_once(tmp_path):
+    previous = make_scheduler(tmp_path)
+    previous.schedule("a", LATER)
+    previous.schedule("b", LATER)
+    exit_process(previous)
+
+    # Workers starting at the same time each resume
+    workers = [make_scheduler(tmp_path) for _ in range(3)]
+    assert [worker.resume() for worker in workers] == [2, 0, 0]
+    assert workers[0].resume() == 0
+
+    for worker in [previous, *workers]:
+        worker.run_due(LATER)
+        worker.run_due(LATER + 60)
+    assert previous.delete.deleted == []
+    assert sorted(workers[0].delete.deleted) == ["a", "b"]
+    assert workers[1].delete.deleted == workers[2].delete.deleted == []
+
+
+def test_takes_over_deletions_of_workers_which_exit(tmp_path):
+    scheduler = make_scheduler(tmp_path)
+    assert scheduler.resume() == 0
+
+    worker = make_scheduler(tmp_path)
+    worker.schedule("a", LATER)
+    assert scheduler.resume() == 0
+    exit_process(worker)
+
+    assert scheduler.resume() == 1
+    assert scheduler.run_due(LATER) == 1
+    assert scheduler.delete.deleted == ["a"]
+
+
+def test_deletes_uploads_from_the_storage_backend(tmp_path, monkeypatch):
+    from midi_app import file_management
+    from midi_app.storage import MemoryStorage
+
+    storage = MemoryStorage("http://localhost")
+    scheduler = make_scheduler(tmp_path / "pending", storage.delete)
+    monkeypatch.setattr(file_management, "storage", storage)
+    monkeypatch.setattr(file_management, "expiry_scheduler", scheduler)
+
+    url = file_management.upload_file(b"RIFF clicktrack", "wav")
+    name = url.rsplit("/", 1)[1]
+    assert storage.open(name) is not None
+    assert scheduler.stats()["pending"] == 1
+
+    assert scheduler.run_due(time.time() + file_management.DELETE_TIMEOUT) == 1
+    assert storage.open(name) is None
+    assert scheduler.stats() == {"pending": 0, "next_expiry": None, "deleted": 1, "failed": 0}
+
+
+def test_deletes_in_batches(tmp_path):
+    scheduler = make_scheduler(tmp_path)
+    for idx in range(250):
+        scheduler.schedule(f"clicktrack{idx}", LATER + idx % 10)
+
+    assert scheduler.stats()["next_expiry"] == LATER
+    assert scheduler.run_due(LATER + 10) == 250
+    assert [len(call) for call in scheduler.delete.calls] == [100, 100, 50]
+    assert len(set(scheduler.delete.deleted)) == 250
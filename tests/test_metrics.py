@@ -0,0 +1,29 @@
+import os
+import subprocess
+import sys
+
+from midi_app.metrics import Metrics
+
+
+def exited_pid() -> int:
+    process = subprocess.Popen([sys.executable, "-c", "pass"])
+    process.wait()
+    return process.pid
+
+
+def test_drops_gauges_of_exited_processes():
+    pool_worker = Metrics()
+    pool_worker.set("clicktrack_cache_entries", 3, cache="samples")
+    snapshot = pool_worker.snapshot()
+    # As if it came from a pool worker which has since been replaced
+    dead_pid = str(exited_pid())
+    snapshot["gauges"] = [[name, [[k, dead_pid if k == "pid" else v] for k, v in labels], value] for name, labels, value in snapshot["gauges"]]
+    snapshot["counters"] = [["clicktrack_renders_total", [], 2]]
+
+    metrics = Metrics()
+    metrics.set("clicktrack_cache_entries", 5, cache="samples")
+    metrics.merge(snapshot)
+    gauges = [(name, dict(labels)["pid"], value) for name, labels, value in metrics.snapshot()["gauges"]]
+
+    assert gauges == [("clicktrack_cache_entries", str(os.getpid()), 5)]
+    assert metrics.snapshot()["counters"] == [["clicktrack_renders_total", [], 2]]
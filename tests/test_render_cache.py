@@ -0,0 +1,23 @@
+from midi_app import app, views
+from midi_app.jobs import render_key_for
+from midi_app.render_cache import RenderCache
+
+SECTION_DATA = [{"rhythms": [{"timeSig": [4, 4], "accentedBeats": [0]}], "overallData": {"numMeasures": 1}}]
+NOTE_BPMS = [120] * 4
+INSTRUMENTS = ["woodblock_high"]
+
+
+def test_streams_cached_renders(tmp_path, monkeypatch):
+    # Relative to the working directory, as the default RENDER_CACHE_DIR is
+    monkeypatch.chdir(tmp_path)
+    render_cache = RenderCache("render_cache")
+    monkeypatch.setattr(views, "render_cache", render_cache)
+    rendered = tmp_path / "rendered.wav"
+    rendered.write_bytes(b"RIFF cached clicktrack")
+    render_cache.put(render_key_for("wav", SECTION_DATA, NOTE_BPMS, INSTRUMENTS), str(rendered), "wav")
+
+    response = app.test_client().post(
+        "/api/make_wav?stream=1", json={"sectionData": SECTION_DATA, "noteBpms": NOTE_BPMS, "instruments": INSTRUMENTS}
+    )
+    assert response.status_code == 200
+    assert response.data == b"RIFF cached clicktrack"
@@ -0,0 +1,59 @@
+from midi_app import app, views
+from midi_app.storage import LocalStorage
+
+
+def test_downloads_locally_stored_files(tmp_path, monkeypatch):
+    # Relative to the working directory, as the default STORAGE_DIR is
+    monkeypatch.chdir(tmp_path)
+    storage = LocalStorage("stored_files", "http://localhost")
+    monkeypatch.setattr(views, "storage", storage)
+    url, name = storage.upload(b"RIFF clicktrack", "wav")
+    assert url == f"http://localhost/files/{name}"
+
+    response = app.test_client().get(f"/files/{name}")
+    assert response.status_code == 200
+    assert response.data == b"RIFF clicktrack"
+    assert app.test_client().get("/files/missing.wav").status_code == 404
+
+
+def test_uploads_streams_of_unknown_size_to_cloudinary_in_parts(monkeypatch):
+    import cloudinary.uploader
+
+    from midi_app import storage as storage_module
+    from midi_app.encoding import ChunkStream
+    from midi_app.storage import CloudinaryStorage
+
+    parts = []
+
+    def upload_large_part(file, http_headers, **options):
+        parts.append((http_headers["Content-Range"], file[1], options.get("public_id")))
+        return {"public_id": "clicktracks/abc", "secure_url": "https://cloudinary/abc.flac"}
+
+    monkeypatch.setattr(cloudinary.uploader, "upload_large_part", upload_large_part)
+    monkeypatch.setattr(storage_module, "UPLOAD_CHUNK_BYTES", 4)
+    storage = CloudinaryStorage()
+    monkeypatch.setattr(storage, "_configured", True)
+    stream = ChunkStream(iter([b"fLaC", b"abc", b"defgh"]))
+    assert not stream.seekable()
+
+    assert storage.upload(stream, "flac") == ("https://cloudinary/abc.flac", "clicktracks/abc")
+    assert parts == [
+        ("bytes 0-3/-1", b"fLaC", None),
+        ("bytes 4-7/-1", b"abcd", "clicktracks/abc"),
+        ("bytes 8-11/12", b"efgh", "clicktracks/abc"),
+    ]
+
+
+def test_cloudinary_responses_without_a_url_or_id_are_errors(monkeypatch):
+    import cloudinary.uploader
+
+    from midi_app.storage import CloudinaryStorage
+
+    storage = CloudinaryStorage()
+    monkeypatch.setattr(storage, "_configured", True)
+    monkeypatch.setattr(cloudinary.uploader, "upload_large", lambda source, **options: {})
+    assert storage.upload(b"RIFF clicktrack", "wav") == ("error", None)
+
+    # Still deleted once it expires, even though there's no url for it
+    monkeypatch.setattr(cloudinary.uploader, "upload_large", lambda source, **options: {"public_id": "abc"})
+    assert storage.upload(b"{}", "json") == ("error", "raw:abc")